@@ -34,6 +34,7 @@ from   matplotlib import pyplot
 import time
 
 from tdl.modules.utils import plotter
+from tdl.modules.utils.columns import PointStore, RodIndex
 from tdl.modules.utils.mathutil import cosd, sind, tand
 from tdl.modules.utils.mathutil import arccosd, arcsind, arctand
 
@@ -43,6 +44,8 @@ from tdl.modules.geom import gonio_psic
 
 DEBUG = False
 
+CTR_COLUMNS = ['H','K','L','I','Inorm','Ierr','Ibgr','ctot','F','Ferr']
+
 ##############################################################################
 def ctr_data(scans,ctr=None,I=None,Inorm=None,Ierr=None,Ibgr=None,
              corr_params=None,scan_type=None):
@@ -64,7 +67,7 @@ def ctr_data(scans,ctr=None,I=None,Inorm=None,Ierr=None,Ibgr=None,
                          corr_params=corr_params,scan_type=scan_type)
     
 ##############################################################################
-class CtrData:
+class CtrData(PointStore):
     """
     CTR data
 
@@ -72,12 +75,12 @@ class CtrData:
     -----------
     * bad is a list of index values of points flagged as 'bad'
     * scan is a list holding all the scan data ojects
-    * scan_index is a list (possibly of tuples) that give the
-      scan index corresponding to a data point. see the get_scan method
-    * labels is a dictionary of lists of the string labels
-      for 'I','Inorm','Ierr','Ibgr'
-    * corr_params = list of correction parameter dictionaries
-    * scan_type list of string flags for scan type
+    * scan_index is an (npts x 2) array that gives the (scan, point)
+      index corresponding to a data point. see the get_scan method
+    * labels is a dictionary of ParamColumns (list like) of the string
+      labels for 'I','Inorm','Ierr','Ibgr'
+    * corr_params = ParamColumn of correction parameter dictionaries
+    * scan_type ParamColumn of string flags for scan type
     * H     = array of H values
     * K     = array of K values
     * L     = array of L values
@@ -88,7 +91,15 @@ class CtrData:
     * ctot  = array of total correction factors
     * F     = array of structure factor magnitudes
     * Ferr  = array of structure factor error bars
+
+    The data arrays are views of a columnar store (see utils.columns)
+    that grows with amortized capacity, so modify them in place
+    (e.g. ctr.F[idx] = ...).  get_data returns the data of a set
+    of points (e.g. a rod).
     """
+    _columns   = CTR_COLUMNS
+    _rod_index = True
+
     ##########################################################################
     def __init__(self,scans=[],I='I',Inorm='io',Ierr='Ierr',
                  Ibgr='Ibgr',corr_params={},scan_type='image'):
@@ -149,22 +160,8 @@ class CtrData:
         self.hklist = None
         self.bad    = []
         self.scan   = []
-        self.scan_index  = []
         #
-        self.labels      = {'I':[],'Inorm':[],'Ierr':[],'Ibgr':[]}
-        self.corr_params = []
-        self.scan_type   = []
-        #
-        self.H     = num.array([],dtype=float)
-        self.K     = num.array([],dtype=float)
-        self.L     = num.array([],dtype=float)
-        self.I     = num.array([],dtype=float)
-        self.Inorm = num.array([],dtype=float)
-        self.Ierr  = num.array([],dtype=float)
-        self.Ibgr  = num.array([],dtype=float)
-        self.ctot  = num.array([],dtype=float)
-        self.F     = num.array([],dtype=float)
-        self.Ferr  = num.array([],dtype=float)
+        self._init_store()
         #
         self.append_scans(scans,I=I,Inorm=Inorm,Ierr=Ierr,Ibgr=Ibgr,
                           corr_params=corr_params,
@@ -190,6 +187,26 @@ class CtrData:
         except:
             self.cursor = None
 
+    ##########################################################################
+    def delete_points(self,idx):
+        """
+        Remove the data points in idx.  The following points are
+        renumbered (the scans are kept in self.scan)
+        """
+        self._sync_store()
+        idx = num.unique(num.asarray(idx,dtype=int))
+        if len(idx) == 0: return
+        self._store.delete(idx)
+        for lbl in self.labels.values():
+            lbl.delete(idx)
+        self.corr_params.delete(idx)
+        self.scan_type.delete(idx)
+        self.rods.delete(idx)
+        bad = num.array([j for j in self.bad if j not in idx],dtype=int)
+        self.bad = [int(j) for j in bad - num.searchsorted(idx,bad)]
+        self._set_views()
+        self.hklist = find_HKs(self)
+
     ##########################################################################
     def append_scans(self,scans,I=None,Inorm=None,Ierr=None,Ibgr=None,
                      corr_params=None,scan_type=None):
@@ -205,6 +222,9 @@ class CtrData:
 
         For any argument with None passed we use previous defined
         values - based on the last exisiting data point.  
+
+        If a scan cannot be parsed it and the following scans are
+        not added, the scans before it are kept.
         """
         if type(scans) != types.ListType:
             scans = [scans]
@@ -217,32 +237,18 @@ class CtrData:
         if corr_params == None: corr_params = self.corr_params[-1]
         if scan_type == None:   scan_type = self.scan_type[-1]
 
-        # get all the data parsed out of each scan and append
+        # get all the data parsed out of each scan
+        self._sync_store()
+        new = []
         for scan in scans:
             data = self._scan_data(scan,I,Inorm,Ierr,Ibgr,corr_params,scan_type)
-            if data == None: return
-
-            #self.scan.append([])
+            # stop at a bad scan, the scans parsed so far are
+            # still stored (and hklist updated) below
+            if data == None: break
             self.scan.append(scan)
-            #
-            self.scan_index.extend(data['scan_index'])
-            self.labels['I'].extend(data['I_lbl'])
-            self.labels['Inorm'].extend(data['Inorm_lbl'])
-            self.labels['Ierr'].extend(data['Ierr_lbl'])
-            self.labels['Ibgr'].extend(data['Ibgr_lbl'])
-            self.corr_params.extend(data['corr_params'])
-            self.scan_type.extend(data['scan_type'])
-            #
-            self.H     = num.append(self.H,data['H'])
-            self.K     = num.append(self.K,data['K'])
-            self.L     = num.append(self.L,data['L'])
-            self.I     = num.append(self.I,data['I'])
-            self.Inorm = num.append(self.Inorm,data['Inorm'])
-            self.Ierr  = num.append(self.Ierr,data['Ierr'])
-            self.Ibgr  = num.append(self.Ibgr,data['Ibgr'])
-            self.ctot  = num.append(self.ctot,data['ctot'])
-            self.F     = num.append(self.F,data['F'])
-            self.Ferr  = num.append(self.Ferr,data['Ferr'])
+            new.append(data)
+        # and append to the store in one step
+        self._extend_store(new)
         # make a list of stored hk's
         self.hklist = find_HKs(self)
         
@@ -368,6 +374,8 @@ class CtrData:
             self.labels['Inorm'][idx] = Inorm
             self.labels['Ierr'][idx]  = Ierr
             self.corr_params[idx]     = corr_params
+            self.rods.update(idx,scan['H'][point],scan['K'][point],
+                             scan['L'][point],oldH=self.H[idx],oldK=self.K[idx])
             self.H[idx]               = scan['H'][point]
             self.K[idx]               = scan['K'][point]
             self.L[idx]               = scan['L'][point]
@@ -662,17 +670,12 @@ class CtrData:
         subplot = self.cursor.subplot
         if subplot < 0:
             return None
-        hksets  = sort_data(self)
-        return self._get_idx(subplot,L,hksets)
+        return self._get_idx(subplot,L)
     
-    def _get_idx(self,subplot,L,hksets):
-        d   = hksets[subplot]
-        tmp = num.fabs(d['L']-L)
-        idx = num.where(tmp==min(tmp))
-        if len(idx) > 0:
-            idx = idx[0]
-        point_idx = d['point_idx'][idx]
-        return point_idx
+    def _get_idx(self,subplot,L):
+        rods = rod_index(self)
+        (H,K) = rods.keys()[subplot]
+        return rods.nearest(H,K,L)
 
     ##########################################################################
     def get_scan(self,idx=None):
@@ -773,20 +776,12 @@ class CtrData:
         subplot = self.cursor.subplot
         if subplot < 0:
             return None
-        hksets  = sort_data(self)
-        return self._get_idx_range(subplot,Lmin,Lmax,hksets)
+        return self._get_idx_range(subplot,Lmin,Lmax)
         
-    def _get_idx_range(self,subplot,Lmin,Lmax,hksets):
-        d    = hksets[subplot]
-        tmp  = d['L']
-        idx1 = num.where(tmp<Lmin)
-        idx2 = num.where(tmp>Lmax)
-        tmp  = num.fabs(tmp)
-        tmp[idx1] = 0.0
-        tmp[idx2] = 0.0
-        idx = num.where(tmp > 0 )
-        point_idx = d['point_idx'][idx]
-        return (point_idx)
+    def _get_idx_range(self,subplot,Lmin,Lmax):
+        rods = rod_index(self)
+        (H,K) = rods.keys()[subplot]
+        return rods.select(H,K,Lmin,Lmax)
     
     ##########################################################################
     def write_HKL(self,fname = 'ctr.lst'):
@@ -807,23 +802,32 @@ class CtrData:
                 f.write(line)
         f.close()
 
+##########################################################################
+def rod_index(ctr,hkdecimal=3):
+    """
+    Get the RodIndex of a ctr data object.
+
+    The index kept by a CtrData instance (ctr.rods) is returned
+    if it has the requested precision, otherwise (e.g. for other
+    data objects) an index is built from ctr.H, ctr.K and ctr.L
+    """
+    rods = getattr(ctr,'rods',None)
+    if isinstance(ctr,CtrData):
+        ctr._sync_store()
+        rods = ctr.rods
+    if rods != None and rods.hkdecimal == hkdecimal and rods.npts == len(ctr.L):
+        return rods
+    rods = RodIndex(hkdecimal=hkdecimal)
+    rods.add(ctr.H,ctr.K,ctr.L)
+    return rods
+
 ##########################################################################
 def find_HKs(ctr,hkdecimal=3):
     """
     find all the unique HK pairs in the data set
+    (sorted list of (H,K) tuples)
     """
-    hkvals = []
-    npts = len(ctr.L)
-    H = num.around(ctr.H,decimals=hkdecimal)
-    K = num.around(ctr.K,decimals=hkdecimal)
-    s = []
-    for j in range(npts):
-        s = (H[j],K[j]) 
-        if s not in hkvals:
-            hkvals.append(s)
-    # sort the hkvals
-    hkvals.sort()
-    return hkvals
+    return rod_index(ctr,hkdecimal=hkdecimal).keys()
 
 ##########################################################################
 def HK_idx(ctr,H,K,hkdecimal=3):
@@ -838,14 +842,8 @@ def HK_idx(ctr,H,K,hkdecimal=3):
     Lset = ctr.K[idx]
     Fset = ctr.F[idx]
     """
-    Hrnd = num.around(ctr.H,decimals=hkdecimal)
-    Krnd = num.around(ctr.K,decimals=hkdecimal)
-    idx1 = num.where(Hrnd==H)
-    if len(idx1) == 0:
-        return idx1
-    idx2 = num.where(Krnd[idx1]==K)
-    idx = (idx1[0][idx2],)
-    return idx
+    idx = rod_index(ctr,hkdecimal=hkdecimal).rod(H,K)
+    return (num.sort(idx),)
 
 ##########################################################################
 def sort_data(ctr,hkdecimal=3):
@@ -861,48 +859,21 @@ def sort_data(ctr,hkdecimal=3):
     * hkdecimal is the number of precision to round H and K
       values to for sorting.  
 
+    Returns a list (sorted by H,K) of dictionaries of the data of
+    each rod, sorted by L.  The point indicies of each rod are
+    taken from the rod index (see rod_index), so each rod costs
+    O(rod size).
     """
-    scan_idx = ctr.scan_index
-    npts = len(ctr.F)
-
-    #find all unique sets
-    hkvals = find_HKs(ctr,hkdecimal=hkdecimal)
-
-    # put data in correct set
-    nsets = len(hkvals)
+    rods = rod_index(ctr,hkdecimal=hkdecimal)
     hkset = []
-    for j in range(nsets):
-        hkset.append({'H':[],'K':[],'L':[],'F':[],'Ferr':[],
-                      'I':[],'Inorm':[],'Ierr':[],'Ibgr':[],
-                      'point_idx':[]})
-    for j in range(nsets):
-        s = hkvals[j]
-        idx = HK_idx(ctr,s[0],s[1],hkdecimal=hkdecimal)
-        hkset[j]['H']     = num.around(ctr.H[idx],decimals=hkdecimal)
-        hkset[j]['K']     = num.around(ctr.K[idx],decimals=hkdecimal)
-        hkset[j]['L']     = ctr.L[idx]
-        hkset[j]['F']     = ctr.F[idx]
-        hkset[j]['Ferr']  = ctr.Ferr[idx]
-        hkset[j]['I']     = ctr.I[idx]
-        hkset[j]['Inorm'] = ctr.Inorm[idx]
-        hkset[j]['Ierr']  = ctr.Ierr[idx]
-        hkset[j]['Ibgr']  = ctr.Ibgr[idx]
-        hkset[j]['point_idx'] = idx[0]
-
-    # now sort each set by L
-    for j in range(nsets):
-        lidx = num.argsort(hkset[j]['L'])
-        hkset[j]['H'] = hkset[j]['H'][lidx]
-        hkset[j]['K'] = hkset[j]['K'][lidx]
-        hkset[j]['L'] = hkset[j]['L'][lidx]
-        hkset[j]['F'] = hkset[j]['F'][lidx]
-        hkset[j]['Ferr'] = hkset[j]['Ferr'][lidx]
-        hkset[j]['I'] = hkset[j]['I'][lidx]
-        hkset[j]['Inorm'] = hkset[j]['Inorm'][lidx]
-        hkset[j]['Ierr'] = hkset[j]['Ierr'][lidx]
-        hkset[j]['Ibgr'] = hkset[j]['Ibgr'][lidx]
-        hkset[j]['point_idx'] = hkset[j]['point_idx'][lidx]
-
+    for (H,K) in rods.keys():
+        idx = rods.rod(H,K)
+        hkset.append({'H':num.around(ctr.H[idx],decimals=hkdecimal),
+                      'K':num.around(ctr.K[idx],decimals=hkdecimal),
+                      'L':ctr.L[idx],'F':ctr.F[idx],'Ferr':ctr.Ferr[idx],
+                      'I':ctr.I[idx],'Inorm':ctr.Inorm[idx],
+                      'Ierr':ctr.Ierr[idx],'Ibgr':ctr.Ibgr[idx],
+                      'point_idx':idx})
     return hkset
 
 ##############################################################################
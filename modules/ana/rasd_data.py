@@ -34,8 +34,11 @@ from   tdl.modules.specfile.reader import Reader
 from   tdl.modules.ana.scan_data import ScanData
 from   tdl.modules.ana import image_data
 from   tdl.modules.ana import ctr_data
+from   tdl.modules.utils.columns import PointStore
 from   tdl.modules.ana.ctr_data import *
 
+RASD_COLUMNS = ['H','K','L','E','I','Inorm','Ierr','Ibgr','ctot','F','Ferr']
+
 #############################################################################
 def rasd_data(spec_path,spec,first_scan,last_scan):
     """
@@ -89,7 +92,7 @@ def rasd_data(spec_path,spec,first_scan,last_scan):
 
 ##################################################################################
 ##################################################################################
-class RasdData:
+class RasdData(PointStore):
     """
     RASD data
 
@@ -97,12 +100,12 @@ class RasdData:
     -----------
     * bad is a list of index values of points flagged as 'bad'
     * scan is a list holding all the scan data ojects
-    * scan_index is a list (possibly of tuples) that give the
-      scan index corresponding to a data point. see the get_scan method
-    * labels is a dictionary of lists of the string labels
-      for 'I','Inorm','Ierr','Ibgr'
-    * corr_params = list of correction parameter dictionaries
-    * scan_type list of string flags for scan type
+    * scan_index is an (npts x 2) array that gives the (scan, point)
+      index corresponding to a data point. see the get_scan method
+    * labels is a dictionary of ParamColumns (list like) of the string
+      labels for 'I','Inorm','Ierr','Ibgr'
+    * corr_params = ParamColumn of correction parameter dictionaries
+    * scan_type ParamColumn of string flags for scan type
     * H     = array of H values
     * K     = array of K values
     * L     = array of L values
@@ -114,7 +117,14 @@ class RasdData:
     * ctot  = array of total correction factors
     * F     = array of structure factor magnitudes
     * Ferr  = array of structure factor error bars
+
+    The data arrays are views of a columnar store (see utils.columns)
+    that grows with amortized capacity, so modify them in place
+    (e.g. ctr.F[idx] = ...).  get_data returns the data of a set
+    of points (e.g. a rod).
     """
+    _columns   = RASD_COLUMNS
+
     ##########################################################################
     def __init__(self,scans=[],I='I',Inorm='io',Ierr='Ierr',
                  Ibgr='Ibgr',corr_params={},scan_type='image'):
@@ -174,23 +184,8 @@ class RasdData:
         self.cursor = None
         self.bad    = []
         self.scan   = []
-        self.scan_index  = []
-        #
-        self.labels      = {'I':[],'Inorm':[],'Ierr':[],'Ibgr':[]}
-        self.corr_params = []
-        self.scan_type   = []
         #
-        self.H     = num.array([],dtype=float)
-        self.K     = num.array([],dtype=float)
-        self.L     = num.array([],dtype=float)
-        self.E     = num.array([],dtype=float)
-        self.I     = num.array([],dtype=float)
-        self.Inorm = num.array([],dtype=float)
-        self.Ierr  = num.array([],dtype=float)
-        self.Ibgr  = num.array([],dtype=float)
-        self.ctot  = num.array([],dtype=float)
-        self.F     = num.array([],dtype=float)
-        self.Ferr  = num.array([],dtype=float)
+        self._init_store()
         #
         self.append_scans(scans,I=I,Inorm=Inorm,Ierr=Ierr,Ibgr=Ibgr,
                           corr_params=corr_params,
@@ -228,6 +223,9 @@ class RasdData:
 
         For any argument with None passed we use previous defined
         values - based on the last exisiting data point.  
+
+        If a scan cannot be parsed it and the following scans are
+        not added, the scans before it are kept.
         """
         if type(scans) != types.ListType:
             scans = [scans]
@@ -240,33 +238,18 @@ class RasdData:
         if corr_params == None: corr_params = self.corr_params[-1]
         if scan_type == None:   scan_type = self.scan_type[-1]
 
-        # get all the data parsed out of each scan and append
+        # get all the data parsed out of each scan
+        self._sync_store()
+        new = []
         for scan in scans:
             data = self._scan_data(scan,I,Inorm,Ierr,Ibgr,corr_params,scan_type)
-            if data == None: return
-
-            #self.scan.append([])
+            # stop at a bad scan, the scans parsed so far are
+            # still stored below
+            if data == None: break
             self.scan.append(scan)
-            #
-            self.scan_index.extend(data['scan_index'])
-            self.labels['I'].extend(data['I_lbl'])
-            self.labels['Inorm'].extend(data['Inorm_lbl'])
-            self.labels['Ierr'].extend(data['Ierr_lbl'])
-            self.labels['Ibgr'].extend(data['Ibgr_lbl'])
-            self.corr_params.extend(data['corr_params'])
-            self.scan_type.extend(data['scan_type'])
-            #
-            self.H     = num.append(self.H,data['H'])
-            self.K     = num.append(self.K,data['K'])
-            self.L     = num.append(self.L,data['L'])
-            self.I     = num.append(self.I,data['I'])
-            self.Inorm = num.append(self.Inorm,data['Inorm'])
-            self.Ierr  = num.append(self.Ierr,data['Ierr'])
-            self.Ibgr  = num.append(self.Ibgr,data['Ibgr'])
-            self.ctot  = num.append(self.ctot,data['ctot'])
-            self.F     = num.append(self.F,data['F'])
-            self.Ferr  = num.append(self.Ferr,data['Ferr'])
-            self.E     = num.append(self.E,data['E'])
+            new.append(data)
+        # and append to the store in one step
+        self._extend_store(new)
 
     ##########################################################################
     def _scan_data(self,scan,I,Inorm,Ierr,Ibgr,corr_params,scan_type):
@@ -21,10 +21,26 @@ root/med_data/...
 root/xrf_data/...  
 root/ctr_data/...  
 
+The chunked archive (archive_ctrdata, archive_scandata) keeps the
+per point data of a set as extendable, compressed arrays (one per
+column, with one row per point or image):
+root/ctr_archive/<setname>/H, K, ..., scan_index, bad
+                           I_lbl, ..., corr_params, scan_type
+root/scan_archive/<setname>/scalers/..., positioners/..., errors/...
+                            image/images, rois, peaks_I, ...
+Parameter columns (labels, corr_params) are stored as integer codes
+into a table of the distinct values (kept as a column attribute),
+other non-array values as group attributes.  Rewriting an existing
+set only writes the rows that changed and appends new rows, and
+columns can be read individually (read_ctr_column, read_scan_column).
+
 Examples:
 --------
 >>write_ctrdata(ctr,file='ctr.h5')
 >>ctr = read_ctrdata(file='ctr.h5',name='ctr')
+>>archive_ctrdata('ctr.h5',ctr,setname='ctr')
+>>ctr = load_ctrdata('ctr.h5',setname='ctr')
+>>F = read_ctr_column('ctr.h5','F',setname='ctr',rows=idx)
 
 Todo:
 -----
@@ -39,6 +55,7 @@ Todo:
 import types
 import os
 import copy
+import zlib
 import numpy as num
 
 try:
@@ -49,6 +66,14 @@ except:
 from tdl.modules.ana import scan_data
 from tdl.modules.ana import image_data
 from tdl.modules.ana import ctr_data
+from tdl.modules.utils.columns import ParamColumn
+
+# chunked archive
+ARCHIVE_VERSION     = 1
+ARCHIVE_COMPLEVEL   = 5
+ARCHIVE_COMPLIB     = 'zlib'
+ARCHIVE_CHUNK_BYTES = 2**16
+ARCHIVE_BLOCK_BYTES = 2**22
 
 ################################################################################
 def get_file(fname,path=None):
@@ -219,12 +244,12 @@ def _ctr_data(ctr):
     npts = len(ctr.L)
     d = {}
     d['bad']        = ctr.bad
-    d['scan_index'] = ctr.scan_index
-    d['scan_type']  = ctr.scan_type
-    d['I_lbl']      = ctr.labels['I']
-    d['In_lbl']     = ctr.labels['Inorm']
-    d['Ie_lbl']     = ctr.labels['Ierr']
-    d['Ib_lbl']     = ctr.labels['Ibgr']
+    d['scan_index'] = num.array(ctr.scan_index)
+    d['scan_type']  = list(ctr.scan_type)
+    d['I_lbl']      = list(ctr.labels['I'])
+    d['In_lbl']     = list(ctr.labels['Inorm'])
+    d['Ie_lbl']     = list(ctr.labels['Ierr'])
+    d['Ib_lbl']     = list(ctr.labels['Ibgr'])
     d['H']  = ctr.H   
     d['K']  = ctr.K     
     d['L']  = ctr.L    
@@ -533,6 +558,537 @@ def _read_scan(h,setname):
     return data
 
 
+################################################################################
+# Chunked archive
+################################################################################
+def _filters():
+    """ compression filters of the archive columns """
+    return tables.Filters(complevel=ARCHIVE_COMPLEVEL,complib=ARCHIVE_COMPLIB,
+                          shuffle=True)
+
+def _group(h,where,name,title=''):
+    """ get or create a group """
+    try:
+        return h.getNode(where,name)
+    except tables.NoSuchNodeError:
+        return h.createGroup(where,name,title)
+
+def _child(h,where,name):
+    """ node or None """
+    try:
+        return h.getNode(where,name)
+    except tables.NoSuchNodeError:
+        return None
+
+def _remove_stale(h,grp,names):
+    """ remove the children of grp that are not in names """
+    for name in grp._v_children.keys():
+        if name not in names:
+            h.removeNode(grp,name,recursive=True)
+
+def _is_column(val):
+    """ numeric arrays are stored as columns, anything else as attributes """
+    return isinstance(val,num.ndarray) and val.ndim > 0 and \
+           val.dtype.kind in 'biuf'
+
+def _row_bytes(values):
+    return max(values.dtype.itemsize*int(num.prod(values.shape[1:])),1)
+
+def _changed_runs(node,values):
+    """
+    (start,stop) runs of the rows of values that differ from the
+    stored rows (nan == nan).  The stored rows are read in blocks
+    """
+    nrows = len(values)
+    changed = num.zeros(nrows,dtype=bool)
+    block = max(ARCHIVE_BLOCK_BYTES/_row_bytes(values),1)
+    for i0 in range(0,nrows,block):
+        i1  = min(i0+block,nrows)
+        old = node.read(i0,i1)
+        new = values[i0:i1]
+        diff = (old != new)
+        if new.dtype.kind == 'f':
+            diff = diff & ~(num.isnan(old) & num.isnan(new))
+        changed[i0:i1] = diff.reshape(i1-i0,-1).any(axis=1)
+    d = num.diff(num.concatenate(([0],changed.astype(int),[0])))
+    return zip(num.where(d == 1)[0],num.where(d == -1)[0])
+
+def _update_column(h,grp,name,values):
+    """
+    Write a column (array with one row per point) to an extendable,
+    chunked and compressed array.  If the column exists only the rows
+    that changed are rewritten, new rows are appended and rows beyond
+    the end of values are truncated (a checksum is kept so an unchanged
+    column is not read).  Returns the number of rows written
+    """
+    values = num.ascontiguousarray(values)
+    crc  = zlib.crc32(values.tostring())
+    node = _child(h,grp,name)
+    if node is not None:
+        if not isinstance(node,tables.EArray) or \
+           node.shape[1:] != values.shape[1:] or \
+           node.atom.dtype != values.dtype:
+            h.removeNode(node)
+            node = None
+        else:
+            if node.nrows > len(values):
+                node.truncate(len(values))
+            if node.nrows == len(values) and \
+               getattr(node.attrs,'crc',None) == crc:
+                return 0
+    if node is None:
+        nchunk = max(ARCHIVE_CHUNK_BYTES/_row_bytes(values),1)
+        node = h.createEArray(grp,name,tables.Atom.from_dtype(values.dtype),
+                              (0,)+values.shape[1:],name,filters=_filters(),
+                              expectedrows=max(len(values),1),
+                              chunkshape=(nchunk,)+values.shape[1:])
+    nold  = node.nrows
+    nrows = 0
+    for (i0,i1) in _changed_runs(node,values[:nold]):
+        node[i0:i1] = values[i0:i1]
+        nrows = nrows + (i1 - i0)
+    if len(values) > nold:
+        node.append(values[nold:])
+        nrows = nrows + (len(values) - nold)
+    node.attrs.crc = crc
+    return nrows
+
+def _update_param(h,grp,name,pcol):
+    """
+    Write a ParamColumn as a column of codes, the table of the
+    distinct values is kept as an attribute of the column
+    """
+    nrows = _update_column(h,grp,name,num.asarray(pcol.codes,dtype=int))
+    h.getNode(grp,name).attrs.table = list(pcol.table)
+    return nrows
+
+def _read_node(node,rows=None):
+    """
+    Read a column, rows is None (all rows), a slice or an
+    array of row indicies
+    """
+    if rows is None:
+        return node.read()
+    if isinstance(rows,slice):
+        return node[rows]
+    rows = num.asarray(rows,dtype=int)
+    if len(rows) == 0:
+        return num.zeros((0,)+node.shape[1:],dtype=node.atom.dtype)
+    rows = num.where(rows < 0,rows + node.nrows,rows)
+    (i0,i1) = (num.min(rows),num.max(rows)+1)
+    return node.read(i0,i1)[rows - i0]
+
+def _read_param(node,rows=None):
+    """ ParamColumn from a column of codes """
+    pcol = ParamColumn()
+    pcol.set_codes(node.attrs.table,_read_node(node,rows))
+    return pcol
+
+def _set_source(h,grp,obj,skipped):
+    """
+    Record the set obj was read from and the columns that were
+    not read (load_ctrdata/load_scandata with columns)
+    """
+    obj._archive_src = (os.path.abspath(h.filename),grp._v_pathname,
+                        list(skipped))
+
+def _skipped_columns(h,grp,obj,npts):
+    """
+    Names of the columns of obj that were not read from the archive,
+    these are left as stored.  A partially loaded object can only be
+    archived back to the set it was read from and without changing
+    the number of points, otherwise a ValueError is raised
+    """
+    src = getattr(obj,'_archive_src',None)
+    if src is None or len(src[2]) == 0: return []
+    (fname,where,skipped) = src
+    if fname != os.path.abspath(h.filename) or where != grp._v_pathname:
+        raise ValueError, "%s is partially loaded from %s:%s, " \
+              "it can only be archived to that set" % (grp._v_name,fname,where)
+    for name in skipped:
+        node = _child(h,where,name)
+        if node is None or node.nrows != npts:
+            raise ValueError, "%s is partially loaded and does not match the " \
+                  "stored set, load all columns to archive it" % where
+    return skipped
+
+class ArchiveImages:
+    """
+    List like access to the images of an archived scan.
+    The images are read from the file when accessed
+    """
+    def __init__(self,fname,where,nimages):
+        self.fname   = fname
+        self.where   = where
+        self.nimages = nimages
+
+    def __len__(self):
+        return self.nimages
+
+    def __getitem__(self,arg):
+        h = tables.openFile(self.fname,mode="r")
+        try:
+            im = h.getNode(self.where)[arg]
+        finally:
+            h.close()
+        return im
+
+    def __setitem__(self,arg,val):
+        print "Cannot set item"
+        return
+
+################################################################################
+def archive_ctrdata(fname,ctr,setname='ctr',path=None,scans=True):
+    """
+    Write ctr data to the chunked archive (root/ctr_archive)
+
+    Parameters:
+    -----------
+    * fname is the file name (path is an optional directory)
+    * ctr is the CtrData instance
+    * setname is the name of the data set
+    * scans is a flag to also archive the scans (as
+      root/scan_archive/<setname>_S###)
+
+    Returns:
+    --------
+    * the number of rows written
+
+    Notes:
+    ------
+    If the set already exists only the rows that changed since the
+    last write are rewritten and new points are appended, so saving
+    after editing a few points does not rewrite the whole set.
+    Columns that were not read by load_ctrdata(columns=...) are left
+    as stored, such a ctr can only be archived to the set it was read
+    from and with the same points.
+    """
+    h = get_file(fname,path)
+    if h == None: return
+    try:
+        nrows = 0
+        if scans:
+            for j in range(len(ctr.scan)):
+                scanname = "%s_S%03d" % (setname,j)
+                nrows = nrows + _archive_scan(h,ctr.scan[j],scanname)
+        nrows = nrows + _archive_ctr(h,ctr,setname)
+    except ValueError, msg:
+        _cleanup()
+        print "Unable to archive ctrdata: %s" % msg
+        return
+    except:
+        _cleanup()
+        print "Unable to archive ctrdata"
+        return
+    h.close()
+    return nrows
+
+def _archive_ctr(h,ctr,setname):
+    """
+    write the ctr point data
+    """
+    grp  = _group(h,'/','ctr_archive',"Ctr Data Archive")
+    grp  = _group(h,grp,setname,"Ctr Data")
+    skip = _skipped_columns(h,grp,ctr,len(ctr.L))
+    data = ctr.get_data()
+    nrows = 0
+    for name in ctr_data.CTR_COLUMNS + ['scan_index']:
+        if name in skip: continue
+        nrows = nrows + _update_column(h,grp,name,data[name])
+    params = {'I_lbl':ctr.labels['I'],'Inorm_lbl':ctr.labels['Inorm'],
+              'Ierr_lbl':ctr.labels['Ierr'],'Ibgr_lbl':ctr.labels['Ibgr'],
+              'corr_params':ctr.corr_params,'scan_type':ctr.scan_type}
+    for (name,pcol) in params.items():
+        nrows = nrows + _update_param(h,grp,name,pcol)
+    nrows = nrows + _update_column(h,grp,'bad',num.array(ctr.bad,dtype=int))
+    grp._v_attrs.npts    = len(ctr.L)
+    grp._v_attrs.nscan   = len(ctr.scan)
+    grp._v_attrs.version = ARCHIVE_VERSION
+    return nrows
+
+def load_ctrdata(fname,setname='ctr',path=None,columns=None,scans=True):
+    """
+    Read a ctr data set from the chunked archive
+
+    Parameters:
+    -----------
+    * fname is the file name (path is an optional directory)
+    * setname is the name of the data set
+    * columns is a list of the point data columns to read (default
+      is all of ctr_data.CTR_COLUMNS, H, K and L are always read).
+      The other columns are zero filled (see read_ctr_column) and
+      are not written back by archive_ctrdata
+    * scans is a flag to read the scans, images are read from the
+      file when accessed (see ArchiveImages)
+
+    Returns:
+    --------
+    * CtrData instance
+    """
+    h = get_file(fname,path)
+    if h == None: return
+    try:
+        grp = h.getNode('/ctr_archive',setname)
+        ctr = _load_ctr(h,grp,columns=columns)
+        if scans:
+            for j in range(grp._v_attrs.nscan):
+                scanname = "%s_S%03d" % (setname,j)
+                sgrp = h.getNode('/scan_archive',scanname)
+                ctr.scan.append(_load_scan(h,sgrp))
+    except:
+        _cleanup()
+        print "Unable to read ctrdata %s" % setname
+        return
+    h.close()
+    return ctr
+
+def _load_ctr(h,grp,columns=None):
+    """
+    read the ctr point data
+    """
+    if columns == None: columns = ctr_data.CTR_COLUMNS
+    npts = grp._v_attrs.npts
+    ctr  = ctr_data.CtrData()
+    skipped = []
+    for name in ctr_data.CTR_COLUMNS:
+        if name in columns or name in ('H','K','L'):
+            setattr(ctr,name,h.getNode(grp,name).read())
+        else:
+            setattr(ctr,name,num.zeros(npts,dtype=float))
+            skipped.append(name)
+    ctr.scan_index = h.getNode(grp,'scan_index').read()
+    ctr.labels = {}
+    for key in ('I','Inorm','Ierr','Ibgr'):
+        ctr.labels[key] = _read_param(h.getNode(grp,key+'_lbl'))
+    ctr.corr_params = _read_param(h.getNode(grp,'corr_params'))
+    ctr.scan_type   = _read_param(h.getNode(grp,'scan_type'))
+    ctr.bad = [int(j) for j in h.getNode(grp,'bad').read()]
+    ctr._init_store()
+    ctr.hklist = ctr_data.find_HKs(ctr)
+    _set_source(h,grp,ctr,skipped)
+    return ctr
+
+def read_ctr_column(fname,name,setname='ctr',path=None,rows=None):
+    """
+    Read one point data column (e.g. 'F' or 'corr_params') of an
+    archived ctr data set.  rows is None (all points), a slice or
+    an array of point indicies.  Parameter columns are returned as
+    ParamColumns
+    """
+    h = get_file(fname,path)
+    if h == None: return
+    try:
+        node = h.getNode('/ctr_archive/'+setname,name)
+        if hasattr(node.attrs,'table'):
+            data = _read_param(node,rows)
+        else:
+            data = _read_node(node,rows)
+    except:
+        _cleanup()
+        print "Unable to read column %s of %s" % (name,setname)
+        return
+    h.close()
+    return data
+
+################################################################################
+def archive_scandata(fname,data,setname=None,path=None):
+    """
+    Write scan data (and its images) to the chunked archive
+    (root/scan_archive).  As for archive_ctrdata only the changed
+    rows of an existing set are rewritten.  Returns the number of
+    rows written
+    """
+    h = get_file(fname,path)
+    if h == None: return
+    try:
+        if setname == None:
+            grp = _group(h,'/','scan_archive',"Scan Data Archive")
+            setname = calc_next_setname(grp._v_children.keys())
+        nrows = _archive_scan(h,data,setname)
+    except ValueError, msg:
+        _cleanup()
+        print "Unable to archive scandata: %s" % msg
+        return
+    except:
+        _cleanup()
+        print "Unable to archive scandata"
+        return
+    h.close()
+    return nrows
+
+def _archive_scan(h,data,setname):
+    """
+    write a scan, numeric arrays are stored as columns
+    and other values as attributes
+    """
+    if not isinstance(data,scan_data.ScanData):
+        print "Warning data is not a ScanData instance"
+    grp = _group(h,'/','scan_archive',"Scan Data Archive")
+    grp = _group(h,grp,setname,"Scan Data")
+    if len(data.dims) > 0: npts = data.dims[0]
+    else: npts = 0
+    skip   = _skipped_columns(h,grp,data,npts)
+    nrows  = 0
+    values = {}
+    for gname in ('scalers','positioners','errors'):
+        sub = _group(h,grp,gname)
+        values[gname] = {}
+        names = [name.split('/')[1] for name in skip
+                 if name.split('/')[0] == gname]
+        for (label,val) in getattr(data,gname,{}).items():
+            if _is_column(val):
+                nrows = nrows + _update_column(h,sub,label,val)
+                names.append(label)
+            else:
+                values[gname][label] = val
+        _remove_stale(h,sub,names)
+    attrs = grp._v_attrs
+    attrs.scan_name    = data.name
+    attrs.dims         = data.dims
+    attrs.primary_axis = data.primary_axis
+    attrs.primary_det  = data.primary_det
+    attrs.state        = data.state
+    attrs.bad_points   = getattr(data,'bad_points',[])
+    attrs.values       = values
+    attrs.version      = ARCHIVE_VERSION
+    if hasattr(data,'image'):
+        nrows = nrows + _archive_image(h,_group(h,grp,'image'),data.image)
+    return nrows
+
+def _archive_image(h,grp,imdata):
+    """
+    write image data, one row per image
+    """
+    nrows = 0
+    where = grp._v_pathname + '/images'
+    npts  = len(imdata.image)
+    if isinstance(imdata.image,ArchiveImages) and \
+       os.path.abspath(imdata.image.fname) == os.path.abspath(h.filename) and \
+       imdata.image.where == where:
+        # images read from this set are not modified
+        pass
+    elif npts > 0:
+        images = num.array([imdata.image[j] for j in range(npts)])
+        nrows = nrows + _update_column(h,grp,'images',images)
+    if npts > 0:
+        nrows = nrows + _update_column(h,grp,'rois',num.array(imdata.rois))
+        nrows = nrows + _update_column(h,grp,'rotangle',num.array(imdata.rotangle))
+        nrows = nrows + _update_column(h,grp,'im_max',num.array(imdata.im_max))
+        for (key,val) in imdata.peaks.items():
+            nrows = nrows + _update_column(h,grp,'peaks_'+key,num.asarray(val))
+    # drop the peaks columns that are not in the current peak set
+    for name in grp._v_children.keys():
+        if name.startswith('peaks_') and \
+           not imdata.peaks.has_key(name[len('peaks_'):]):
+            h.removeNode(grp,name)
+    grp._v_attrs.nimages    = npts
+    grp._v_attrs.bgrpar     = imdata.bgrpar
+    grp._v_attrs.integrated = imdata._is_integrated
+    return nrows
+
+def load_scandata(fname,setname,path=None,columns=None):
+    """
+    Read a scan from the chunked archive
+
+    Parameters:
+    -----------
+    * fname is the file name (path is an optional directory)
+    * setname is the name of the data set
+    * columns is a list of the scaler/positioner labels to read
+      (default is all, see read_scan_column).  The other columns
+      are left as stored when the scan is archived to the same set
+
+    Returns:
+    --------
+    * ScanData instance, images are read from the file
+      when accessed (see ArchiveImages)
+    """
+    h = get_file(fname,path)
+    if h == None: return
+    try:
+        data = _load_scan(h,h.getNode('/scan_archive',setname),columns=columns)
+    except:
+        _cleanup()
+        print "Unable to read scandata %s" % setname
+        return
+    h.close()
+    return data
+
+def _load_scan(h,grp,columns=None):
+    """
+    read a scan
+    """
+    attrs  = grp._v_attrs
+    values = attrs.values
+    cols   = {}
+    skipped = []
+    for gname in ('scalers','positioners','errors'):
+        cols[gname] = dict(values.get(gname,{}))
+        sub = h.getNode(grp,gname)
+        for (label,node) in sub._v_children.items():
+            if columns == None or label in columns:
+                cols[gname][label] = node.read()
+            else:
+                skipped.append(gname + '/' + label)
+    data = scan_data.ScanData(name=attrs.scan_name,dims=attrs.dims,
+                              scalers=cols['scalers'],
+                              positioners=cols['positioners'],
+                              primary_axis=attrs.primary_axis,
+                              primary_det=attrs.primary_det,
+                              state=attrs.state)
+    data.bad_points = attrs.bad_points
+    data.errors     = cols['errors']
+    if hasattr(grp,'image'):
+        data.image = _load_image(h,grp.image)
+    _set_source(h,grp,data,skipped)
+    return data
+
+def _load_image(h,grp):
+    """
+    read image data, the images are read when accessed
+    """
+    npts   = grp._v_attrs.nimages
+    imdata = image_data.ImageScan()
+    if npts > 0:
+        imdata.image    = ArchiveImages(os.path.abspath(h.filename),
+                                        grp._v_pathname + '/images',npts)
+        imdata.rois     = h.getNode(grp,'rois').read().tolist()
+        imdata.rotangle = h.getNode(grp,'rotangle').read().tolist()
+        imdata.im_max   = h.getNode(grp,'im_max').read().tolist()
+        imdata.peaks    = {}
+        for (name,node) in grp._v_children.items():
+            if name.startswith('peaks_'):
+                imdata.peaks[name[6:]] = node.read()
+    imdata.bgrpar = grp._v_attrs.bgrpar
+    imdata._is_integrated = grp._v_attrs.integrated
+    return imdata
+
+def read_scan_column(fname,setname,label,path=None,rows=None):
+    """
+    Read one scaler or positioner column of an archived scan.
+    rows is None (all points), a slice or an array of point
+    indicies
+    """
+    h = get_file(fname,path)
+    if h == None: return
+    try:
+        grp  = h.getNode('/scan_archive',setname)
+        node = None
+        for gname in ('scalers','positioners'):
+            node = _child(h,grp._v_pathname+'/'+gname,label)
+            if node is not None: break
+        if node is None:
+            print "Label %s not found in %s" % (label,setname)
+            data = None
+        else:
+            data = _read_node(node,rows)
+    except:
+        _cleanup()
+        print "Unable to read column %s of %s" % (label,setname)
+        return
+    h.close()
+    return data
+
 ################################################################################
 ################################################################################
 if __name__ == '__main__':
@@ -76,6 +76,7 @@ class ScanData:
         self.positioners  = positioners
         self.state        = state
         self.bad_points   = []
+        self.errors       = {}
         #
         if med != None:
             if isinstance(med,med_data.MedScan):
@@ -222,57 +223,57 @@ def append(data1,data2,sort=True):
     
     This works for one dimensional data
 
-    Note check how this works.  only append arrays of full length
-    others combine into 2d arrays.  is this ok???  what if combine three
-    or more... 
-    
+    Scalers, positioners and peaks with one value per point are
+    appended (and sorted on the primary axis), others are combined
+    into 2d arrays.  The per point spectra and images of the two
+    scans are appended in the same order
     """
     # Check data
-    if (len(data1.dims) != 1) or (len(data1.primary_axis) > 1):
-        print "Only 1-d data sets may be combined"
-        return
-    if len(data2.dims) != 1 or (len(data2.primary_axis) > 1):
-        print "Only 1-d data sets may be combined"
-        return
+    for d in (data1,data2):
+        if (len(d.dims) != 1) or (len(d.primary_axis) > 1):
+            print "Only 1-d data sets may be combined"
+            return
     if data2.primary_axis != data1.primary_axis:
         print "Warning primary axis doesnt match "
     if data2.primary_det != data1.primary_det:
         print "Warning primary detector doesnt match "
-    if hasattr(data1,'xrf'):
-        if data1.xrf.lines != data2.xrf.lines:
-            print "Warning xrf lines dont match"
-    if hasattr(data1,'image'):
-        if data1.image_rois != data2.image_rois:
-            print "Warning image rois dont match"
+    _check_spectra([data1,data2])
 
     # init
-    data3 = ScanData()
+    data3 = ScanData(scalers={},positioners={},state={})
     data3.name         = "%s, %s" % (data1.name, data2.name)
     data3.dims         = [data1.dims[0]+data2.dims[0]]
     npts               = data3.dims[0]
     data3.primary_axis = copy.copy(data1.primary_axis)
     data3.primary_det  = copy.copy(data1.primary_det)
 
-    # append scalers, all will be numarrays
-    for key in data1.scalers.keys():
-        s1 = num.array(data1.scalers[key])
-        s2 = num.array(data2.scalers[key])
-        #tmp = num.concatenate( (s1,s2) )
-        tmp = num.append( s1,s2 )
-        if len(tmp) == npts:
-            data3.scalers.update({key:tmp})
-        else:
-            data3.scalers.update({key:num.array([s1,s2])})
-
-    # append positioners, all will be numarrays
-    for key in data1.positioners.keys():
-        s1 = num.array(data1.positioners[key])
-        s2 = num.array(data2.positioners[key])
-        tmp = num.append(s1,s2)
-        if len(tmp) == npts:
-            data3.positioners.update({key:tmp})
-        else:
-            data3.positioners.update({key:num.array([s1,s2])})
+    # append all per point columns at once, 
+    # others are combined into 2d arrays
+    cols1 = _columns(data1)
+    cols2 = _columns(data2)
+    keys  = [k for k in cols1.keys() if k in cols2 and
+             len(cols1[k]) + len(cols2[k]) == npts]
+    idx   = None
+    if len(keys) > 0:
+        tmp = num.concatenate((_stack(cols1,keys),_stack(cols2,keys)))
+        if sort and len(data3.primary_axis) == 1 and \
+           ('positioners',data3.primary_axis[0]) in keys:
+            pidx = keys.index(('positioners',data3.primary_axis[0]))
+            idx  = tmp[:,pidx].argsort()
+            tmp  = tmp[idx]
+
+    # append meds, xrfs, images in the same order
+    for attr in ('med','xrf','image'):
+        if hasattr(data1,attr) and hasattr(data2,attr):
+            setattr(data3,attr,_combine_points([getattr(data1,attr),
+                                                getattr(data2,attr)],
+                                               attr,idx))
+
+    if len(keys) > 0:
+        _unstack(data3,keys,tmp)
+    for key in cols1.keys():
+        if key in keys or key not in cols2: continue
+        _set_column(data3,key,num.array([cols1[key],cols2[key]]))
 
     # combine state info,
     # these are not appened!  
@@ -281,30 +282,6 @@ def append(data1,data2,sort=True):
         s2 = num.array(data2.state[key])
         tmp = num.array([s1,s2])
         data3.state.update({key:tmp})
-
-    # append meds, xrfs...
-    data3.med = num.append(data1.med, data2.med)
-    data3.xrf = num.append(data1.xrf, data2.xrf)
-    data3.xrf_lines = data1.xrf_lines
-    for key in data1.xrf_peaks.keys():
-        s1 = num.array(data1.xrf_peaks[key])
-        s2 = num.array(data2.xrf_peaks[key])
-        tmp = num.append(s1,s2)
-        data3.xrf_peaks.update({key:tmp})
-    
-    # append images...
-    data3.image = data1.image
-    for i in range(data2.dims[0]):
-        data3.image.append(data2.image[i])
-
-    data3.image_rois = data1.image_rois
-    for key in data1.image_peaks.keys():
-        s1 = num.array(data1.image_peaks[key])
-        s2 = num.array(data2.image_peaks[key])
-        tmp = num.append(s1,s2)
-        data3.image_peaks.update({key:tmp})
-
-    if sort: _sort_data(data3)
         
     return data3
 
@@ -315,44 +292,133 @@ def _sort_data(data):
     paxis = data.primary_axis
     if len(paxis) != 1: return
     
-    a    = data.positioners[paxis[0]]
-    npts = len(data.positioners[paxis[0]])
+    a    = num.asarray(data.positioners[paxis[0]])
+    npts = len(a)
     idx  = a.argsort()
 
-    for key in data.scalers.keys():
-        if len(data.scalers[key]) == npts:
-            data.scalers[key] = data.scalers[key][idx]
-    
-    for key in data.positioners.keys():
-        if len(data.positioners[key]) == npts:
-            data.positioners[key] = data.positioners[key][idx]
-
-    if len(data.med) == npts:
-        data.med = data.med[idx]
-
-    if len(data.xrf) == npts:
-        data.xrf = data.xrf[idx]
+    cols = _columns(data)
+    keys = [k for k in cols.keys() if len(cols[k]) == npts]
+    for attr in ('med','xrf','image'):
+        if hasattr(data,attr):
+            obj = _combine_points([getattr(data,attr)],attr,idx)
+            if hasattr(obj,'peaks'):
+                obj.peaks = dict(getattr(data,attr).peaks)
+            setattr(data,attr,obj)
+    if len(keys) > 0:
+        _unstack(data,keys,_stack(cols,keys)[idx])
+    return            
 
-    for key in data.xrf_peaks.keys():
-        if len(data.xrf_peaks[key]) == npts:
-            data.xrf_peaks[key] = data.xrf_peaks[key][idx]
+# per point lists of the MedScan, XrfScan and ImageScan objects
+_POINT_ATTRS = {'med':('med',),
+                'xrf':('xrf',),
+                'image':('image','rois','rotangle','bgrpar','im_max')}
 
-    if len(data.image) == npts:
-        data.image = data.image[idx]
+def _combine_points(objs,attr,idx=None):
+    """
+    Copy of objs[0] (a MedScan, XrfScan or ImageScan, attr is
+    'med', 'xrf' or 'image') holding the per point lists of all
+    objs, reordered by idx if given.  The peaks are reset, they
+    are set from the combined columns (see _set_column)
+    """
+    obj = copy.copy(objs[0])
+    for name in _POINT_ATTRS[attr]:
+        if not hasattr(obj,name): continue
+        vals = []
+        for o in objs:
+            v = getattr(o,name,[])
+            vals.extend([v[j] for j in range(len(v))])
+        if idx is not None and len(vals) == len(idx):
+            vals = [vals[j] for j in idx]
+        setattr(obj,name,vals)
+    if hasattr(obj,'peaks'): obj.peaks = {}
+    return obj
+
+def _check_spectra(data):
+    """
+    warn if the xrf lines or image rois of scans differ
+    """
+    for d in data[1:]:
+        if hasattr(d,'xrf') and hasattr(data[0],'xrf'):
+            if d.xrf.lines != data[0].xrf.lines:
+                print "Warning xrf lines dont match"
+        if hasattr(d,'image') and hasattr(data[0],'image'):
+            if d.image.rois != data[0].image.rois:
+                print "Warning image rois dont match"
+
+def _columns(data):
+    """
+    Dictionary of the scalers, positioners and xrf/image peaks
+    of a scan keyed by (group,label)
+    """
+    groups = [('scalers',data.scalers),('positioners',data.positioners)]
+    if hasattr(data,'xrf') and hasattr(data.xrf,'peaks'):
+        groups.append(('xrf_peaks',data.xrf.peaks))
+    if hasattr(data,'image') and hasattr(data.image,'peaks'):
+        groups.append(('image_peaks',data.image.peaks))
+    cols = {}
+    for (group,d) in groups:
+        for key in d.keys():
+            cols[(group,key)] = num.atleast_1d(num.array(d[key]))
+    return cols
+
+def _stack(cols,keys):
+    """
+    2d array (npts,ncol) of the columns keys
+    """
+    return num.array([cols[k] for k in keys],dtype=float).transpose()
 
-    for key in data.image_peaks.keys():
-        if len(data.image_peaks[key]) == npts:
-            data.image_peaks[key] = data.image_peaks[key][idx]
+def _unstack(data,keys,arr):
+    """
+    set the columns keys of data from the 2d array arr
+    """
+    for j in range(len(keys)):
+        _set_column(data,keys[j],arr[:,j].copy())
 
-    return            
+def _set_column(data,key,val):
+    """
+    set a column, peaks are stored in the data.xrf.peaks
+    and data.image.peaks dictionaries
+    """
+    (group,label) = key
+    if group in ('xrf_peaks','image_peaks'):
+        obj = getattr(data,group[:-6],None)
+        if hasattr(obj,'peaks'):
+            obj.peaks[label] = val
+            return
+    if not hasattr(data,group): setattr(data,group,{})
+    getattr(data,group)[label] = val
 
 ########################################################################
-def merge(data=[],average=True,align=False,fast=True):
+def merge(data=[],average=True,align=False,fast=True,weights=None,
+          errors=False):
     """
     Merge a list of ScanData instances
 
     This works for one dimensional data
-    
+
+    Parameters:
+    -----------
+    * data is a list of ScanData instances
+    * average is a flag to average (rather than sum) the scalers
+      and peaks.  Positioners are always averaged
+    * align is a flag to interpolate the data of each scan onto
+      the primary axis values of the first scan (cubic spline,
+      see Resampler)
+    * fast is a flag for the fast spline for uniform grids
+    * weights is an optional list of weights of each scan.  The
+      result is sum(w*y), or sum(w*y)/sum(w) if averaged
+    * errors is a flag to propagate errors.  The errors of each
+      scan are taken from data[j].errors or are sqrt(|counts|).
+      The errors of the merged scalers/peaks are in data_m.errors
+
+    Notes:
+    ------
+    All scalers, positioners and peaks with one value per point are
+    stacked into one 2d array per scan, the spline resampling
+    operator of each scan is set up once and applied to all the
+    columns (see merge_columns).  The merged peaks are in
+    data_m.xrf.peaks and data_m.image.peaks, the spectra and images
+    are those of the first scan (they are not summed)
     """
     ndat = len(data)
     if ndat < 2: return None
@@ -368,17 +434,14 @@ def merge(data=[],average=True,align=False,fast=True):
             print "Warning primary axis doesnt match "
         if d.primary_det != data[0].primary_det:
             print "Warning primary detector doesnt match "
-        if d.xrf_lines != data[0].xrf_lines:
-            print "Warning xrf lines dont match"
-        if d.image_rois != data[0].image_rois:
-            print "Warning image rois dont match"
         if len(name) == 0:
             name = "%s" % d.name
         else:
             name = "%s, %s" % (name, d.name)
+    _check_spectra(data)
         
     # init
-    data_m      = ScanData()
+    data_m      = ScanData(scalers={},positioners={},state={})
     data_m.name = name
     data_m.dims = data[0].dims
     npts        = data[0].dims[0]
@@ -387,48 +450,65 @@ def merge(data=[],average=True,align=False,fast=True):
 
     # the primary axis of data[0] sets the primary
     # axis of data_m when align is true
+    xs = None
     if align:
-        newx = data[0][paxis]
-    else:
-        newx = None
-
-    # sum/average scalers
-    for key in data[0].scalers.keys():
-        tmp = []
+        xs = [num.array(d.positioners[paxis[0]],dtype=float) for d in data]
+
+    # keep meds, xrfs, images of the first scan, these are
+    # not summed.  The merged peaks are set in data_m.xrf.peaks
+    # and data_m.image.peaks
+    for attr in ('med','xrf','image'):
+        if hasattr(data[0],attr):
+            setattr(data_m,attr,_combine_points([getattr(data[0],attr)],attr))
+
+    # the columns with one value per point are merged,
+    # the others are kept as a list
+    cols = [_columns(d) for d in data]
+    keys = []
+    for key in cols[0].keys():
+        if len(cols[0][key]) != npts: 
+            _set_column(data_m,key,[c.get(key) for c in cols])
+            continue
+        for j in range(1,ndat):
+            c = cols[j]
+            if (key not in c) or (not align and len(c[key]) != npts):
+                print "Cannot merge %s '%s' of scan %s" % (key[0],key[1],
+                                                           data[j].name)
+                return
+        keys.append(key)
+    keys.sort()
+
+    # the merge
+    variances = None
+    if errors:
+        variances = []
         for j in range(ndat):
-            if j == 0:
-                tmp.append(num.array(data[j].scalers[key]))
-            else:
-                s = num.array(data[j].scalers[key])
-                if align and (len(s) == npts):
-                    oldx = data[j][paxis]
-                    s = _spline_interpolate(oldx,s,newx,fast=fast)
-                tmp.append(s)
-        if len(tmp[0]) == npts:
-            tmp = num.sum(tmp,0)
-            if average:
-                tmp = tmp / (1.0*ndat)
-        data_m.scalers.update({key:tmp})
-
-
-    # average positioners
-    for key in data[0].positioners.keys():
-        tmp = []
-        for j in range(ndat):
-            if j == 0:
-                tmp.append(num.array(data[j].positioners[key]))
-            else:
-                s = num.array(data[j].positioner[key])
-                if align and (len(s) == npts):
-                    # does this work for positioners?
-                    oldx = data[j][paxis]
-                    s = _spline_interpolate(oldx,s,newx,fast=fast)
-                tmp.append(s)
-        if len(tmp[0]) == npts:
-            tmp = num.sum(tmp,0)
-            # always average
-            tmp = tmp / (1.0*ndat)
-        data_m.scalers.update({key:tmp})
+            err = getattr(data[j],'errors',{})
+            var = []
+            for key in keys:
+                if key[0] == 'positioners':
+                    var.append(num.zeros(len(cols[j][key])))
+                elif err.has_key(key[1]):
+                    var.append(num.array(err[key[1]],dtype=float)**2)
+                else:
+                    var.append(num.abs(cols[j][key]))
+            variances.append(num.array(var).transpose())
+    (ysum,vsum,wsum) = merge_columns([_stack(c,keys) for c in cols],xs=xs,
+                                     weights=weights,variances=variances,
+                                     fast=fast)
+    for j in range(len(keys)):
+        # positioners are always averaged
+        if average or keys[j][0] == 'positioners':
+            y = ysum[:,j] / wsum
+            v = vsum[:,j] / wsum**2
+        else:
+            y = ysum[:,j]
+            v = vsum[:,j]
+        _set_column(data_m,keys[j],y)
+        if errors and keys[j][0] != 'positioners':
+            data_m.errors[keys[j][1]] = num.sqrt(v)
+    if align:
+        data_m.positioners[paxis[0]] = xs[0].copy()
 
     # combine state info,
     # these are not summed/averaged!  
@@ -437,54 +517,136 @@ def merge(data=[],average=True,align=False,fast=True):
         for j in range(ndat):
             tmp.append(data[j].state[key])
         data_m.state.update({key:tmp})
+        
+    return data_m
 
-    # append meds, xrfs, images...
-    data_m.xrf_lines = data[0].xrf_lines
-    data_m.image_rois = data[0].image_rois
+def merge_columns(ys,xs=None,weights=None,variances=None,fast=True):
+    """
+    Weighted sum of the column stacks of several scans
 
-    # should we try to sum the spectra (and images)?
+    Parameters:
+    -----------
+    * ys is a list of (npts_j,ncol) arrays, one per scan
+    * xs is an optional list of the abscissa of each scan.  If given
+      the data of each scan are interpolated onto xs[0] (one
+      Resampler per scan, applied to all the columns)
+    * weights is an optional list of scan weights (default 1)
+    * variances is an optional list of (npts_j,ncol) arrays of
+      the variances of ys, these are interpolated like the data
+    * fast is the Resampler fast flag
+
+    Returns:
+    --------
+    * (ysum,vsum,wsum) where ysum = sum(w*y), vsum = sum(w**2 * var)
+      (zeros if no variances) and wsum = sum(w)
+    """
+    ndat = len(ys)
+    ysum = None
+    vsum = 0.0
+    wsum = 0.0
     for j in range(ndat):
-        data_m.med.append(data[j].med)
-        data_m.xrf.append(data[j].xrf)
-        data_m.image.append(data[j].image)
-        
+        y = num.asarray(ys[j],dtype=float)
+        v = None
+        if variances != None:
+            v = num.asarray(variances[j],dtype=float)
+        if xs != None and j > 0:
+            op = Resampler(xs[j],xs[0],fast=fast)
+            y  = op(y)
+            if v is not None:
+                v = num.maximum(op(v),0.0)
+        if weights == None:
+            w = 1.0
+        else:
+            w = float(weights[j])
+            y = w*y
+        if ysum is None:
+            ysum = y
+        else:
+            ysum = ysum + y
+        if v is not None:
+            vsum = vsum + (w**2)*v
+        wsum = wsum + w
+    if variances == None:
+        vsum = num.zeros(ysum.shape)
+    return (ysum,vsum,wsum)
+
+class Resampler:
+    """
+    Cubic spline interpolation from the grid oldx to newx,
+    applied to all the columns of an (npts,ncol) array
 
-    # treat peaks etc same as scalers....
-    for key in data[0].xrf_peaks.keys():
-        tmp = []
-        for j in range(ndat):
-            if j == 0:
-                tmp.append(num.array(data[j].xrf_peaks[key]))
-            else:
-                s = num.array(data[j].xrf_peaks[key])
-                if align and (len(s) == npts):
-                    oldx = data[j][paxis]
-                    s = _spline_interpolate(oldx,s,newx,fast=fast)
-                tmp.append(s)
-        if len(tmp[0]) == npts:
-            tmp = num.sum(tmp,0)
-            if average:
-                tmp = tmp / (1.0*ndat)
-        data_m.xrf_peaks.update({key:tmp})
-
-    for key in data[0].image_peaks.keys():
-        tmp = []
-        for j in range(ndat):
-            if j == 0:
-                tmp.append(num.array(data[j].image_peaks[key]))
-            else:
-                s = num.array(data[j].image_peaks[key])
-                if align and (len(s) == npts):
-                    oldx = data[j][paxis]
-                    s = _spline_interpolate(oldx,s,newx,fast=fast)
-                tmp.append(s)
-        if len(tmp[0]) == npts:
-            tmp = num.sum(tmp,0)
-            if average:
-                tmp = tmp / (1.0*ndat)
-        data_m.image_peaks.update({key:tmp})
-        
-    return data_m
+    newy = Resampler(oldx,newx,fast=fast)(oldy)
+
+    if fast = True
+       this is the mirror symmetric cubic spline of
+       scipy.signal.cspline1d / cspline1d_eval for a uniform
+       grid oldx.  The spline weights at newx are computed once,
+       and the coefficients of all the columns are computed
+       together, the results match those of _spline_interpolate
+    else
+       this is the (not-a-knot) cubic spline interpolating oldx,
+       ie the splrep spline of _spline_interpolate without the
+       (small) smoothing
+    """
+    def __init__(self,oldx,newx,fast=True):
+        self.fast = fast
+        self.oldx = num.asarray(oldx,dtype=float)
+        self.newx = num.asarray(newx,dtype=float)
+        if fast: self._init_weights()
+
+    def _init_weights(self):
+        """
+        cspline1d_eval weights and coefficient indices at newx
+        """
+        from scipy.signal import cubic
+        N  = len(self.oldx)
+        x  = (self.newx - self.oldx[0]) / float(self.oldx[1]-self.oldx[0])
+        # mirror symmetry
+        while True:
+            lo = x < 0
+            hi = x > (N - 1)
+            if not (num.any(lo) or num.any(hi)): break
+            x[lo] = -x[lo]
+            x[hi] = 2 * (N - 1) - x[hi]
+        jlower = num.floor(x - 2).astype(int) + 1
+        self.indj = []
+        self.w    = []
+        for i in range(4):
+            thisj = jlower + i
+            self.indj.append(thisj.clip(0, N - 1))
+            self.w.append(cubic(x - thisj)[:,num.newaxis])
+
+    def __call__(self,y):
+        y = num.asarray(y,dtype=float)
+        if y.ndim == 1:
+            return self(y[:,num.newaxis])[:,0]
+        if not self.fast:
+            from scipy.interpolate import CubicSpline
+            return CubicSpline(self.oldx,y,axis=0)(self.newx)
+        cj = _cubic_coeff(y)
+        result = num.zeros((len(self.newx),y.shape[1]))
+        for i in range(4):
+            result += cj[self.indj[i]] * self.w[i]
+        return result
+
+def _cubic_coeff(y):
+    """
+    Mirror symmetric cubic spline coefficients of the columns
+    of y (as scipy.signal.cspline1d)
+    """
+    zi = -2 + num.sqrt(3)
+    K  = len(y)
+    yt = y.transpose().copy()
+    yplus = num.zeros(yt.shape)
+    powers = zi ** num.arange(K)
+    yplus[:,0] = yt[:,0] + zi * num.add.reduce(powers * yt, axis=1)
+    for k in range(1, K):
+        yplus[:,k] = yt[:,k] + zi * yplus[:,k - 1]
+    output = num.zeros(yt.shape)
+    output[:,K - 1] = zi / (zi - 1) * yplus[:,K - 1]
+    for k in range(K - 2, -1, -1):
+        output[:,k] = zi * (output[:,k + 1] - yplus[:,k])
+    return (output * 6.0).transpose()
 
 ################################################################################
 def _spline_interpolate(oldx, oldy, newx, smoothing=0.001,fast=True, **kw):
@@ -632,8 +794,41 @@ def _display_deadtime_fit(xfit,yfit_arr,ycorr_arr,tau,a,off):
     pyplot.ylabel('y corrected ')
     pyplot.xlabel('x')
     
+########################################################################
+def test():
+    """
+    merge and append two scans with images and index the results
+    """
+    def _scan(name,x):
+        npts = len(x)
+        d = ScanData(name=name,dims=[npts],
+                     scalers={'I0':num.ones(npts)*1000.,'i1':x*10.},
+                     positioners={'E':x},primary_axis=['E'],
+                     primary_det=['i1'],state={'T':25.},
+                     image=[num.ones((4,5))*j for j in range(npts)])
+        d.image.peaks['I'] = num.arange(npts,dtype=float)
+        return d
+    d1 = _scan('s1',num.arange(5.))
+    d2 = _scan('s2',num.arange(5.)+0.5)
+    # merged data
+    m = merge([d1,d2])
+    assert num.allclose(m['I0'],1000.)
+    assert num.allclose(m['i1'],num.arange(5.)*10.+2.5)
+    assert num.allclose(m['I'],num.arange(5.))
+    assert len(m.image.image) == 5
+    assert m['image',2] is d1.image.image[2]
+    # appended data, sorted on E
+    a = append(d1,d2)
+    assert num.allclose(a['E'],num.arange(10)*0.5)
+    assert num.allclose(a['I0'],1000.)
+    assert num.allclose(a['I'],num.arange(10)//2)
+    assert len(a.image.image) == 10 and len(a.image.rois) == 10
+    assert a['image',1] is d2.image.image[0]
+    assert a['image',8] is d1.image.image[4]
+    print "merge/append ok"
+
 ########################################################################
 ########################################################################
 if __name__ == '__main__':
-    pass
+    test()
 
@@ -34,15 +34,19 @@ from   matplotlib import pyplot
 import time
 
 from tdl.modules.utils import plotter
+from tdl.modules.utils.columns import PointStore, RodIndex
 from tdl.modules.utils.mathutil import cosd, sind, tand
 from tdl.modules.utils.mathutil import arccosd, arcsind, arctand
 
 #from tdl.modules.ana import image_data
 from tdl.modules.geom.active_area import active_area
+from tdl.modules.geom.active_area import active_area_array as _active_area_array
 from tdl.modules.geom import gonio_psic 
 
 DEBUG = False
 
+CTR_COLUMNS = ['H','K','L','I','Inorm','Ierr','Ibgr','ctot','F','Ferr']
+
 ##############################################################################
 def ctr_data(scans,ctr=None,I=None,Inorm=None,Ierr=None,Ibgr=None,
              corr_params=None,scan_type=None):
@@ -64,7 +68,7 @@ def ctr_data(scans,ctr=None,I=None,Inorm=None,Ierr=None,Ibgr=None,
                          corr_params=corr_params,scan_type=scan_type)
     
 ##############################################################################
-class CtrData:
+class CtrData(PointStore):
     """
     CTR data
 
@@ -72,12 +76,12 @@ class CtrData:
     -----------
     * bad is a list of index values of points flagged as 'bad'
     * scan is a list holding all the scan data ojects
-    * scan_index is a list (possibly of tuples) that give the
-      scan index corresponding to a data point. see the get_scan method
-    * labels is a dictionary of lists of the string labels
-      for 'I','Inorm','Ierr','Ibgr'
-    * corr_params = list of correction parameter dictionaries
-    * scan_type list of string flags for scan type
+    * scan_index is an (npts x 2) array that gives the (scan, point)
+      index corresponding to a data point. see the get_scan method
+    * labels is a dictionary of ParamColumns (list like) of the string
+      labels for 'I','Inorm','Ierr','Ibgr'
+    * corr_params = ParamColumn of correction parameter dictionaries
+    * scan_type ParamColumn of string flags for scan type
     * H     = array of H values
     * K     = array of K values
     * L     = array of L values
@@ -88,7 +92,15 @@ class CtrData:
     * ctot  = array of total correction factors
     * F     = array of structure factor magnitudes
     * Ferr  = array of structure factor error bars
+
+    The data arrays are views of a columnar store (see utils.columns)
+    that grows with amortized capacity, so modify them in place
+    (e.g. ctr.F[idx] = ...).  get_data returns the data of a set
+    of points (e.g. a rod).
     """
+    _columns   = CTR_COLUMNS
+    _rod_index = True
+
     ##########################################################################
     def __init__(self,scans=[],I='I',Inorm='io',Ierr='Ierr',
                  Ibgr='Ibgr',corr_params={},scan_type='image'):
@@ -149,22 +161,8 @@ class CtrData:
         self.hklist = None
         self.bad    = []
         self.scan   = []
-        self.scan_index  = []
         #
-        self.labels      = {'I':[],'Inorm':[],'Ierr':[],'Ibgr':[]}
-        self.corr_params = []
-        self.scan_type   = []
-        #
-        self.H     = num.array([],dtype=float)
-        self.K     = num.array([],dtype=float)
-        self.L     = num.array([],dtype=float)
-        self.I     = num.array([],dtype=float)
-        self.Inorm = num.array([],dtype=float)
-        self.Ierr  = num.array([],dtype=float)
-        self.Ibgr  = num.array([],dtype=float)
-        self.ctot  = num.array([],dtype=float)
-        self.F     = num.array([],dtype=float)
-        self.Ferr  = num.array([],dtype=float)
+        self._init_store()
         #
         self.append_scans(scans,I=I,Inorm=Inorm,Ierr=Ierr,Ibgr=Ibgr,
                           corr_params=corr_params,
@@ -190,6 +188,26 @@ class CtrData:
         except:
             self.cursor = None
 
+    ##########################################################################
+    def delete_points(self,idx):
+        """
+        Remove the data points in idx.  The following points are
+        renumbered (the scans are kept in self.scan)
+        """
+        self._sync_store()
+        idx = num.unique(num.asarray(idx,dtype=int))
+        if len(idx) == 0: return
+        self._store.delete(idx)
+        for lbl in self.labels.values():
+            lbl.delete(idx)
+        self.corr_params.delete(idx)
+        self.scan_type.delete(idx)
+        self.rods.delete(idx)
+        bad = num.array([j for j in self.bad if j not in idx],dtype=int)
+        self.bad = [int(j) for j in bad - num.searchsorted(idx,bad)]
+        self._set_views()
+        self.hklist = find_HKs(self)
+
     ##########################################################################
     def append_scans(self,scans,I=None,Inorm=None,Ierr=None,Ibgr=None,
                      corr_params=None,scan_type=None):
@@ -205,6 +223,9 @@ class CtrData:
 
         For any argument with None passed we use previous defined
         values - based on the last exisiting data point.  
+
+        If a scan cannot be parsed it and the following scans are
+        not added, the scans before it are kept.
         """
         if type(scans) != types.ListType:
             scans = [scans]
@@ -217,37 +238,27 @@ class CtrData:
         if corr_params == None: corr_params = self.corr_params[-1]
         if scan_type == None:   scan_type = self.scan_type[-1]
 
-        # get all the data parsed out of each scan and append
+        # get all the data parsed out of each scan
+        # (scans with the same G share a gonio instance)
+        gonio_cache = {}
+        self._sync_store()
+        new = []
         for scan in scans:
-            data = self._scan_data(scan,I,Inorm,Ierr,Ibgr,corr_params,scan_type)
-            if data == None: return
-
-            #self.scan.append([])
+            data = self._scan_data(scan,I,Inorm,Ierr,Ibgr,corr_params,scan_type,
+                                   gonio_cache=gonio_cache)
+            # stop at a bad scan, the scans parsed so far are
+            # still stored (and hklist updated) below
+            if data == None: break
             self.scan.append(scan)
-            #
-            self.scan_index.extend(data['scan_index'])
-            self.labels['I'].extend(data['I_lbl'])
-            self.labels['Inorm'].extend(data['Inorm_lbl'])
-            self.labels['Ierr'].extend(data['Ierr_lbl'])
-            self.labels['Ibgr'].extend(data['Ibgr_lbl'])
-            self.corr_params.extend(data['corr_params'])
-            self.scan_type.extend(data['scan_type'])
-            #
-            self.H     = num.append(self.H,data['H'])
-            self.K     = num.append(self.K,data['K'])
-            self.L     = num.append(self.L,data['L'])
-            self.I     = num.append(self.I,data['I'])
-            self.Inorm = num.append(self.Inorm,data['Inorm'])
-            self.Ierr  = num.append(self.Ierr,data['Ierr'])
-            self.Ibgr  = num.append(self.Ibgr,data['Ibgr'])
-            self.ctot  = num.append(self.ctot,data['ctot'])
-            self.F     = num.append(self.F,data['F'])
-            self.Ferr  = num.append(self.Ferr,data['Ferr'])
+            new.append(data)
+        # and append to the store in one step
+        self._extend_store(new)
         # make a list of stored hk's
         self.hklist = find_HKs(self)
         
     ##########################################################################
-    def _scan_data(self,scan,I,Inorm,Ierr,Ibgr,corr_params,scan_type):
+    def _scan_data(self,scan,I,Inorm,Ierr,Ibgr,corr_params,scan_type,
+                   gonio_cache=None):
         """
         Parse scan into data...
         """
@@ -276,17 +287,12 @@ class CtrData:
                 data['H'].append(scan['H'][j])
                 data['K'].append(scan['K'][j])
                 data['L'].append(scan['L'][j])
-                # get F
-                d = image_point_F(scan,j,I=I,Inorm=Inorm,
-                                  Ierr=Ierr,Ibgr=Ibgr,
-                                  corr_params=corr_params)
-                data['I'].append(d['I'])
-                data['Inorm'].append(d['Inorm'])
-                data['Ierr'].append(d['Ierr'])
-                data['Ibgr'].append(d['Ibgr'])
-                data['ctot'].append(d['ctot'])
-                data['F'].append(d['F'])
-                data['Ferr'].append(d['Ferr'])
+            # get F for all points of the scan
+            d = image_scan_F(scan,points=range(npts),I=I,Inorm=Inorm,
+                             Ierr=Ierr,Ibgr=Ibgr,corr_params=corr_params,
+                             gonio_cache=gonio_cache)
+            for key in ('I','Inorm','Ierr','Ibgr','ctot','F','Ferr'):
+                data[key] = d[key]
         return data
 
     ##########################################################################
@@ -368,6 +374,8 @@ class CtrData:
             self.labels['Inorm'][idx] = Inorm
             self.labels['Ierr'][idx]  = Ierr
             self.corr_params[idx]     = corr_params
+            self.rods.update(idx,scan['H'][point],scan['K'][point],
+                             scan['L'][point],oldH=self.H[idx],oldK=self.K[idx])
             self.H[idx]               = scan['H'][point]
             self.K[idx]               = scan['K'][point]
             self.L[idx]               = scan['L'][point]
@@ -388,6 +396,58 @@ class CtrData:
         if DEBUG: print "Integration time(s)=",time.time()-tm
         return 
 
+    ##########################################################################
+    def correct(self,idx=None,corr_params=None):
+        """
+        Re-compute the correction factors, F and Ferr of a set of
+        data points from the current (integrated) intensities.
+
+        Parameters:
+        -----------
+        * idx is a list of data point indicies (default is all)
+        * corr_params = CTR correction parameters.  If None the
+          existing parameters of each point are used, otherwise
+          the new parameters are stored for each point in idx
+
+        Notes:
+        ------
+        Points are grouped by scan and correction parameters, and
+        each group is corrected with a single call to image_scan_F,
+        e.g. use this after changing the slit settings of a rod.
+        """
+        if DEBUG: tm = time.time()
+        if idx == None: idx = range(len(self.L))
+        # group the image points by scan and corr_params
+        groups = {}
+        order  = []
+        for j in idx:
+            if self.scan_type[j] != 'image':
+                print "No other scan types implemented"
+                continue
+            if corr_params != None:
+                self.corr_params[j] = corr_params
+            (scan_idx,point) = self.scan_index[j]
+            key = (scan_idx,id(self.corr_params[j]),self.labels['I'][j],
+                   self.labels['Inorm'][j],self.labels['Ierr'][j],
+                   self.labels['Ibgr'][j])
+            if key not in groups:
+                groups[key] = ([],[])
+                order.append(key)
+            groups[key][0].append(j)
+            groups[key][1].append(point)
+        gonio_cache = {}
+        for key in order:
+            (jdx,points) = groups[key]
+            j = jdx[0]
+            d = image_scan_F(self.scan[key[0]],points=points,
+                             I=self.labels['I'][j],Inorm=self.labels['Inorm'][j],
+                             Ierr=self.labels['Ierr'][j],Ibgr=self.labels['Ibgr'][j],
+                             corr_params=self.corr_params[j],
+                             gonio_cache=gonio_cache)
+            for attr in ('I','Inorm','Ierr','Ibgr','ctot','F','Ferr'):
+                getattr(self,attr)[jdx] = d[attr]
+        if DEBUG: print "Correction time(s)=",time.time()-tm
+
     ##########################################################################
     def hk_plot(self,H,K,fig=None,cursor=True,verbose=True,spnt=None):
         """
@@ -662,17 +722,12 @@ class CtrData:
         subplot = self.cursor.subplot
         if subplot < 0:
             return None
-        hksets  = sort_data(self)
-        return self._get_idx(subplot,L,hksets)
+        return self._get_idx(subplot,L)
     
-    def _get_idx(self,subplot,L,hksets):
-        d   = hksets[subplot]
-        tmp = num.fabs(d['L']-L)
-        idx = num.where(tmp==min(tmp))
-        if len(idx) > 0:
-            idx = idx[0]
-        point_idx = d['point_idx'][idx]
-        return point_idx
+    def _get_idx(self,subplot,L):
+        rods = rod_index(self)
+        (H,K) = rods.keys()[subplot]
+        return rods.nearest(H,K,L)
 
     ##########################################################################
     def get_scan(self,idx=None):
@@ -773,20 +828,12 @@ class CtrData:
         subplot = self.cursor.subplot
         if subplot < 0:
             return None
-        hksets  = sort_data(self)
-        return self._get_idx_range(subplot,Lmin,Lmax,hksets)
+        return self._get_idx_range(subplot,Lmin,Lmax)
         
-    def _get_idx_range(self,subplot,Lmin,Lmax,hksets):
-        d    = hksets[subplot]
-        tmp  = d['L']
-        idx1 = num.where(tmp<Lmin)
-        idx2 = num.where(tmp>Lmax)
-        tmp  = num.fabs(tmp)
-        tmp[idx1] = 0.0
-        tmp[idx2] = 0.0
-        idx = num.where(tmp > 0 )
-        point_idx = d['point_idx'][idx]
-        return (point_idx)
+    def _get_idx_range(self,subplot,Lmin,Lmax):
+        rods = rod_index(self)
+        (H,K) = rods.keys()[subplot]
+        return rods.select(H,K,Lmin,Lmax)
     
     ##########################################################################
     def write_HKL(self,fname = 'ctr.lst'):
@@ -807,23 +854,32 @@ class CtrData:
                 f.write(line)
         f.close()
 
+##########################################################################
+def rod_index(ctr,hkdecimal=3):
+    """
+    Get the RodIndex of a ctr data object.
+
+    The index kept by a CtrData instance (ctr.rods) is returned
+    if it has the requested precision, otherwise (e.g. for other
+    data objects) an index is built from ctr.H, ctr.K and ctr.L
+    """
+    rods = getattr(ctr,'rods',None)
+    if isinstance(ctr,CtrData):
+        ctr._sync_store()
+        rods = ctr.rods
+    if rods != None and rods.hkdecimal == hkdecimal and rods.npts == len(ctr.L):
+        return rods
+    rods = RodIndex(hkdecimal=hkdecimal)
+    rods.add(ctr.H,ctr.K,ctr.L)
+    return rods
+
 ##########################################################################
 def find_HKs(ctr,hkdecimal=3):
     """
     find all the unique HK pairs in the data set
+    (sorted list of (H,K) tuples)
     """
-    hkvals = []
-    npts = len(ctr.L)
-    H = num.around(ctr.H,decimals=hkdecimal)
-    K = num.around(ctr.K,decimals=hkdecimal)
-    s = []
-    for j in range(npts):
-        s = (H[j],K[j]) 
-        if s not in hkvals:
-            hkvals.append(s)
-    # sort the hkvals
-    hkvals.sort()
-    return hkvals
+    return rod_index(ctr,hkdecimal=hkdecimal).keys()
 
 ##########################################################################
 def HK_idx(ctr,H,K,hkdecimal=3):
@@ -838,14 +894,8 @@ def HK_idx(ctr,H,K,hkdecimal=3):
     Lset = ctr.K[idx]
     Fset = ctr.F[idx]
     """
-    Hrnd = num.around(ctr.H,decimals=hkdecimal)
-    Krnd = num.around(ctr.K,decimals=hkdecimal)
-    idx1 = num.where(Hrnd==H)
-    if len(idx1) == 0:
-        return idx1
-    idx2 = num.where(Krnd[idx1]==K)
-    idx = (idx1[0][idx2],)
-    return idx
+    idx = rod_index(ctr,hkdecimal=hkdecimal).rod(H,K)
+    return (num.sort(idx),)
 
 ##########################################################################
 def sort_data(ctr,hkdecimal=3):
@@ -861,48 +911,21 @@ def sort_data(ctr,hkdecimal=3):
     * hkdecimal is the number of precision to round H and K
       values to for sorting.  
 
+    Returns a list (sorted by H,K) of dictionaries of the data of
+    each rod, sorted by L.  The point indicies of each rod are
+    taken from the rod index (see rod_index), so each rod costs
+    O(rod size).
     """
-    scan_idx = ctr.scan_index
-    npts = len(ctr.F)
-
-    #find all unique sets
-    hkvals = find_HKs(ctr,hkdecimal=hkdecimal)
-
-    # put data in correct set
-    nsets = len(hkvals)
+    rods = rod_index(ctr,hkdecimal=hkdecimal)
     hkset = []
-    for j in range(nsets):
-        hkset.append({'H':[],'K':[],'L':[],'F':[],'Ferr':[],
-                      'I':[],'Inorm':[],'Ierr':[],'Ibgr':[],
-                      'point_idx':[]})
-    for j in range(nsets):
-        s = hkvals[j]
-        idx = HK_idx(ctr,s[0],s[1],hkdecimal=hkdecimal)
-        hkset[j]['H']     = num.around(ctr.H[idx],decimals=hkdecimal)
-        hkset[j]['K']     = num.around(ctr.K[idx],decimals=hkdecimal)
-        hkset[j]['L']     = ctr.L[idx]
-        hkset[j]['F']     = ctr.F[idx]
-        hkset[j]['Ferr']  = ctr.Ferr[idx]
-        hkset[j]['I']     = ctr.I[idx]
-        hkset[j]['Inorm'] = ctr.Inorm[idx]
-        hkset[j]['Ierr']  = ctr.Ierr[idx]
-        hkset[j]['Ibgr']  = ctr.Ibgr[idx]
-        hkset[j]['point_idx'] = idx[0]
-
-    # now sort each set by L
-    for j in range(nsets):
-        lidx = num.argsort(hkset[j]['L'])
-        hkset[j]['H'] = hkset[j]['H'][lidx]
-        hkset[j]['K'] = hkset[j]['K'][lidx]
-        hkset[j]['L'] = hkset[j]['L'][lidx]
-        hkset[j]['F'] = hkset[j]['F'][lidx]
-        hkset[j]['Ferr'] = hkset[j]['Ferr'][lidx]
-        hkset[j]['I'] = hkset[j]['I'][lidx]
-        hkset[j]['Inorm'] = hkset[j]['Inorm'][lidx]
-        hkset[j]['Ierr'] = hkset[j]['Ierr'][lidx]
-        hkset[j]['Ibgr'] = hkset[j]['Ibgr'][lidx]
-        hkset[j]['point_idx'] = hkset[j]['point_idx'][lidx]
-
+    for (H,K) in rods.keys():
+        idx = rods.rod(H,K)
+        hkset.append({'H':num.around(ctr.H[idx],decimals=hkdecimal),
+                      'K':num.around(ctr.K[idx],decimals=hkdecimal),
+                      'L':ctr.L[idx],'F':ctr.F[idx],'Ferr':ctr.Ferr[idx],
+                      'I':ctr.I[idx],'Inorm':ctr.Inorm[idx],
+                      'Ierr':ctr.Ierr[idx],'Ibgr':ctr.Ibgr[idx],
+                      'point_idx':idx})
     return hkset
 
 ##############################################################################
@@ -943,6 +966,49 @@ def image_point_F(scan,point,I='I',Inorm='io',Ierr='Ierr',Ibgr='Ibgr',
         d['Ferr'] = 0.5 * scale**0.5 * d['Ierr']/d['I']**0.5
     return d
 
+##############################################################################
+def image_scan_F(scan,points=None,I='I',Inorm='io',Ierr='Ierr',Ibgr='Ibgr',
+                 corr_params={},preparsed=False,gonio_cache=None):
+    """
+    compute F for a list of points of an image scan.  The values
+    are the same as those of image_point_F for each point, but the
+    corrections are computed for all points at once (see ctot_scan).
+
+    Returns a dictionary of arrays with the same keys as image_point_F
+    """
+    if points is None:
+        points = range(_scan_npts(scan))
+    points = num.asarray(points,dtype=int)
+    d = {}
+    for (key,lbl) in (('I',I),('Inorm',Inorm),('Ierr',Ierr),('Ibgr',Ibgr)):
+        d[key] = num.array([scan[lbl][j] for j in points],dtype=float)
+    if corr_params == None:
+        scale = 1.0
+        c = None
+    else:
+        scale  = corr_params.get('scale')
+        if scale == None: scale = 1.
+        scale  = float(scale)
+        c = ctot_scan(scan,corr_params,points=points,preparsed=preparsed,
+                      gonio_cache=gonio_cache)
+    if c == None:
+        d['ctot']  = num.ones(len(points),dtype=float)
+        d['alpha'] = num.zeros(len(points),dtype=float)
+        d['beta']  = num.zeros(len(points),dtype=float)
+    else:
+        d['ctot']  = c['ctot']
+        d['alpha'] = c['alpha']
+        d['beta']  = c['beta']
+
+    # compute F
+    d['F']    = num.zeros(len(points),dtype=float)
+    d['Ferr'] = num.zeros(len(points),dtype=float)
+    good  = (d['I'] > 0.0) & (d['Inorm'] > 0.0)
+    scale = scale * d['ctot'][good]/d['Inorm'][good]
+    d['F'][good]    = num.sqrt(scale*d['I'][good])
+    d['Ferr'][good] = 0.5 * scale**0.5 * d['Ierr'][good]/d['I'][good]**0.5
+    return d
+
 ##############################################################################
 def _get_corr(scan,point,corr_params,preparsed=False):
     """
@@ -1178,6 +1244,44 @@ def _update_psic_angles(gonio,scan,point,verbose=True):
     gonio.set_angles(phi=phi,chi=chi,eta=eta,
                      mu=mu,nu=nu,delta=delta)
 
+##############################################################################
+def _scan_npts(scan):
+    try:
+        return int(scan.dims[0])
+    except:
+        return scan.get('dims', (1,0))[0]
+
+def scan_psic_angles(scan,points=None,verbose=True):
+    """
+    given a scandata object return the psic angles of a list
+    of scan points as an (N x 6) array (columns ordered as
+    gonio_psic.PSIC_ANGLES).  The angles are parsed as in
+    _update_psic_angles, missing angles are taken as zero
+    (ie the angles of a new gonio instance)
+    """
+    npts = _scan_npts(scan)
+    if points is None: points = range(npts)
+    points = num.asarray(points,dtype=int)
+    try: 
+        scan_name = scan.name
+    except: 
+        scan_name = ''
+    angles = num.zeros((len(points),6),dtype=float)
+    for (j,name) in enumerate(('phi','chi','eta','mu','nu','del')):
+        try:
+            x = scan[name]
+            if type(x) == types.FloatType:
+                angles[:,j] = x
+            elif len(x) == npts:
+                angles[:,j] = num.asarray(x,dtype=float)[points]
+            else:
+                x = None
+        except:
+            x = None
+        if x is None and verbose==True:
+            print "Warning no %s angle" % name, scan_name
+    return angles
+
 ##############################################################################
 class CtrCorrectionPsic:
     """
@@ -1454,6 +1558,156 @@ class CtrCorrectionPsic:
             
         return ca
 
+##############################################################################
+## Batch corrections.  These compute the same correction factors as
+## CtrCorrectionPsic.ctot_stationary for many points (gonio angles) at
+## once, using the array functions of gonio_psic
+##############################################################################
+def _get_gonio(G,preparsed=False,gonio_cache=None):
+    """
+    psic gonio instance for the spec G array.  If a gonio_cache
+    dictionary is passed, instances are shared between calls
+    with the same G
+    """
+    if gonio_cache == None:
+        return gonio_psic.psic_from_spec(G,preparsed=preparsed)
+    key = (repr(G),preparsed)
+    if key not in gonio_cache:
+        gonio_cache[key] = gonio_psic.psic_from_spec(G,preparsed=preparsed)
+    return gonio_cache[key]
+
+def ctot_scan(scan,corr_params,points=None,preparsed=False,gonio_cache=None):
+    """
+    correction factors for a list of points of a scan (all points
+    by default).  The gonio is built once from scan['G'] and the
+    corrections are computed with ctot_stationary_array.
+
+    Returns None if the geometry is not implemented, otherwise
+    the dictionary of arrays from ctot_stationary_array
+    """
+    geom   = corr_params.get('geom','psic')
+    beam   = corr_params.get('beam_slits',{})
+    det    = corr_params.get('det_slits')
+    sample = corr_params.get('sample')
+    if geom == 'psic':
+        gonio  = _get_gonio(scan['G'],preparsed=preparsed,gonio_cache=gonio_cache)
+        angles = scan_psic_angles(scan,points=points)
+        return ctot_stationary_array(gonio,angles,beam_slits=beam,
+                                     det_slits=det,sample=sample)
+    else:
+        print "Geometry %s not implemented" % geom
+        return None
+
+def ctot_stationary_array(gonio,angles,beam_slits={},det_slits=None,
+                          sample={},fh=1.0):
+    """
+    correction factors for stationary measurements (e.g. images)
+    for N sets of gonio angles
+
+    Parameters:
+    -----------
+    * gonio is a gonio_psic.Psic instance (UB, lambda and n are used)
+    * angles is an (N x 6) array ordered as gonio_psic.PSIC_ANGLES
+    * beam_slits, det_slits, sample are as in CtrCorrectionPsic
+    * fh is the fraction of horizontal polarization
+
+    Returns a dictionary of arrays:
+    'ctot','cp','cl','ca','alpha','beta'
+    """
+    angles = num.asarray(angles,dtype=float)
+    if angles.ndim == 1: angles = angles[num.newaxis,:]
+    arrs = _gonio_arrays(gonio,angles)
+    cp = polarization_array(angles[:,4],angles[:,5],fh=fh)
+    cl = sind(arrs['beta'])
+    ca = active_area_array(arrs,angles,beam_slits=beam_slits,
+                           det_slits=det_slits,sample=sample)
+    return {'ctot':cp*cl*ca,'cp':cp,'cl':cl,'ca':ca,
+            'alpha':arrs['alpha'],'beta':arrs['beta']}
+
+def _gonio_arrays(gonio,angles):
+    """
+    gonio_psic.psic_arrays for a gonio instance, always
+    including the psuedo angles
+    """
+    return gonio_psic.psic_arrays(angles,gonio.UB,gonio.lattice.lam,
+                                  n=gonio.n,UBinv=gonio.UBinv,
+                                  calc_psuedo=True)
+
+def polarization_array(nu,delta,fh=1.0):
+    """
+    polarization correction factors (see CtrCorrectionPsic.polarization)
+    for arrays of nu and delta
+    """
+    p = 1. - ( cosd(delta) * sind(nu) )**2.
+    if fh != 1.0:
+        p = fh * p + (1.-fh)*(1.0 - (sind(delta))**2.)
+    return num.where(p == 0.,0.,1./num.where(p == 0.,1.,p))
+
+def active_area_array(arrs,angles,beam_slits={},det_slits=None,sample={}):
+    """
+    active area corrections (see CtrCorrectionPsic.active_area) for
+    N points.  arrs is the dictionary returned by psic_arrays and
+    angles the (N x 6) array of gonio angles.
+
+    The beam and sample (phi frame) vectors are computed once, the
+    sample polygon is then rotated with the Z matrix of each point,
+    and the areas of all points are computed in a single call to
+    geom.active_area.active_area_array
+    """
+    npts = len(angles)
+    ca = num.zeros(npts,dtype=float)
+    if beam_slits == {} or beam_slits == None:
+        print "Warning beam slits not specified"
+        ca[:] = 1.0
+        return ca
+    alpha = arrs['alpha']
+    beta  = arrs['beta']
+
+    # get beam vectors
+    beam = gonio_psic.beam_vectors(h=beam_slits['horz'],v=beam_slits['vert'])
+
+    # get sample poly, in the phi frame
+    sample_phi = None
+    if type(sample) == types.DictType:
+        sample_dia    = sample.get('dia',0.)
+        sample_vecs   = sample.get('polygon',None)
+        sample_angles = sample.get('angles',{})
+        #
+        if sample_vecs != None and sample_dia <= 0.:
+            sample_phi = gonio_psic.sample_vectors(sample_vecs,
+                                                   angles=sample_angles)
+            if sample_phi != None:
+                sample_phi = num.array([[p[0],p[1],0.] if len(p) == 2 else p
+                                        for p in sample_phi],dtype=float)
+            sample = None
+        elif sample_dia > 0.:
+            sample = sample_dia
+        else:
+            sample = None
+
+    # only points with the beam and detector above the surface
+    idx = num.where((alpha >= 0.0) & (beta >= 0.0))[0]
+    if len(idx) == 0: return ca
+
+    # get det vectors
+    if det_slits == None:
+        det = None
+    else:
+        det = gonio_psic.det_vectors(h=det_slits['horz'],v=det_slits['vert'])
+        D   = gonio_psic.calc_D_array(nu=angles[idx,4],delta=angles[idx,5])
+        # det_vectors for nu=delta=0 rotated by D of each point
+        det = num.einsum('nij,kj->nki',D,num.array(det))
+    if sample_phi is not None:
+        sample = num.einsum('nij,kj->nki',arrs['Z'][idx],sample_phi)
+
+    # compute active_area
+    (A_beam,A_int) = _active_area_array(arrs['nm'][idx],ki=arrs['ki'][idx],
+                                        kr=arrs['kr'][idx],beam=beam,det=det,
+                                        sample=sample)
+    nz = A_int != 0.
+    ca[idx[nz]] = A_beam[nz]/(A_int[nz]**2)
+    return ca
+
 ##############################################################################
 ##############################################################################
 def test1():
@@ -13,6 +13,12 @@ that the beam is perfectly parrallel (no divergence)
 It would be interesting if we could set the detector polygon from an 
 arbirary set of pixels (e.g. roi) on image detector... especially if 
 shifted off center (or better off center relative to a specific hkl)
+
+The areas are computed exactly, by clipping the surface projections of
+the beam, detector and sample polygons (see polygon.clip_polygons) and
+with the closed form area of a polygon within a round sample
+(polygon.circle_poly_area).  active_area_array computes the areas for
+many instrument settings (e.g. all points of a rod) in one call.
 """
 ##########################################################################
 
@@ -24,7 +30,9 @@ from tdl.modules.utils.mathutil import cosd, sind, tand
 from tdl.modules.utils.mathutil import arccosd, arcsind, arctand
 from tdl.modules.utils.mathutil import cartesian_mag, cartesian_angle
 
-from tdl.modules.geom.polygon import poly_area, poly_area_num, inner_polygon
+from tdl.modules.geom.polygon import poly_area, poly_array, poly_points
+from tdl.modules.geom.polygon import poly_area_array, sort_polygons
+from tdl.modules.geom.polygon import clip_polygons, circle_poly_area
 from tdl.modules.geom.polygon import plot_polygon, plot_points, plot_circle
 
 ##########################################################################
@@ -164,15 +172,16 @@ def _area_round(beam_poly,det_poly,diameter=None,plot=False,fig=None):
         pyplot.clf()
     A_beam = poly_area(beam_poly)
     if det_poly != None:
-        inner_poly = inner_polygon(beam_poly,det_poly)
+        inner = clip_polygons(beam_poly,det_poly)
     else:
-        inner_poly = beam_poly
+        inner = poly_array(beam_poly)
+    inner_poly = poly_points(inner[0])
     if diameter <= 0.:
         diameter = None
     if diameter == None:
-        A_int = poly_area(inner_poly)
+        A_int = poly_area_array(inner)[0]
     else:
-        A_int = poly_area_num(beam_poly,diameter=diameter,plot=plot)
+        A_int = circle_poly_area(inner,diameter)[0]
 
     # make plots
     if plot:
@@ -210,12 +219,13 @@ def _area_polygon(beam_poly,det_poly,sam_poly,plot=False,fig=None):
         pyplot.clf()
     A_beam = poly_area(beam_poly)
     if sam_poly == None:
-        inner_poly = beam_poly
+        inner = poly_array(beam_poly)
     else:
-        inner_poly = inner_polygon(beam_poly,sam_poly)
+        inner = clip_polygons(sort_polygons(sam_poly),beam_poly)
     if det_poly != None:
-        inner_poly = inner_polygon(inner_poly,det_poly)
-    A_int = poly_area(inner_poly)
+        inner = clip_polygons(inner,det_poly)
+    inner_poly = poly_points(inner[0])
+    A_int = poly_area_array(inner)[0]
     
     # make plots
     if plot:
@@ -236,6 +246,89 @@ def _area_polygon(beam_poly,det_poly,sam_poly,plot=False,fig=None):
 
     return (A_beam,A_int)
 
+##########################################################################
+def active_area_array(nm,ki=num.array([0.,1.,0.]),kr=num.array([0.,1.,0.]),
+                      beam=[],det=None,sample=1.):
+    """
+    Calc the areas of overlap of beam, sample and detector surface
+    polygon projections for N instrument settings (see active_area)
+
+    Parameters:
+    -----------
+    * nm, ki and kr are (N x 3) arrays (or single vectors) of the
+      surface normal and incident and diffracted beam directions
+    * beam is a list of lab frame vectors defining the beam apperature
+      or an (N x nb x 3) array
+    * det is None (ignored) or a list of lab frame vectors or an
+      (N x nd x 3) array defining the detector apperature
+    * sample is a number (diameter of a round sample), None (infinite
+      sample), or a list of lab frame vectors or an (N x ns x 3) array
+      describing the sample polygon
+
+    Output:
+    -------
+    * (A_beam, A_int) arrays of length N, see active_area
+    """
+    nm = num.atleast_2d(num.asarray(nm,dtype=float))
+    n  = len(nm)
+    M  = calc_surf_transform_array(nm)
+    ki_s = _surf_vectors(M,_unit_vectors(ki,n)[:,num.newaxis,:])[:,0]
+    kr_s = _surf_vectors(M,_unit_vectors(kr,n)[:,num.newaxis,:])[:,0]
+
+    beam_poly = _surf_intercepts(ki_s,_surf_vectors(M,_lab_vectors(beam,n)))
+    A_beam = poly_area_array(beam_poly)
+    if det is not None:
+        det_poly = _surf_intercepts(kr_s,_surf_vectors(M,_lab_vectors(det,n)))
+    else:
+        det_poly = None
+
+    if sample is None or num.ndim(sample) == 0:
+        if det_poly is not None:
+            inner = clip_polygons(beam_poly,det_poly)
+        else:
+            inner = beam_poly
+        if sample is None or sample <= 0.:
+            A_int = poly_area_array(inner)
+        else:
+            A_int = circle_poly_area(inner,sample)
+    else:
+        vs = _surf_vectors(M,_lab_vectors(sample,n))
+        if num.any(num.fabs(vs[:,:,2]) > 0.01):
+            print "Warning sample hieght problem"
+        inner = clip_polygons(sort_polygons(vs),beam_poly)
+        if det_poly is not None:
+            inner = clip_polygons(inner,det_poly)
+        A_int = poly_area_array(inner)
+    return (A_beam, A_int)
+
+def _unit_vectors(k,n):
+    k = num.atleast_2d(num.asarray(k,dtype=float))
+    k = k / num.sqrt(num.sum(k*k,axis=1))[:,num.newaxis]
+    if len(k) == 1: k = k.repeat(n,axis=0)
+    return k
+
+def _lab_vectors(v,n):
+    """ (n x nv x 3) array of lab frame polygon vectors """
+    v = num.array(v,dtype=float)
+    if v.ndim == 2:
+        if v.shape[1] == 2:
+            v = num.concatenate((v,num.zeros((len(v),1))),axis=1)
+        v = v[num.newaxis,:,:].repeat(n,axis=0)
+    return v
+
+def _surf_vectors(M,v):
+    return num.einsum('nij,nkj->nki',M,v)
+
+def _surf_intercepts(k,v):
+    """ array version of surface_intercept """
+    old = num.seterr(divide='ignore',invalid='ignore')
+    try:
+        x = v[:,:,0] - (k[:,0]/k[:,2])[:,num.newaxis]*v[:,:,2]
+        y = v[:,:,1] - (k[:,1]/k[:,2])[:,num.newaxis]*v[:,:,2]
+    finally:
+        num.seterr(**old)
+    return num.concatenate((x[:,:,num.newaxis],y[:,:,num.newaxis]),axis=2)
+
 ##########################################################################
 def calc_surf_transform(nm):
     """
@@ -287,6 +380,22 @@ def calc_surf_transform(nm):
 
     return M
 
+##########################################################################
+def calc_surf_transform_array(nm):
+    """
+    Array version of calc_surf_transform, nm is (N x 3)
+    and the (N x 3 x 3) transformation matricies are returned.
+    F is orthonormal, therefore M = transpose(inv(F)) = F
+    """
+    v_z = nm / num.sqrt(num.sum(nm*nm,axis=1))[:,num.newaxis]
+    v   = num.array([0.,-1.,0.])
+    v_y = v[num.newaxis,:] - num.dot(v_z,v)[:,num.newaxis]*v_z
+    v_y = v_y / num.sqrt(num.sum(v_y*v_y,axis=1))[:,num.newaxis]
+    v_x = num.cross(v_y,v_z)
+    v_x = v_x / num.sqrt(num.sum(v_x*v_x,axis=1))[:,num.newaxis]
+    return num.concatenate((v_x[:,num.newaxis,:],v_y[:,num.newaxis,:],
+                            v_z[:,num.newaxis,:]),axis=1)
+
 ##################################################################
 def surface_intercept(k,v):
     """
@@ -174,6 +174,7 @@ class Psic:
         self.U = []
         self.B = []
         self.UB = []
+        self.UBinv = []
         self._calc_UB()
 
     ###################################################
@@ -370,8 +371,9 @@ class Psic:
         #self.U = num.dot(Tphi, Tc.transpose())
         self.U = num.dot(Tphi, num.linalg.inv(Tc))
 
-        # calc UB
+        # calc UB and cache its inverse
         self.UB = num.dot(self.U,self.B)
+        self.UBinv = num.linalg.inv(self.UB)
 
         #update h and psuedo angles...
         self.set_angles()
@@ -415,7 +417,7 @@ class Psic:
         self.kr=kr
         
         hphi = num.dot(num.linalg.inv(self.Z),self.Q) / (2.*num.pi) 
-        h    = num.dot(num.linalg.inv(self.UB),hphi)
+        h    = num.dot(self.UBinv,hphi)
         self.h = h
         
     ###################################################
@@ -465,7 +467,7 @@ class Psic:
                            -sind(sig_az)*sind(tau_az), 
                                   cosd(sig_az)        ])
         # n in HKL
-        n_hkl = num.dot(num.linalg.inv(self.UB),n_phi)
+        n_hkl = num.dot(self.UBinv,n_phi)
         n_hkl = n_hkl/ num.max(num.abs(n_hkl))
         
         # note if l-component is negative, then its
@@ -479,6 +481,30 @@ class Psic:
         # all the psuedo angles
         self.set_n(n_hkl)
 
+    ###################################################
+    def calc_arrays(self,angles):
+        """
+        Compute h, Q and the psuedo angles for many sets of
+        gonio angles at once, using the current UB, lambda
+        and reference vector n.
+
+        Parameters:
+        -----------
+        * angles is either an (N x 6) array with columns
+          ordered as PSIC_ANGLES (phi,chi,eta,mu,nu,delta),
+          or a dictionary of angle arrays keyed by angle name
+          (missing angles are taken from self.angles)
+
+        Returns a dictionary of arrays, see psic_arrays.
+        The gonio state (self.angles, self.h) is not changed.
+        """
+        if isinstance(angles,dict):
+            tmp = copy.copy(self.angles)
+            tmp.update(angles)
+            angles = tmp
+        return psic_arrays(angles,self.UB,self.lattice.lam,n=self.n,
+                           UBinv=self.UBinv,calc_psuedo=self.calc_psuedo)
+
     ################################################### 
     ## Pseudo angles
     ###################################################
@@ -885,6 +911,167 @@ def calc_D(nu=0.0,delta=0.0):
     D = num.dot(D2,D1)
     return (D)
 
+##########################################################################
+## Array versions.  These evaluate the above for N angle settings
+## at once, rotation matrices are returned stacked as (N x 3 x 3)
+## and vectors as (N x 3)
+##########################################################################
+PSIC_ANGLES = ['phi','chi','eta','mu','nu','delta']
+
+def _rot_array(c,s,axes,signs):
+    """
+    Stack of rotation matrices about one axis.  c and s are the
+    cosine and sine arrays, axes the two rotated indicies and
+    signs the signs of the off diagonal sine terms
+    """
+    R = num.zeros((len(c),3,3),dtype=float)
+    k = 3 - axes[0] - axes[1]
+    R[:,k,k] = 1.
+    R[:,axes[0],axes[0]] = c
+    R[:,axes[1],axes[1]] = c
+    R[:,axes[0],axes[1]] = signs[0]*s
+    R[:,axes[1],axes[0]] = signs[1]*s
+    return R
+
+def _as_array(x,n=None):
+    x = num.atleast_1d(num.asarray(x,dtype=float))
+    if n != None and len(x) == 1: x = x.repeat(n)
+    return x
+
+def calc_Z_array(phi=0.0,chi=0.0,eta=0.0,mu=0.0):
+    """
+    Array version of calc_Z.  Angles (degrees) are arrays
+    (or scalars) of a common length N, returns (N x 3 x 3)
+    """
+    n = max([num.size(x) for x in (phi,chi,eta,mu)])
+    phi,chi,eta,mu = [_as_array(x,n) for x in (phi,chi,eta,mu)]
+    P = _rot_array(cosd(phi),sind(phi),(0,1),( 1,-1))
+    X = _rot_array(cosd(chi),sind(chi),(0,2),( 1,-1))
+    H = _rot_array(cosd(eta),sind(eta),(0,1),( 1,-1))
+    M = _rot_array(cosd(mu), sind(mu), (1,2),(-1, 1))
+    mult = lambda A,B: num.einsum('nij,njk->nik',A,B)
+    return mult(mult(mult(M,H),X),P)
+
+def calc_kvecs_array(nu=0.0,delta=0.0,lam=1.0):
+    """
+    Array version of calc_kvecs, returns (ki,kr) as (N x 3)
+    """
+    n = max(num.size(nu),num.size(delta))
+    nu,delta = _as_array(nu,n),_as_array(delta,n)
+    k  = (2.* num.pi / lam)
+    ki = num.zeros((n,3),dtype=float)
+    ki[:,1] = k
+    kr = k * num.column_stack((sind(delta),
+                               cosd(nu)*cosd(delta),
+                               sind(nu)*cosd(delta)))
+    return (ki,kr)
+
+def calc_Q_array(nu=0.0,delta=0.0,lam=1.0,ret_k=False):
+    """
+    Array version of calc_Q, returns Q as (N x 3)
+    """
+    (ki,kr) = calc_kvecs_array(nu=nu,delta=delta,lam=lam)
+    Q = kr - ki
+    if ret_k == True:
+        return (Q,ki,kr)
+    else:
+        return Q
+
+def calc_D_array(nu=0.0,delta=0.0):
+    """
+    Array version of calc_D, returns (N x 3 x 3)
+    """
+    n = max(num.size(nu),num.size(delta))
+    nu,delta = _as_array(nu,n),_as_array(delta,n)
+    D1 = _rot_array(cosd(delta),sind(delta),(0,1),( 1,-1))
+    D2 = _rot_array(cosd(nu),   sind(nu),   (1,2),(-1, 1))
+    return num.einsum('nij,njk->nik',D2,D1)
+
+def _mag_array(v):
+    return num.sqrt(num.sum(v*v,axis=1))
+
+def _angle_array(u,v):
+    """
+    row wise cartesian_angle
+    """
+    denom = _mag_array(u)*_mag_array(v)
+    arg = num.sum(u*v,axis=1) / num.where(denom == 0, 1., denom)
+    alpha = arccosd(num.clip(arg,-1.,1.))
+    return num.where(denom == 0, 0., alpha)
+
+def psic_arrays(angles,UB,lam,n=[0.,0.,1.],UBinv=None,calc_psuedo=True):
+    """
+    Compute h and psuedo angles for N sets of psic angles
+
+    Parameters:
+    -----------
+    * angles is an (N x 6) array with columns ordered as
+      PSIC_ANGLES (phi,chi,eta,mu,nu,delta) or a dictionary
+      of angle arrays (or scalars) keyed by the angle names
+    * UB is the orientation matrix and lam the wavelength
+    * n is the reference vector (hkl) for psuedo angles
+    * UBinv may be passed to avoid recomputing inv(UB)
+
+    Returns:
+    --------
+    * dictionary with 'h' (N x 3), 'Q', 'ki', 'kr', 'nm' (N x 3),
+      'Z' (N x 3 x 3) and, if calc_psuedo, the psuedo angle
+      arrays keyed as in Psic.pangles.  The results agree with
+      Psic.set_angles(...); Psic.h and Psic.pangles for each row.
+    """
+    if isinstance(angles,dict):
+        ang = [angles.get(a,0.0) for a in PSIC_ANGLES]
+    else:
+        angles = num.asarray(angles,dtype=float)
+        if angles.ndim == 1: angles = angles[num.newaxis,:]
+        ang = [angles[:,j] for j in range(6)]
+    npts = max([num.size(a) for a in ang])
+    (phi,chi,eta,mu,nu,delta) = [_as_array(a,npts) for a in ang]
+    if UBinv is None: UBinv = num.linalg.inv(UB)
+
+    Z = calc_Z_array(phi,chi,eta,mu)
+    (Q,ki,kr) = calc_Q_array(nu,delta,lam,ret_k=True)
+    # Z is orthogonal so inv(Z) = transpose(Z)
+    hphi = num.einsum('nji,nj->ni',Z,Q) / (2.*num.pi)
+    h    = num.dot(hphi,UBinv.transpose())
+    out = {'h':h,'Q':Q,'ki':ki,'kr':kr,'Z':Z}
+    if not calc_psuedo:
+        return out
+
+    n = num.asarray(n,dtype=float)
+    n_phi = num.dot(UB,n)
+    n_phi = n_phi/cartesian_mag(n_phi)
+    nm = num.einsum('nij,j->ni',Z,n_phi)
+    nm = nm/_mag_array(nm)[:,num.newaxis]
+    out['nm'] = nm
+
+    tth = arccosd(cosd(delta)*cosd(nu))
+    out['tth'] = tth
+    out['sigma_az'] = arccosd(n_phi[2]).repeat(npts)
+    out['tau_az'] = num.degrees(num.arctan2(-n_phi[1],n_phi[0])).repeat(npts)
+    out['naz'] = num.degrees(num.arctan2(nm[:,0],nm[:,2]))
+    alpha = arcsind(-nm[:,1])
+    out['alpha'] = alpha
+    kr_n = kr/_mag_array(kr)[:,num.newaxis]
+    out['beta'] = arcsind(num.sum(nm*kr_n,axis=1))
+    tau = _angle_array(Q,nm)
+    out['tau'] = tau
+    xx    = (cosd(tau)*sind(tth/2.) - sind(alpha))
+    denom = (sind(tau)*cosd(tth/2.))
+    zero  = (denom == 0)
+    psi   = arccosd(xx/num.where(zero,1.,denom))
+    out['psi'] = num.where(zero,0.,psi)
+    out['qaz'] = num.degrees(num.arctan2(sind(delta),cosd(delta)*sind(nu)))
+    # T = transpose(M)*transpose(H), i.e. Qpp = transpose(H*M)*Q
+    H = _rot_array(cosd(eta),sind(eta),(0,1),( 1,-1))
+    M = _rot_array(cosd(mu), sind(mu), (1,2),(-1, 1))
+    HM  = num.einsum('nij,njk->nik',H,M)
+    Qpp = num.einsum('nji,nj->ni',HM,Q)
+    Qxz = Qpp.copy()
+    Qxz[:,1] = 0.
+    out['omega'] = _angle_array(Qxz,Qpp)
+    return out
+
 ##########################################################################
 def beam_vectors(h=1.0,v=1.0):
     """
@@ -1149,6 +1336,25 @@ def test2(show=True):
 
     return psic
     
+##########################################################################
+def test3(npts=1000):
+    """
+    Compare psic_arrays with the single point calcs
+    """
+    psic = test2(show=False)
+    angles = num.random.uniform(-60.,60.,(npts,6))
+    angles[:,4:6] = num.abs(angles[:,4:6])
+    res = psic.calc_arrays(angles)
+    err = 0.
+    for j in range(npts):
+        psic.set_angles(**dict(zip(PSIC_ANGLES,angles[j])))
+        err = max(err,num.max(num.abs(psic.h - res['h'][j])))
+        for key in psic.pangles.keys():
+            if num.isfinite(psic.pangles[key]):
+                err = max(err,num.abs(psic.pangles[key] - res[key][j]))
+    print "max deviation array vs single point calcs:", err
+    return err
+
 ##########################################################################
 if __name__ == "__main__":
     """
@@ -3,280 +3,291 @@ Pixel HKL
 
 Authors/Modifications:
 -----------------------
+agent (agent@local)
 
 Notes:
 ------
-* Needs to be completed.
+Per pixel Q and HKL for an area detector mounted on the psic
+detector arm.
+
+With all detector angles zero the detector face is perpendicular
+to the lab y axis (the incident beam direction) at a distance
+'distance' from the rotation center.  The vector from the sample
+to a pixel (row, col) in this (phi) frame is
+    p = [(row - cen_row)*pixel_size, distance, (col - cen_col)*pixel_size]
+ie image rows run along lab x (vertical) and columns along lab z
+(horizontal).  The scattered wave vector of a pixel after the
+detector rotation is
+    kr_p = (2pi/lam) * D * p/|p|
+where D = calc_D(nu,delta), and the pixel momentum transfer and hkl
+follow as for the detector center:
+    Q_p = kr_p - ki
+    h_p = inv(UB) * inv(Z) * Q_p / (2pi)
+
+The normalized pixel vectors p/|p| depend only on the detector
+geometry and are computed once.  For a scan the angles are passed
+as (N x 6) arrays (see gonio_psic.PSIC_ANGLES) and the rotations
+are applied to all pixels of all frames with array products.
+
+Example:
+--------
+>>pq = PixelQ(shape=(195,487),distance=1000.,pixel_size=0.172,
+              center=(97,243))
+>>hkl = pq.calc_hkl_scan(angles,UB,lam)     # (N,195,487,3)
+>>grid = HKLGrid(ranges=[(0.9,1.1),(-0.1,0.1),(0.5,4.)],bins=(50,50,400))
+>>grid.add(hkl,images)
+>>I = grid.intensity()
 """
 ###########################################################
 
 import numpy as num
 
-###########################################################
-""""
-lam = 1.2;
-k = 2*pi/lam;
-
-# sample det distance (mm)
-y = 5000 ;
-
-# pixel dims (mm)
-del_pixel = 0.175;
-
-# pixel coords
-dx = 500;
-dz = 100;
-
-# vector pointing to pixel
-p = [dx*del_pixel, y, dz*del_pixel];
-
-# normalized
-pn = p/sqrt((dx*del_pixel)^2 + y^2 + (dz*del_pixel)^2);
-v_mag(pn);
-
-
-# get rot matricies for detector arm
-nu = 0
-del = 0
-
-P = [  1,       0,         0    ;
-       0,   cosd(nu), -sind(nu) ;
-       0,   sind(nu),  cosd(nu) ];
-    
-D = [  cosd(del),   sind(del),   0 ;
-      -sind(del),   cosd(del),   0 ;
-          0     ,       0    ,   1 ];
-       
-
-# calc kr for center of det
-kr = P*D*[0;1;0];
-kr = k*kr
-#should be same as
-#kr = k*[ sind(del)           ; 
-#         cosd(nu)*cosd(del)  ; 
-#         sind(nu)*cosd(del) ];
+from tdl.modules.geom.gonio_psic import calc_Z_array, calc_D_array
+from tdl.modules.geom.gonio_psic import PSIC_ANGLES
 
-# calc Q for center
-ki = k*[ 0 ;
-         1 ;
-         0 ];      
-Qm = kr - ki
-tth = v_angle(ki,kr, [1 1 1 90 90 90])
-
-# calc kr or rotated pixel vector 
-kr_p = P*D*pn;
-kr_p = k*kr_p
-
-# calc Q for pixel
-Qm_p = kr_p - ki
-tth_p = v_angle(ki,kr_p, [1 1 1 90 90 90])
-
-# now we can calc hkl for the center and the pixel 
-# given Z and UB
-# [Z,Qm,ki,kr,tth] = calc_Z_and_Q(angles,k);
-#[U, UB] = calc_U(h_1, lam_1, angle_1, h_2, lam_2, angle_2, cell);
-#
-# h = (1/(2*pi))*inv(UB)*inv(Z)*Qm_p
-
-########################################################################
-########################################################################
-#HKL scan for goethite (10L) rod, specfile: gt_6_april07_b(fake).spc, scan = 1 0 2.51379
-#############################
-# #S 2  hklscan  0.999939 0.999939  -8.56988e-05 -8.56988e-05  2.06 3.94  29 0.5
-# #D Mon Apr 23 17:06:40 2007
-# #T 0.5  (Seconds)
-# #G0 0 0 1 -0.0001806167054 0.0002695003495 1 0 0 0 0 0 0 50.031 0 0 1 4 2 5 4 0
-# #G1 3.023 4.609 9.963 90 90 90 2.078460241 1.363242636 0.6306519429 90 90 90 0 0 6 1 -1 3 -0.0002 -0.008 -2.59 1.9435 36.2778 15.309 26.6488 13.3275 9.021 -26.4045 13.88 -0.10275 1.0339 1.0339
-# #G3 2.070853321 -0.09753606408 0.02949524505 0.1533409954 1.357964195 -0.03015295668 -0.08972198422 0.06964512884 0.6292397817
-# #G4 0.9999385052 -8.569884087e-05 1.940140169 1.0339 4.000241947 7.548864431 -1.522131988 22.89000882 87.91053344 59.54799609 71.72405792 12.00256456 3.7875 45.7 4 0 0 0 12 0 0 0 0.2 122.798 0 0 0 0 -180 -180 -180 -180 -180 -180 -180 -180 -180 0 0 0 0 0 0 0 0 0 0 0 0
-# #Q 0.999939 -8.56988e-05 1.94014
-# #P0 21.675099 10.833 10.34 4.272 7.5422504 -1.2597501 15.1823 13.5044
-# #P1 8.6210004 0 0.0001072 0.064599998 8.1185004 0 499.93943 0
-# #P2 499.93943 -1816.025 179.96889 0 199.84443 0 2000.0779 0
-# #P3 2000.0779 0 2000.0779 0 2000.0779 0.065399998 -0.1552 -0.1538
-# #P4 0 0 0 0 0 0 0 -5655.4269
-# #P5 0 
-# #ATTEN 0 0 0 0
-# #ALP_BET 4.00024 7.54886
-# #ENERGY 11991.9
-# #N 15
-# #L H  K  L  del  eta  chi  phi  nu  mu  Alpha  Beta  Epoch  io  i1  Bicron  AmpTek_sc  ROI1  ROI2  ROI3  Seconds  IROI
-# 0.999939 -8.56988e-05 2.06    21.8112    10.9035    10.3590     4.4855     8.3050    -1.2860  3.9997   8.2706  510 40 22 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.12483    21.8852    10.9385    10.3700     4.6160     8.7168    -1.3003  3.9993   8.6601  512 40 23 0 0 0 0 0 0.509997 0
-# 0.999939 -8.56988e-05 2.18966    21.9572    10.9755    10.3810     4.7540     9.1298    -1.3138  4.0002   9.0487  515 43 25 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.25448    22.0292    11.0105    10.3940     4.9010     9.5435    -1.3308   3.998   9.4412  517 48 29 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.31931    22.1011    11.0530    10.4060     5.0545     9.9590    -1.3453  3.9997   9.8307  519 48 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.38414    22.1683    11.0820    10.4190     5.2180    10.3745    -1.3613  3.9977   10.223  521 42 23 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.44897    22.2413    11.1175    10.4335     5.3880    10.7918    -1.3748  3.9999   10.615  523 48 29 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.51379    22.3113    11.1500    10.4470     5.5685    11.2093    -1.3910   3.999   11.008  525 48 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.57862    22.3787    11.1850    10.4620     5.7560    11.6275    -1.4060  4.0002   11.399  527 47 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.64345    22.4432    11.2180    10.4770     5.9515    12.0480    -1.4228  3.9995   11.794  529 48 30 0 0 0 0 0 0.509997 0
 ###########################################################
-# Give the hkl of interest
-# Do the reverse converions from h to Pixels
-h = [ 1.0021;-0.0028;2.5374]
-
-# arrays from spec file
-Uarray = [3.023 4.609 9.963 90 90 90 2.078460241 1.363242636 0.6306519429 90 90 90 0 0 6 1 -1 3 -0.0002 -0.008 -2.59 1.9435 36.2778 15.309 26.6488 13.3275 9.021 -26.4045 13.88 -0.10275 1.0339 1.0339];
-angles = [22.3113    11.1500    10.4470     5.5685    11.2093    -1.3910 ];
-# get the angles needed for the geometry calcs
-# first parse the data needed to calc the UB matrix.
-cell = [Uarray(1:6)];     # cell parameters (real space)
-h_1 = [Uarray(13:15)];    # hkl of OR1
-h_2 = [Uarray(16:18)];    # hkl of OR2 
+class PixelQ:
+    """
+    Per pixel Q and HKL calculations for an area detector
+    """
+    def __init__(self,shape=(195,487),distance=1000.,pixel_size=0.172,
+                 center=None):
+        """
+        Parameters:
+        -----------
+        * shape is the image shape (nrows,ncols)
+        * distance is the sample-detector distance (mm)
+        * pixel_size is the pixel size (mm)
+        * center is the (row,col) of the pixel intersected by
+          the detector arm axis.  If center == None the center
+          of the image is used
+        """
+        self.shape      = tuple(shape)
+        self.distance   = float(distance)
+        self.pixel_size = float(pixel_size)
+        if center == None:
+            center = ((self.shape[0]-1)/2., (self.shape[1]-1)/2.)
+        self.center = (float(center[0]),float(center[1]))
+        self._calc_pn()
+
+    def __repr__(self):
+        lout = "Detector: %i x %i pixels, " % self.shape
+        lout = "%sdistance=%6.2f mm, pixel=%6.4f mm, " % (lout,self.distance,
+                                                         self.pixel_size)
+        lout = "%scenter=(%6.2f,%6.2f)\n" % (lout,self.center[0],self.center[1])
+        return lout
+
+    def update(self,distance=None,pixel_size=None,center=None):
+        """
+        Change the detector geometry and recompute the
+        pixel vectors
+        """
+        if distance != None:   self.distance = float(distance)
+        if pixel_size != None: self.pixel_size = float(pixel_size)
+        if center != None:     self.center = (float(center[0]),float(center[1]))
+        self._calc_pn()
+
+    def _calc_pn(self):
+        """
+        Normalized phi frame vectors pointing to each pixel,
+        shape (nrows*ncols,3)
+        """
+        (nrow,ncol) = self.shape
+        row = (num.arange(nrow,dtype=float) - self.center[0])*self.pixel_size
+        col = (num.arange(ncol,dtype=float) - self.center[1])*self.pixel_size
+        p = num.zeros((nrow,ncol,3),dtype=float)
+        p[:,:,0] = row[:,num.newaxis]
+        p[:,:,1] = self.distance
+        p[:,:,2] = col[num.newaxis,:]
+        p = p.reshape(nrow*ncol,3)
+        self.pn = p / num.sqrt(num.sum(p*p,axis=1))[:,num.newaxis]
+
+    def calc_Q(self,nu=0.0,delta=0.0,lam=1.0):
+        """
+        Lab frame Q of every pixel.  nu and delta are scalars
+        or arrays of length N.  Returns (N,nrows,ncols,3)
+        """
+        D  = calc_D_array(nu,delta)
+        k  = 2.*num.pi/lam
+        Q  = k*num.einsum('nij,pj->npi',D,self.pn)
+        Q[:,:,1] = Q[:,:,1] - k
+        return Q.reshape((len(D),) + self.shape + (3,))
+
+    def calc_tth(self,nu=0.0,delta=0.0):
+        """
+        Scattering angle (degrees) of every pixel,
+        returns (N,nrows,ncols)
+        """
+        D = calc_D_array(nu,delta)
+        # ki is along lab y so cos(tth) is the y component of kr/k
+        c = num.einsum('nj,pj->np',D[:,1,:],self.pn)
+        tth = num.degrees(num.arccos(num.clip(c,-1.,1.)))
+        return tth.reshape((len(D),) + self.shape)
+
+    def calc_hkl(self,angles,UB,lam,UBinv=None):
+        """
+        hkl of every pixel for one set of gonio angles.
+
+        Parameters:
+        -----------
+        * angles is a dictionary of gonio angles (or a
+          length 6 sequence ordered as PSIC_ANGLES)
+        * UB is the orientation matrix and lam the wavelength
+
+        Returns (nrows,ncols,3)
+        """
+        if isinstance(angles,dict):
+            angles = [angles.get(a,0.0) for a in PSIC_ANGLES]
+        angles = num.asarray(angles,dtype=float)[num.newaxis,:]
+        return self.calc_hkl_scan(angles,UB,lam,UBinv=UBinv)[0]
+
+    def calc_hkl_scan(self,angles,UB,lam,UBinv=None):
+        """
+        hkl of every pixel for each frame of a scan.
+
+        Parameters:
+        -----------
+        * angles is an (N x 6) array with columns ordered as
+          PSIC_ANGLES (phi,chi,eta,mu,nu,delta)
+        * UB is the orientation matrix and lam the wavelength
+        * UBinv may be passed to avoid recomputing inv(UB)
+
+        Returns (N,nrows,ncols,3)
+        """
+        angles = num.asarray(angles,dtype=float)
+        if angles.ndim == 1: angles = angles[num.newaxis,:]
+        (phi,chi,eta,mu,nu,delta) = [angles[:,j] for j in range(6)]
+        if UBinv is None: UBinv = num.linalg.inv(UB)
+        Q = self.calc_Q(nu,delta,lam)
+        Z = calc_Z_array(phi,chi,eta,mu)
+        # h = inv(UB)*transpose(Z)*Q/(2pi) for each frame, Z is orthogonal
+        M = num.einsum('ij,nkj->nik',UBinv,Z) / (2.*num.pi)
+        npix = self.shape[0]*self.shape[1]
+        h = num.einsum('nij,npj->npi',M,Q.reshape(len(Z),npix,3))
+        return h.reshape(Q.shape)
+
+    def iter_hkl_scan(self,angles,UB,lam,nframes=10):
+        """
+        Generator yielding (index slice, hkl) for blocks of
+        nframes frames, to bound memory on long scans
+        """
+        angles = num.asarray(angles,dtype=float)
+        if angles.ndim == 1: angles = angles[num.newaxis,:]
+        UBinv = num.linalg.inv(UB)
+        for j in range(0,len(angles),nframes):
+            idx = slice(j,min(j+nframes,len(angles)))
+            yield idx, self.calc_hkl_scan(angles[idx],UB,lam,UBinv=UBinv)
 
-# note see calc_U for how these should be parsed
-angle_1 = [Uarray(19:24)];   # motor settings for OR1
-angle_2 = [Uarray(25:30)];   # motor settings for OR2
-lam_1 = Uarray(31);          # lambda for OR1  
-lam_2 = Uarray(32);          # lambda for OR2 
-
-lam = 1.0339;
-k = 2*pi/lam;
-# sample det distance (mm)
-y =1500 ;
-# pixel dims (mm)
-del_pixel = 0.175;
-#center pixels 
-CenPix_x = 235;
-CenPix_y = 85;
-# now we can calc hkl for the center and the pixel 
-# given Z and UB
- [Z,Qm,ki,kr,tth] = calc_Z_and_Q(angles,k);
-[U, UB] = calc_U(h_1, lam_1, angle_1, h_2, lam_2, angle_2, cell);
-
-#matrix of conversion of Pixel to h
-M_PQ = (1/(2*pi))*inv(UB)*inv(Z);
-Qm_p = inv(M_PQ)*h;
-kr_p = Qm_p + ki;
-kr_p = kr_p/k;
-pn = inv(D)*inv(P)*kr_p;
-mod_p = y/pn(2);
-p = pn*mod_p;
-dx = p(1)/del_pixel
-dz = p(3)/del_pixel
-Pix_x = CenPix_x + dz
-Pix_y = CenPix_y + dx
-
-########################################################################
-########################################################################
-#HKL scan for goethite (10L) rod, specfile: gt_6_april07_b(fake).spc, scan = 1 0 2.51379
-#############################
-# #S 2  hklscan  0.999939 0.999939  -8.56988e-05 -8.56988e-05  2.06 3.94  29 0.5
-# #D Mon Apr 23 17:06:40 2007
-# #T 0.5  (Seconds)
-# #G0 0 0 1 -0.0001806167054 0.0002695003495 1 0 0 0 0 0 0 50.031 0 0 1 4 2 5 4 0
-# #G1 3.023 4.609 9.963 90 90 90 2.078460241 1.363242636 0.6306519429 90 90 90 0 0 6 1 -1 3 -0.0002 -0.008 -2.59 1.9435 36.2778 15.309 26.6488 13.3275 9.021 -26.4045 13.88 -0.10275 1.0339 1.0339
-# #G3 2.070853321 -0.09753606408 0.02949524505 0.1533409954 1.357964195 -0.03015295668 -0.08972198422 0.06964512884 0.6292397817
-# #G4 0.9999385052 -8.569884087e-05 1.940140169 1.0339 4.000241947 7.548864431 -1.522131988 22.89000882 87.91053344 59.54799609 71.72405792 12.00256456 3.7875 45.7 4 0 0 0 12 0 0 0 0.2 122.798 0 0 0 0 -180 -180 -180 -180 -180 -180 -180 -180 -180 0 0 0 0 0 0 0 0 0 0 0 0
-# #Q 0.999939 -8.56988e-05 1.94014
-# #P0 21.675099 10.833 10.34 4.272 7.5422504 -1.2597501 15.1823 13.5044
-# #P1 8.6210004 0 0.0001072 0.064599998 8.1185004 0 499.93943 0
-# #P2 499.93943 -1816.025 179.96889 0 199.84443 0 2000.0779 0
-# #P3 2000.0779 0 2000.0779 0 2000.0779 0.065399998 -0.1552 -0.1538
-# #P4 0 0 0 0 0 0 0 -5655.4269
-# #P5 0 
-# #ATTEN 0 0 0 0
-# #ALP_BET 4.00024 7.54886
-# #ENERGY 11991.9
-# #N 15
-# #L H  K  L  del  eta  chi  phi  nu  mu  Alpha  Beta  Epoch  io  i1  Bicron  AmpTek_sc  ROI1  ROI2  ROI3  Seconds  IROI
-# 0.999939 -8.56988e-05 2.06    21.8112    10.9035    10.3590     4.4855     8.3050    -1.2860  3.9997   8.2706  510 40 22 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.12483    21.8852    10.9385    10.3700     4.6160     8.7168    -1.3003  3.9993   8.6601  512 40 23 0 0 0 0 0 0.509997 0
-# 0.999939 -8.56988e-05 2.18966    21.9572    10.9755    10.3810     4.7540     9.1298    -1.3138  4.0002   9.0487  515 43 25 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.25448    22.0292    11.0105    10.3940     4.9010     9.5435    -1.3308   3.998   9.4412  517 48 29 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.31931    22.1011    11.0530    10.4060     5.0545     9.9590    -1.3453  3.9997   9.8307  519 48 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.38414    22.1683    11.0820    10.4190     5.2180    10.3745    -1.3613  3.9977   10.223  521 42 23 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.44897    22.2413    11.1175    10.4335     5.3880    10.7918    -1.3748  3.9999   10.615  523 48 29 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.51379    22.3113    11.1500    10.4470     5.5685    11.2093    -1.3910   3.999   11.008  525 48 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.57862    22.3787    11.1850    10.4620     5.7560    11.6275    -1.4060  4.0002   11.399  527 47 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.64345    22.4432    11.2180    10.4770     5.9515    12.0480    -1.4228  3.9995   11.794  529 48 30 0 0 0 0 0 0.509997 0
 ###########################################################
-# convert pixel to hkl from the center pixel
-#pixels of interest
-Pix_x = 255
-Pix_y = 95
-
-#########
-Uarray = [3.023 4.609 9.963 90 90 90 2.078460241 1.363242636 0.6306519429 90 90 90 0 0 6 1 -1 3 -0.0002 -0.008 -2.59 1.9435 36.2778 15.309 26.6488 13.3275 9.021 -26.4045 13.88 -0.10275 1.0339 1.0339];
-angles = [22.3113    11.1500    10.4470     5.5685    11.2093    -1.3910 ];
-# get the angles needed for the geometry calcs
-# first parse the data needed to calc the UB matrix.
-cell = [Uarray(1:6)];     # cell parameters (real space)
-h_1 = [Uarray(13:15)];    # hkl of OR1
-h_2 = [Uarray(16:18)];    # hkl of OR2 
-
-# note see calc_U for how these should be parsed
-angle_1 = [Uarray(19:24)];   # motor settings for OR1
-angle_2 = [Uarray(25:30)];   # motor settings for OR2
-lam_1 = Uarray(31);          # lambda for OR1  
-lam_2 = Uarray(32);          # lambda for OR2 
-
-lam = 1.0339;
-k = 2*pi/lam;
-
-# sample det distance (mm)
-y =1500 ;
-
-# pixel dims (mm)
-del_pixel = 0.175;
-
-#center pixels 
-CenPix_x = 235;
-CenPix_y = 85;
-# pixel coords
-dx = (195 - CenPix_y) - (195 - Pix_y)
-dz = Pix_x  - CenPix_x
-
-# vector pointing to pixel
-p = [dx*del_pixel; y; dz*del_pixel];
-
-# normalized
-pn = p/sqrt((dx*del_pixel)^2 + y^2 + (dz*del_pixel)^2);
-v_mag(pn);
-
-# get rot matricies for detector arm
-nu = angles(5);
-del = angles(1);
-
-P = [  1,       0,         0    ;
-       0,   cosd(nu), -sind(nu) ;
-       0,   sind(nu),  cosd(nu) ];
-    
-D = [  cosd(del),   sind(del),   0 ;
-      -sind(del),   cosd(del),   0 ;
-          0     ,       0    ,   1 ];
-       
-
-# calc kr for center of det
-kr = P*D*[0;1;0];
-kr = k*kr;
-#should be same as
-#kr = k*[ sind(del)           ; 
-#         cosd(nu)*cosd(del)  ; 
-#         sind(nu)*cosd(del) ];
-
-# calc Q for center
-ki = k*[ 0 ;
-         1 ;
-         0 ];      
-Qm = kr - ki;
-tth = v_angle(ki,kr, [1 1 1 90 90 90]);
-
-# calc kr or rotated pixel vector 
-kr_p = P*D*pn;
-kr_p = k*kr_p;
-
-# calc Q for pixel
-Qm_p = kr_p - ki;
-tth_p = v_angle(ki,kr_p, [1 1 1 90 90 90]);
-
-# now we can calc hkl for the center and the pixel 
-# given Z and UB
- [Z,Qm,ki,kr,tth] = calc_Z_and_Q(angles,k);
-[U, UB] = calc_U(h_1, lam_1, angle_1, h_2, lam_2, angle_2, cell);
-h = (1/(2*pi))*inv(UB)*inv(Z)*Qm_p
-
-"""
-
+class HKLGrid:
+    """
+    Accumulate pixel intensities on a regular HKL grid
+    """
+    def __init__(self,ranges=[(0.,1.),(0.,1.),(0.,1.)],bins=(10,10,10)):
+        """
+        Parameters:
+        -----------
+        * ranges is a list of (min,max) for H, K and L
+        * bins is the number of grid cells along H, K and L
+        """
+        self.ranges = [tuple(map(float,r)) for r in ranges]
+        self.bins   = tuple([int(b) for b in bins])
+        self.edges  = [num.linspace(r[0],r[1],b+1)
+                       for r,b in zip(self.ranges,self.bins)]
+        self.centers = [0.5*(e[1:]+e[:-1]) for e in self.edges]
+        self.sum    = num.zeros(self.bins,dtype=float)
+        self.var    = num.zeros(self.bins,dtype=float)
+        self.counts = num.zeros(self.bins,dtype=float)
+
+    def _index(self,hkl):
+        hkl = num.asarray(hkl,dtype=float).reshape(-1,3)
+        idx = []
+        good = num.ones(len(hkl),dtype=bool)
+        for j in range(3):
+            (lo,hi) = self.ranges[j]
+            i = num.floor((hkl[:,j]-lo)/(hi-lo)*self.bins[j]).astype(int)
+            good = good & (i >= 0) & (i < self.bins[j])
+            idx.append(i)
+        flat = num.ravel_multi_index([i[good] for i in idx],self.bins)
+        return flat, good
+
+    def add(self,hkl,intensity,error=None,mask=None):
+        """
+        Add pixel intensities to the grid
+
+        Parameters:
+        -----------
+        * hkl is an array (...,3), eg from PixelQ.calc_hkl_scan
+        * intensity is the matching array of pixel intensities
+          (shape hkl.shape[:-1])
+        * error are optional pixel errors (default sqrt(intensity))
+        * mask is an optional array of good (True) pixels
+        """
+        I = num.asarray(intensity,dtype=float).ravel()
+        if error is None:
+            var = num.abs(I)
+        else:
+            var = num.asarray(error,dtype=float).ravel()**2
+        flat, good = self._index(hkl)
+        if mask is not None:
+            m = num.asarray(mask,dtype=bool)
+            m = num.broadcast_to(m,num.shape(intensity)).ravel()
+            keep = m[good]
+            flat = flat[keep]
+            good[good] = keep
+        n = self.sum.size
+        self.sum    += num.bincount(flat,weights=I[good],minlength=n).reshape(self.bins)
+        self.var    += num.bincount(flat,weights=var[good],minlength=n).reshape(self.bins)
+        self.counts += num.bincount(flat,minlength=n).reshape(self.bins)
+
+    def intensity(self):
+        """
+        Average intensity per grid cell (nan for empty cells)
+        """
+        return num.where(self.counts > 0,self.sum/num.maximum(self.counts,1),num.nan)
+
+    def error(self):
+        """
+        Propagated error of the average intensity
+        """
+        return num.where(self.counts > 0,
+                         num.sqrt(self.var)/num.maximum(self.counts,1),num.nan)
+
+def bin_scan(images,angles,UB,lam,pixelq,ranges,bins,mask=None,nframes=10):
+    """
+    Grid the images of a scan in HKL
+
+    Parameters:
+    -----------
+    * images is an array (N,nrows,ncols) (or a list of images)
+    * angles is an (N x 6) array ordered as PSIC_ANGLES
+    * UB, lam orientation matrix and wavelength
+    * pixelq is a PixelQ instance for the detector
+    * ranges, bins define the HKL grid (see HKLGrid)
+    * mask is an optional (nrows,ncols) array of good pixels
+
+    Returns an HKLGrid instance
+    """
+    grid = HKLGrid(ranges=ranges,bins=bins)
+    for idx, hkl in pixelq.iter_hkl_scan(angles,UB,lam,nframes=nframes):
+        I = num.asarray(images[idx],dtype=float)
+        grid.add(hkl,I,mask=mask)
+    return grid
 
+###########################################################
+def test():
+    """
+    The center pixel hkl should be the same as the
+    gonio h for the same angles
+    """
+    from tdl.modules.geom.gonio_psic import test2
+    psic = test2(show=False)
+    pq = PixelQ(shape=(195,487),distance=1000.,pixel_size=0.172,
+                center=(97,243))
+    h = pq.calc_hkl(psic.angles,psic.UB,psic.lattice.lam)
+    print "center pixel hkl:", h[97,243]
+    print "gonio hkl:       ", psic.h
+    return pq
+
+if __name__ == "__main__":
+    test()
@@ -13,6 +13,15 @@ Todo:
 * Add some more polygon calcs
   - compute center
   - determine type (simple, complex etc)
+
+Notes:
+------
+The *_array functions operate on stacks of polygons, stored as
+(N x M x 2) arrays of [x,y] points.  Polygons with fewer than M
+points are padded with nan (see poly_array).  Intersections are
+computed by Sutherland-Hodgman clipping against convex polygons,
+and the area inside a circle (centered on the origin) is computed
+in closed form, ie there is no numerical integration.
 """
 ##########################################################################
 
@@ -445,6 +454,213 @@ def poly_y_intercepts(polygon):
             intercepts.append(intercept)
     return intercepts
 
+##########################################################################
+def poly_array(polygons):
+    """
+    Stack polygons into an (N x M x 2) array
+
+    Parameters:
+    -----------
+    * polygons is a list of polygons (each a list of [x,y] points),
+      a single polygon, or an (N x M x 2(3)) array
+
+    Notes:
+    ------
+    Polygons with less than M points are padded with nan.  Only
+    the first two components of each point are used.
+    """
+    if isinstance(polygons,num.ndarray) and polygons.ndim == 3:
+        return num.array(polygons[:,:,0:2],dtype=float)
+    polygons = list(polygons)
+    if len(polygons) == 0:
+        return num.zeros((0,0,2),dtype=float)
+    if num.ndim(polygons[0]) == 1:
+        polygons = [polygons]
+    npts = max([len(p) for p in polygons])
+    P = num.empty((len(polygons),npts,2),dtype=float)
+    P.fill(num.nan)
+    for j in range(len(polygons)):
+        if len(polygons[j]) > 0:
+            P[j,:len(polygons[j])] = [v[0:2] for v in polygons[j]]
+    return P
+
+def _take(P,idx):
+    """ P[n,idx[n,j]] for each polygon n """
+    return P[num.arange(len(P))[:,num.newaxis],idx]
+
+def _npts(P):
+    return num.sum(~num.isnan(P[:,:,0]),axis=1)
+
+def _next_idx(P):
+    """ index of the next point of each polygon (cyclic) """
+    npts = _npts(P)[:,num.newaxis]
+    idx  = num.arange(P.shape[1])[num.newaxis,:] + 1
+    return num.where(idx >= npts,0,idx)
+
+def _prev_idx(P):
+    """ index of the previous point of each polygon (cyclic) """
+    npts = _npts(P)[:,num.newaxis]
+    idx  = num.arange(P.shape[1])[num.newaxis,:] - 1
+    return num.where(idx < 0,npts-1,idx) % max(P.shape[1],1)
+
+def sort_polygons(P):
+    """
+    Sort the points of each polygon according to angle
+    (ccw w/r/t x-axis), see sort_points
+    """
+    P = poly_array(P)
+    angle = num.arctan2(P[:,:,1],P[:,:,0]) % (2.*num.pi)
+    # nan padding is sorted to the end
+    return _take(P,num.argsort(angle,axis=1,kind='mergesort'))
+
+def _signed_area(P):
+    Q = _take(P,_next_idx(P))
+    a = P[:,:,0]*Q[:,:,1] - Q[:,:,0]*P[:,:,1]
+    return 0.5*num.sum(num.where(num.isnan(a),0.,a),axis=1)
+
+def orient_ccw(P):
+    """
+    Reverse the point order of each polygon that is
+    traversed clockwise
+    """
+    P = poly_array(P)
+    npts = _npts(P)[:,num.newaxis]
+    j    = num.arange(P.shape[1])[num.newaxis,:]
+    idx  = num.where(j < npts,npts-1-j,j)
+    cw   = _signed_area(P) < 0.
+    P[cw] = _take(P[cw],idx[cw])
+    return P
+
+def poly_area_array(P,sort=False):
+    """
+    Area of each polygon of a stack of polygons (N x M x 2)
+
+    The points must be in order around the polygon unless sort
+    is True, in which case they are sorted by angle (see poly_area)
+    """
+    P = poly_array(P)
+    if sort == True: P = sort_polygons(P)
+    return num.abs(_signed_area(P))
+
+def _clip_edge(P,a,b):
+    """
+    Clip polygons P (N x M x 2) to the left side of the lines
+    through a and b (N x 2), ie one Sutherland-Hodgman step
+    """
+    (n,m) = P.shape[0:2]
+    if m == 0: return P
+    e  = b - a
+    s  = e[:,num.newaxis,0]*(P[:,:,1] - a[:,num.newaxis,1]) - \
+         e[:,num.newaxis,1]*(P[:,:,0] - a[:,num.newaxis,0])
+    prev = _prev_idx(P)
+    Pp = _take(P,prev)
+    sp = _take(s,prev)
+    valid = ~num.isnan(s)
+    cin   = valid & (s >= 0.)
+    pin   = valid & (sp >= 0.)
+    cross = valid & (cin != pin)
+    # each point gives the edge intercept (if the edge crosses
+    # the line) followed by the point itself (if inside)
+    t = num.where(cross,sp/num.where(cross,sp - s,1.),0.)
+    out = num.empty((n,m,2,2),dtype=float)
+    out[:,:,0] = Pp + t[:,:,num.newaxis]*(P - Pp)
+    out[:,:,1] = P
+    keep = num.concatenate((cross[:,:,num.newaxis],cin[:,:,num.newaxis]),axis=2)
+    out  = out.reshape(n,2*m,2)
+    keep = keep.reshape(n,2*m)
+    order = num.argsort(~keep,axis=1,kind='mergesort')
+    out   = _take(out,order)
+    keep  = _take(keep,order)
+    out[~keep] = num.nan
+    return out[:,:max(num.max(num.sum(keep,axis=1)),1)]
+
+def clip_polygons(subject,clip):
+    """
+    Intersection of polygons by Sutherland-Hodgman clipping
+
+    Parameters:
+    -----------
+    * subject is a polygon or stack of polygons (see poly_array),
+      these may be concave
+    * clip is a convex polygon or a stack of convex polygons, all
+      with the same number of points (in order around the polygon,
+      either direction)
+
+    Output:
+    -------
+    * (N x M x 2) array of the intersection polygons (nan padded).
+      A single subject or clip polygon is used with each polygon
+      of the other stack.  For a concave subject the result can
+      include zero width edges, the area is still exact.
+    """
+    S = poly_array(subject)
+    C = orient_ccw(poly_array(clip))
+    if len(S) == 1 and len(C) > 1:
+        S = S.repeat(len(C),axis=0)
+    elif len(C) == 1 and len(S) > 1:
+        C = C.repeat(len(S),axis=0)
+    old = num.seterr(invalid='ignore')
+    try:
+        ncl = C.shape[1]
+        for k in range(ncl):
+            S = _clip_edge(S,C[:,k],C[:,(k+1) % ncl])
+    finally:
+        num.seterr(**old)
+    return S
+
+def circle_poly_area(P,diameter):
+    """
+    Area of each polygon inside a circle (centered on the
+    origin) of the given diameter, computed exactly.
+
+    Parameters:
+    -----------
+    * P is a polygon or stack of polygons (see poly_array),
+      points in order around the polygon
+    * diameter is a number or array of N diameters
+
+    Notes:
+    ------
+    The area is summed over the triangles formed by the origin
+    and each polygon edge.  Each edge is split at its intercepts
+    with the circle, parts inside contribute a triangle and parts
+    outside a circular sector.
+    """
+    P  = poly_array(P)
+    r2 = (num.asarray(diameter,dtype=float)/2.)**2.
+    if r2.ndim == 1: r2 = r2[:,num.newaxis]
+    A  = P
+    B  = _take(P,_next_idx(P))
+    d  = B - A
+    dd = num.sum(d*d,axis=2)
+    ad = num.sum(A*d,axis=2)
+    aa = num.sum(A*A,axis=2)
+    old = num.seterr(invalid='ignore')
+    try:
+        disc = ad**2. - dd*(aa - r2)
+        ok = (disc > 0.) & (dd > 0.)
+        sq = num.sqrt(num.where(ok,disc,0.))
+        dd = num.where(ok,dd,1.)
+        ta = num.clip(num.where(ok,(-ad - sq)/dd,1.),0.,1.)[:,:,num.newaxis]
+        tb = num.clip(num.where(ok,(-ad + sq)/dd,1.),0.,1.)[:,:,num.newaxis]
+        Pa = A + ta*d
+        Pb = A + tb*d
+        cross = lambda u,v: u[:,:,0]*v[:,:,1] - u[:,:,1]*v[:,:,0]
+        dot   = lambda u,v: u[:,:,0]*v[:,:,0] + u[:,:,1]*v[:,:,1]
+        a = 0.5*r2*num.arctan2(cross(A,Pa),dot(A,Pa)) + \
+            0.5*cross(Pa,Pb) + \
+            0.5*r2*num.arctan2(cross(Pb,B),dot(Pb,B))
+    finally:
+        num.seterr(**old)
+    return num.abs(num.sum(num.where(num.isnan(a),0.,a),axis=1))
+
+def poly_points(P):
+    """
+    list of [x,y] points of a (nan padded) polygon array row
+    """
+    P = num.asarray(P)
+    return [p for p in P if not num.isnan(p[0])]
+
 ##########################################################################
 def trans_point(p,theta=0.,scale=1.):
     """
@@ -557,6 +773,9 @@ def test():
     print 'inner area = %6.3f, num=%6.3f' % (poly_area(inner),
                                              poly_area_num(inner,num_int=n,
                                              diameter=diameter,plot=True))
+    clip = clip_polygons(sort_polygons(poly1),poly2)
+    print 'clipped area = %6.3f, in circle=%6.3f' % (poly_area_array(clip)[0],
+                                                  circle_poly_area(clip,diameter)[0])
     #
     plot_polygon(poly1,fmt='ro-')
     plot_polygon(poly2,fmt='ko-')
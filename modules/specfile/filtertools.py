@@ -6,6 +6,10 @@ Author: Craig Biwer (cbiwer@uchicago.edu)
 
 import h5py
 import numpy
+import ast
+import operator
+import os
+import re
 
 # Given two dates, checks that the first comes before the second
 # Format: 'Day Month Date Time Year', e.g. 'Mon Jan 12 08:42:32 2011'
@@ -51,6 +55,462 @@ def list_intersect(*args):
         intersect = intersect.intersection(entry)
     return list(intersect)
 
+# Query language
+# A query is one or more comparisons of a scan attribute / label with a
+# value, combined with and / or / not and parentheses, e.g.
+#     s_type == "rodscan" and (L < 2.5 or not H in (0, 1))
+# Comparisons are ==, !=, <, <=, >, >=, in and not in.  Values are numbers,
+# quoted strings, True / False or lists / tuples of these (for in).
+# Labels may start with a digit (e.g. 2theta), labels with spaces or
+# punctuation must be quoted.
+# Queries are parsed into predicate trees (never passed to eval) and the
+# predicates are evaluated as numpy masks over all scans or all points.
+# A scan / point without the label, or whose value is of the other kind
+# (string vs number), never passes a comparison on that label, negated
+# or not: 'not L < 2', 'L >= 2' and 'L not in (0, 1)' all skip scans
+# without an L.
+_WORD = r'''[^\s()\[\],=!<>"']'''
+_TOKENS = re.compile(r'''\s*(?:(?P<str>"[^"]*"|'[^']*')|''' +
+                     r'''(?P<num>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?!''' +
+                     _WORD + r''')|(?P<op>==|!=|<=|>=|<|>)|(?P<punct>[()\[\],])|''' +
+                     r'''(?P<word>''' + _WORD + r'''+))''')
+_COMPARE = {'==': operator.eq, '!=': operator.ne,
+            '<': operator.lt, '<=': operator.le,
+            '>': operator.gt, '>=': operator.ge}
+_QUERIES = {}
+
+# A comparison of one attribute / label with a value
+class Predicate:
+    '''
+    label op value, where op is one of ==, !=, <, <=, >, >=, in, not in
+    '''
+    def __init__(self, label, op, value):
+        if op not in _COMPARE and op not in ('in', 'not in'):
+            raise ValueError('Unrecognized comparison: ' + str(op))
+        self.label = label
+        self.op = op
+        self.value = value
+    def __repr__(self):
+        return '%s %s %s' % (self.label, self.op, repr(self.value))
+    def __and__(self, other):
+        return And(self, other)
+    def __or__(self, other):
+        return Or(self, other)
+    def __invert__(self):
+        return Not(self)
+    def labels(self):
+        return [self.label]
+    def mask(self, index, level='scan'):
+        return self.masks(index, level)[0]
+    # (passes, fails) masks, entries without a comparable value are in
+    # neither
+    def masks(self, index, level='scan'):
+        col = index.column(self.label, level)
+        if self.op in ('in', 'not in'):
+            has = numpy.zeros(len(col), dtype=bool)
+            test = numpy.zeros(len(col), dtype=bool)
+            choices = [v for v in self.value if isinstance(v, basestring)]
+            if len(choices) > 0:
+                has = has | col.str_has
+                test = test | (col.str_has & numpy.in1d(col.str, choices))
+            choices = [v for v in self.value if not isinstance(v, basestring)]
+            if len(choices) > 0:
+                has = has | col.num_has
+                test = test | (col.num_has & numpy.in1d(col.num, choices))
+            if self.op == 'not in':
+                test = has & ~test
+        else:
+            if isinstance(self.value, basestring):
+                (values, has) = (col.str, col.str_has)
+            else:
+                (values, has) = (col.num, col.num_has)
+            err = numpy.seterr(invalid='ignore')
+            test = has & _COMPARE[self.op](values, self.value)
+            numpy.seterr(**err)
+        return (test, has & ~test)
+
+# Compound predicates
+class And(Predicate):
+    '''
+    True where all the predicates are True
+    '''
+    def __init__(self, *args):
+        self.args = list(args)
+    def __repr__(self):
+        return '(' + ' and '.join([repr(a) for a in self.args]) + ')'
+    def labels(self):
+        return [lbl for a in self.args for lbl in a.labels()]
+    def masks(self, index, level='scan'):
+        (passes, fails) = self.args[0].masks(index, level)
+        for a in self.args[1:]:
+            (p, f) = a.masks(index, level)
+            (passes, fails) = (passes & p, fails | f)
+        return (passes, fails)
+
+class Or(And):
+    '''
+    True where any of the predicates is True
+    '''
+    def __repr__(self):
+        return '(' + ' or '.join([repr(a) for a in self.args]) + ')'
+    def masks(self, index, level='scan'):
+        (passes, fails) = self.args[0].masks(index, level)
+        for a in self.args[1:]:
+            (p, f) = a.masks(index, level)
+            (passes, fails) = (passes | p, fails & f)
+        return (passes, fails)
+
+class Not(And):
+    '''
+    True where the predicate is False
+    '''
+    def __repr__(self):
+        return 'not ' + repr(self.args[0])
+    def masks(self, index, level='scan'):
+        (passes, fails) = self.args[0].masks(index, level)
+        return (fails, passes)
+
+# Splits a query string into (kind, text) tokens
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKENS.match(text, pos)
+        if match is None or match.end() == pos:
+            raise ValueError('Cannot parse query at: ' + text[pos:])
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'word' and value.lower() in ('and', 'or', 'not', 'in'):
+            kind = value.lower()
+        tokens.append((kind, value))
+    return tokens
+
+# Recursive descent parser for the query language
+class _Parser:
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+    def next(self, kind=None, value=None):
+        token = self.peek()
+        if token[0] is None:
+            raise ValueError('Unexpected end of query')
+        if (kind is not None and token[0] != kind) or \
+           (value is not None and token[1] != value):
+            raise ValueError('Unexpected ' + str(token[1]) + ' in query')
+        self.pos += 1
+        return token
+    def parse(self):
+        node = self.expr()
+        if self.pos != len(self.tokens):
+            raise ValueError('Unexpected ' + str(self.peek()[1]) + ' in query')
+        return node
+    def expr(self):
+        args = [self.term()]
+        while self.peek()[0] == 'or':
+            self.next()
+            args.append(self.term())
+        if len(args) == 1:
+            return args[0]
+        return Or(*args)
+    def term(self):
+        args = [self.factor()]
+        while self.peek()[0] == 'and':
+            self.next()
+            args.append(self.factor())
+        if len(args) == 1:
+            return args[0]
+        return And(*args)
+    def factor(self):
+        (kind, value) = self.peek()
+        if kind == 'not':
+            self.next()
+            return Not(self.factor())
+        if kind == 'punct' and value == '(':
+            self.next()
+            node = self.expr()
+            self.next('punct', ')')
+            return node
+        label = self.label()
+        (kind, value) = self.next()
+        if kind == 'op':
+            return Predicate(label, value, self.value())
+        if kind == 'in':
+            return Predicate(label, 'in', self.values())
+        if kind == 'not':
+            self.next('in')
+            return Predicate(label, 'not in', self.values())
+        raise ValueError('Expected a comparison after ' + label)
+    def label(self):
+        (kind, value) = self.next()
+        if kind in ('word', 'num'):
+            return value
+        if kind == 'str':
+            return value[1:-1]
+        raise ValueError('Expected an attribute or label, got ' + str(value))
+    def value(self):
+        (kind, value) = self.next()
+        if kind == 'str':
+            return value[1:-1]
+        if kind == 'num':
+            return float(ast.literal_eval(value.lstrip('+')))
+        if kind == 'word':
+            if value in ('True', 'False'):
+                return float(value == 'True')
+            return value
+        raise ValueError('Expected a value, got ' + str(value))
+    def values(self):
+        (kind, value) = self.peek()
+        if not (kind == 'punct' and value in ('(', '[')):
+            return [self.value()]
+        close = {'(': ')', '[': ']'}[self.next()[1]]
+        values = []
+        while self.peek()[1] != close:
+            values.append(self.value())
+            if self.peek()[1] == ',':
+                self.next()
+        self.next('punct', close)
+        return values
+
+# Parses (and caches) a query string
+def compile_query(query):
+    '''
+    Returns the predicate tree of a query string (see the query language
+    above).  Predicates are returned unchanged.  Raises ValueError if the
+    query cannot be parsed
+    '''
+    if isinstance(query, Predicate):
+        return query
+    if query not in _QUERIES:
+        _QUERIES[query] = _Parser(query).parse()
+    return _QUERIES[query]
+
+# Columnar index of the scans in a master h5 file
+class FilterIndex:
+    '''
+    Scan attributes, param labels and point labels of all the scans in a
+    master file, stored as one column per attribute / label.
+
+    Scan level columns have one entry per scan, point level columns one
+    entry per point (of all scans).  Each column keeps the numeric values
+    (float array) and the string values (string array) with masks of the
+    entries that have a value of that kind (see _Column).  The point data
+    are read the first time a point level query is made.
+    '''
+    def __init__(self, in_here):
+        self.h5file = in_here
+        self.paths = []
+        attrs = {}
+        params = {}
+        for spec, group in in_here.items():
+            for number, scan in group.items():
+                j = len(self.paths)
+                self.paths.append(scan.name)
+                for (key, value) in scan.attrs.items():
+                    attrs.setdefault(key, []).append((j, value))
+                if 'param_labs' in scan and 'param_data' in scan:
+                    labs = list(scan['param_labs'][...])
+                    data = scan['param_data'][...]
+                    for k in range(min(len(labs), len(data))):
+                        if labs.index(labs[k]) == k:
+                            params.setdefault(labs[k], []).append((j, data[k]))
+        self.paths = numpy.array(self.paths)
+        self.nscan = len(self.paths)
+        self.attrs = {}
+        for key in attrs:
+            self.attrs[key] = _make_column(attrs[key], self.nscan)
+        self.params = {}
+        for key in params:
+            self.params[key] = _make_column(params[key], self.nscan)
+        self.points = None
+        self._scan_cols = {}
+        self._point_cols = {}
+
+    def __repr__(self):
+        lout = 'FilterIndex: %i scans, %i attributes, %i params' % \
+               (self.nscan, len(self.attrs), len(self.params))
+        if self.points is not None:
+            lout = lout + ', %i points, %i point labels' % \
+                   (self.npoint, len(self.points))
+        return lout
+
+    # Reads the point labels / data of all scans
+    def _init_points(self):
+        self.npts = numpy.zeros(self.nscan, dtype=int)
+        cols = {}
+        for j in range(self.nscan):
+            scan = self.h5file[self.paths[j]]
+            if 'point_data' not in scan:
+                continue
+            data = numpy.asarray(scan['point_data'][...])
+            if data.ndim == 1:
+                data = data.reshape((len(data), 1))
+            self.npts[j] = len(data)
+            if 'point_labs' not in scan:
+                continue
+            labs = list(scan['point_labs'][...])
+            for k in range(min(len(labs), data.shape[1])):
+                if labs.index(labs[k]) == k:
+                    cols.setdefault(labs[k], []).append((j, data[:, k]))
+        self.first = numpy.cumsum(self.npts) - self.npts
+        self.npoint = int(numpy.sum(self.npts))
+        self.point_scan = numpy.repeat(numpy.arange(self.nscan), self.npts)
+        self.point_index = numpy.arange(self.npoint) - \
+                           self.first[self.point_scan]
+        self.points = {}
+        for key in cols:
+            col = _Column(self.npoint)
+            for (j, data) in cols[key]:
+                sl = slice(self.first[j], self.first[j] + self.npts[j])
+                col.num[sl] = data
+                col.num_has[sl] = True
+            self.points[key] = col
+
+    def labels(self, level='scan'):
+        '''
+        Sorted list of the attributes / labels that can be queried
+        '''
+        labels = set(self.attrs.keys()) | set(self.params.keys())
+        if level == 'point':
+            if self.points is None:
+                self._init_points()
+            labels = labels | set(self.points.keys())
+        return sorted(labels)
+
+    def column(self, label, level='scan'):
+        '''
+        Returns the _Column of the attribute / label.  At the scan
+        level scan attributes take precedence over param labels.  At
+        the point level scan attributes take precedence over point
+        labels, which take precedence over param labels (scan values
+        apply to all the points of the scan)
+        '''
+        if level == 'scan':
+            if label not in self._scan_cols:
+                self._scan_cols[label] = _merge_columns(
+                    [self.attrs.get(label), self.params.get(label)],
+                    self.nscan)
+            return self._scan_cols[label]
+        elif level == 'point':
+            if self.points is None:
+                self._init_points()
+            if label not in self._point_cols:
+                cols = []
+                for col in (self.attrs.get(label), None,
+                            self.params.get(label)):
+                    if col is not None:
+                        col = col.take(self.point_scan)
+                    cols.append(col)
+                cols[1] = self.points.get(label)
+                self._point_cols[label] = _merge_columns(cols, self.npoint)
+            return self._point_cols[label]
+        raise ValueError('Unrecognized filter level: ' + str(level))
+
+    def mask(self, query, level='scan'):
+        '''
+        Boolean mask of the scans / points that pass the query
+        '''
+        return compile_query(query).mask(self, level)
+
+    def select(self, query, level='scan'):
+        '''
+        Returns the array of paths of the scans that pass the query
+        (level='scan'), or the arrays (paths, indices) of the points
+        that pass (level='point')
+        '''
+        mask = self.mask(query, level)
+        if level == 'scan':
+            return self.paths[mask]
+        return (self.paths[self.point_scan[mask]], self.point_index[mask])
+
+# One attribute / label column, a column may hold numbers for some
+# entries and strings for others
+class _Column:
+    '''
+    num / str are the numeric / string values, num_has / str_has the
+    masks of the entries with a value of that kind
+    '''
+    def __init__(self, n):
+        self.num = numpy.zeros(n) + numpy.nan
+        self.num_has = numpy.zeros(n, dtype=bool)
+        self.str = numpy.array([''] * n, dtype=object).astype(str)
+        self.str_has = numpy.zeros(n, dtype=bool)
+    def __len__(self):
+        return len(self.num)
+    def has(self):
+        return self.num_has | self.str_has
+    def take(self, idx):
+        col = _Column(0)
+        col.num = self.num[idx]
+        col.num_has = self.num_has[idx]
+        col.str = self.str[idx]
+        col.str_has = self.str_has[idx]
+        return col
+
+# Builds a column from a list of (scan index, value) pairs
+def _make_column(entries, n):
+    col = _Column(n)
+    strs = numpy.array([''] * n, dtype=object)
+    for (j, v) in entries:
+        if isinstance(v, basestring):
+            strs[j] = v
+            col.str_has[j] = True
+        elif numpy.isscalar(v) and numpy.asarray(v).dtype.kind in 'biuf':
+            col.num[j] = v
+            col.num_has[j] = True
+    col.str = strs.astype(str)
+    return col
+
+# Combines columns, earlier columns take precedence
+def _merge_columns(cols, n):
+    cols = [c for c in cols if c is not None]
+    if len(cols) == 1:
+        return cols[0]
+    col = _Column(n)
+    strs = numpy.array([''] * n, dtype=object)
+    for c in cols[::-1]:
+        h = c.has()
+        col.num[h] = c.num[h]
+        col.num_has[h] = c.num_has[h]
+        strs[h] = c.str[h]
+        col.str_has[h] = c.str_has[h]
+    col.str = strs.astype(str)
+    return col
+
+# Returns the (cached) index of an opened h5 file
+_INDEX = {}
+def get_index(in_here, refresh=False):
+    '''
+    Returns the FilterIndex of the opened h5 file.  Indexes are cached
+    by file name and modification time, use refresh=True to rebuild
+    '''
+    fname = os.path.abspath(in_here.filename)
+    try:
+        mtime = os.path.getmtime(fname)
+    except OSError:
+        mtime = None
+    key = (fname, mtime)
+    if refresh or key not in _INDEX or _INDEX[key].h5file != in_here:
+        for old in [k for k in _INDEX if k[0] == fname]:
+            del _INDEX[old]
+        _INDEX[key] = FilterIndex(in_here)
+    return _INDEX[key]
+
+# Filters the scans / points of an opened h5 file with a query string
+def query(in_here, such_that, this_level='scan'):
+    '''
+    Returns the array of paths (this_level='scan') or the arrays
+    (paths, indices) (this_level='point') of the scans / points in the
+    opened h5 file that pass the query, e.g.
+        query(f, 's_type == "rodscan" and L > 0.5', 'point')
+    '''
+    return get_index(in_here).select(such_that, this_level)
+
 # The heart of the filtering process
 # Given an opened h5 file, filters on the given criteria
 # and returns a list of the matched scans / points
@@ -63,7 +523,9 @@ def cases(in_here, of_this, such_that, this_level='scan'):
     in_here is the opened h5 file [f = h5py.File(<filename>, 'r')]
     of_this is the attribute / label to filter
     such_that is the criteria you want the filtered variable to pass
-        eg '< 1.4' or '== "rodscan"' (note the quotes: this is passed to eval)
+        eg '< 1.4' or '== "rodscan"' (note the quotes), or 'in (1, 2)'.
+        This may also continue the query, eg '> 1 and L < 2' (see the
+        query language above)
     this_level is the sensitivity of the filter:
         scan: default; checks the attribute / label of_this against such_that
         point: checks all the points and returns only those that match
@@ -72,93 +534,24 @@ def cases(in_here, of_this, such_that, this_level='scan'):
     If this_level is point, returns a list of (path, index) tuples
     '''
     
-    if isinstance(in_here, h5py.File):
-        all_possible = []
-        for spec, group in in_here.items():
-            for number, scan in group.items():
-                all_possible.append(scan.name)
-    else:
+    if not isinstance(in_here, h5py.File):
         print 'Error: input file not recognized'
         return None
-    
-    return_this = []
-    if this_level == 'scan':
-        for scan in all_possible:
-            this_ind = None
-            this_value = None
-            if in_here[scan].attrs.get(of_this, None) is not None:
-                this_value = in_here[scan].attrs.get(of_this)
-            elif of_this in in_here[scan]['param_labs']:
-                this_ind = list(in_here[scan]['param_labs']).index(of_this)
-                this_value = in_here[scan]['param_data'][this_ind]
-            '''
-            else:
-                print 'Error: Unrecognized attribute or label'
-                return None
-            '''
-            if this_value is None:
-                pass
-            elif isinstance(this_value, basestring):
-                if eval('"' + this_value + '" ' + such_that):
-                    return_this.append(scan)
-            elif isinstance(this_value, (int, float, bool, numpy.bool_)):
-                if eval(str(this_value) + " " + such_that):
-                    return_this.append(scan)
-            else:
-                print 'Error: Unrecognized type'
-                print this_value
-                return None
-        return return_this
-                
-    elif this_level == 'point':
-        for scan in all_possible:
-            this_ind = None
-            this_value = None
-            if in_here[scan].attrs.get(of_this, None) is not None:
-                this_value = in_here[scan].attrs.get(of_this)
-                if isinstance(this_value, basestring):
-                    if eval('"' + this_value + '" ' + such_that):
-                        for i in range(len(in_here[scan]['point_data'])):
-                            return_this.append((scan, i))
-                elif isinstance(this_value, (int, float, bool, numpy.bool_)):
-                    if eval(str(this_value) + " " + such_that):
-                        for i in range(len(in_here[scan]['point_data'])):
-                            return_this.append((scan, i))
-                else:
-                    print 'Error: Unrecognized type'
-                    print this_value
-                    return None
-            elif of_this in in_here[scan]['point_labs']:
-                this_ind = list(in_here[scan]['point_labs']).index(of_this)
-                for i in range(len(in_here[scan]['point_data'])):
-                    this_value = in_here[scan]['point_data'][i][this_ind]
-                    if isinstance(this_value, basestring):
-                        if eval('"' + this_value + '" ' + such_that):
-                            return_this.append((scan, i))
-                    elif isinstance(this_value,
-                                    (int, float, bool, numpy.bool_)):
-                        if eval(str(this_value) + " " + such_that):
-                            return_this.append((scan, i))
-                    else:
-                        print 'Error: Unrecognized type'
-                        print this_value
-                        return None
-            elif of_this in in_here[scan]['param_labs']:
-                this_ind = list(in_here[scan]['param_labs']).index(of_this)
-                this_value = in_here[scan]['param_data'][this_ind]
-                if isinstance(this_value, basestring):
-                    if eval('"' + this_value + '" ' + such_that):
-                        for i in range(len(in_here[scan]['point_data'])):
-                            return_this.append((scan, i))
-                elif isinstance(this_value, (int, float, bool, numpy.bool_)):
-                    if eval(str(this_value) + " " + such_that):
-                        for i in range(len(in_here[scan]['point_data'])):
-                            return_this.append((scan, i))
-                else:
-                    print 'Error: Unrecognized type'
-                    print this_value
-                    return None
-        return return_this
-    else:
+    if this_level not in ('scan', 'point'):
         print 'Error: unrecognized filter level'
-        return None
\ No newline at end of file
+        return None
+    if re.match(_WORD + '+$', of_this) is None or \
+       of_this.lower() in ('and', 'or', 'not', 'in'):
+        if '"' in of_this:
+            of_this = "'" + of_this + "'"
+        else:
+            of_this = '"' + of_this + '"'
+    try:
+        such_that = compile_query(of_this + ' ' + such_that)
+    except ValueError as e:
+        print 'Error: ' + str(e)
+        return None
+    result = get_index(in_here).select(such_that, this_level)
+    if this_level == 'scan':
+        return list(result)
+    return zip(list(result[0]), [int(i) for i in result[1]])
@@ -14,6 +14,7 @@ import random
 import wx
 
 from tdl.modules.xtal.bv_params import bv_params
+from tdl.modules.xtab.atomic import f0_table
 
 try:
     import pp
@@ -65,18 +66,7 @@ def rigid_body_rotation(atoms, theta, phi, chi, cell):
     R_chi   = Num.array([[1,0,0],[0,Num.cos(chi),-Num.sin(chi)],\
                          [0,Num.sin(chi),Num.cos(chi)]],float)
     R  = Num.dot(R_theta,Num.dot(R_phi,R_chi))
-    def calcM(cell):
-        alpha = Num.radians(cell[3])
-        beta = Num.radians(cell[4])
-        gamma = Num.radians(cell[5])
-        x = Num.cos(beta)*cell[2]
-        y = Num.cos(alpha)*cell[2]*Num.cos(Num.pi/2-gamma)
-        z = (cell[2]**2-x**2-y**2)**0.5
-        M = Num.array([[cell[0],0,0],\
-                       [Num.cos(gamma)*cell[1],Num.cos(Num.pi/2-gamma)*cell[1],0],\
-                       [x,y,z]],float)
-        return M
-    P = calcM(cell)
+    P = calc_M(cell)
     R = Num.dot(Num.dot(P,R),Num.linalg.inv(P))
     new_atoms = []
     for atom in atoms:
@@ -87,18 +77,82 @@ def rigid_body_rotation(atoms, theta, phi, chi, cell):
         new_atoms.append(new_atom)
     return new_atoms
 
+def calc_M(cell):
+    alpha = Num.radians(cell[3])
+    beta = Num.radians(cell[4])
+    gamma = Num.radians(cell[5])
+    x = Num.cos(beta)*cell[2]
+    y = Num.cos(alpha)*cell[2]*Num.cos(Num.pi/2-gamma)
+    z = (cell[2]**2-x**2-y**2)**0.5
+    M = Num.array([[cell[0],0,0],\
+                   [Num.cos(gamma)*cell[1],Num.cos(Num.pi/2-gamma)*cell[1],0],\
+                   [x,y,z]],float)
+    return M
+
+def RB_rotations(rigid_bodies, parameter, cell):
+    """
+    rotation matrices (n_bodies x 3 x 3) of all rigid bodies in
+    fractional coordinates, built as stacked arrays (same as in
+    rigid_body_rotation)
+    """
+    angles = Num.array([[RB.angles[0] * parameter[RB.angles[1]][0],\
+                         RB.angles[2] * parameter[RB.angles[3]][0],\
+                         RB.angles[4] * parameter[RB.angles[5]][0]]\
+                        for RB in rigid_bodies],float).reshape(-1,3)
+    angles = Num.radians(angles)
+    c = Num.cos(angles)
+    s = Num.sin(angles)
+    n = len(angles)
+    R_theta = Num.zeros((n,3,3),float)
+    R_theta[:,0,0] = c[:,0]
+    R_theta[:,0,1] = -s[:,0]
+    R_theta[:,1,0] = s[:,0]
+    R_theta[:,1,1] = c[:,0]
+    R_theta[:,2,2] = 1
+    R_phi = Num.zeros((n,3,3),float)
+    R_phi[:,0,0] = c[:,1]
+    R_phi[:,0,2] = -s[:,1]
+    R_phi[:,1,1] = 1
+    R_phi[:,2,0] = s[:,1]
+    R_phi[:,2,2] = c[:,1]
+    R_chi = Num.zeros((n,3,3),float)
+    R_chi[:,0,0] = 1
+    R_chi[:,1,1] = c[:,2]
+    R_chi[:,1,2] = -s[:,2]
+    R_chi[:,2,1] = s[:,2]
+    R_chi[:,2,2] = c[:,2]
+    R = Num.matmul(R_theta, Num.matmul(R_phi, R_chi))
+    P = calc_M(cell)
+    return Num.matmul(Num.matmul(P, R), Num.linalg.inv(P))
+
+def RB_transform(rigid_bodies, xyz, parameter, cell):
+    """
+    apply the rigid body rotations (about the first atom of each
+    body) to an array of positions (n_atoms x 3), returns a new
+    array.  If bodies share atoms the last body wins (as in the
+    sequential update)
+    """
+    xyz = Num.array(xyz, float)
+    if len(rigid_bodies) == 0: return xyz
+    R = RB_rotations(rigid_bodies, parameter, cell)
+    idx = Num.array([i for RB in rigid_bodies for i in RB.atoms], int)
+    body = Num.array([b for b in range(len(rigid_bodies))\
+                      for i in rigid_bodies[b].atoms], int)
+    first = Num.array([RB.atoms[0] for RB in rigid_bodies], int)
+    centers = xyz[first][body]
+    coords = xyz[idx] - centers
+    xyz[idx] = Num.sum(coords[:,:,Num.newaxis] * R[body], axis=1) + centers
+    return xyz
+
 def RB_update(rigid_bodies, surface, parameter, cell):
     surface_new = surface[:]
-    for RB in rigid_bodies:
-        atoms = []
-        for i in RB.atoms:
-            atoms.append(surface[i])
-        theta = RB.angles[0] * parameter[RB.angles[1]][0]
-        phi   = RB.angles[2] * parameter[RB.angles[3]][0]
-        chi   = RB.angles[4] * parameter[RB.angles[5]][0]
-        atoms = rigid_body_rotation(atoms, theta, phi, chi, cell)
-        for i in range(len(RB.atoms)):
-            surface_new[RB.atoms[i]] = atoms[i]
+    if len(rigid_bodies) == 0: return surface_new
+    xyz = Num.array([atom[1:4] for atom in surface], float)
+    xyz = RB_transform(rigid_bodies, xyz, parameter, cell)
+    for i in set([i for RB in rigid_bodies for i in RB.atoms]):
+        atom = surface[i]
+        surface_new[i] = [atom[0], xyz[i][0], xyz[i][1], xyz[i][2]] + \
+                         list(atom[4:11])
     return surface_new
 ################################################################################
 ###############   Bond Valence Calculations  ###################################
@@ -134,14 +188,145 @@ class BVcluster:
             BVS = BVS + Num.exp((self.r0s[i]-dist)/self.bs[i])
         return BVS, distances
 
-def BV_impact(BVclusters, surface):
-    impact = 0
-    for i in BVclusters:
-        BVS, dist = i.calc_BVS(surface)
-        eqval = Num.sqrt((float(i.eqval) **2))
-        BV_offset = Num.sqrt(((BVS - eqval)**2)) / eqval
-        impact = impact + (i.ip[0] * BV_offset)**i.ip[1]
-    return impact
+class BVclusterSet(list):
+    """
+    List of BVclusters that also holds all clusters as flat arrays
+    (one entry per cluster or per bond), so the bond lengths, bond
+    valence sums and the penalty of all clusters are computed with
+    one gather of the atom positions and a few array operations
+    """
+    def __init__(self, BVclusters=[]):
+        list.__init__(self, BVclusters)
+        self.compiled = False
+
+    # changing the list of clusters invalidates the compiled arrays
+    def __setitem__(self, i, value):
+        list.__setitem__(self, i, value)
+        self.compiled = False
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self.compiled = False
+
+    def __setslice__(self, i, j, value):
+        list.__setslice__(self, i, j, value)
+        self.compiled = False
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.compiled = False
+
+    def __iadd__(self, other):
+        self.compiled = False
+        return list.__iadd__(self, other)
+
+    def __imul__(self, n):
+        self.compiled = False
+        return list.__imul__(self, n)
+
+    def append(self, value):
+        list.append(self, value)
+        self.compiled = False
+
+    def extend(self, values):
+        list.extend(self, values)
+        self.compiled = False
+
+    def insert(self, i, value):
+        list.insert(self, i, value)
+        self.compiled = False
+
+    def pop(self, i=-1):
+        self.compiled = False
+        return list.pop(self, i)
+
+    def remove(self, value):
+        list.remove(self, value)
+        self.compiled = False
+
+    def reverse(self):
+        list.reverse(self)
+        self.compiled = False
+
+    def sort(self, *args, **kws):
+        list.sort(self, *args, **kws)
+        self.compiled = False
+
+    def compile(self):
+        nc = len(self)
+        self.eqval = Num.array([abs(float(i.eqval)) for i in self],float)
+        self.ip = Num.array([i.ip for i in self],float).reshape(nc,2)
+        self.center = Num.array([i.center for i in self],int)
+        self.center_offset = Num.array([[i.centerxoffset, i.centeryoffset, 0]\
+                                        for i in self],float).reshape(nc,3)
+        cluster = []
+        for c in range(nc):
+            cluster.extend([c]*len(self[c].neighbors))
+        self.cluster = Num.array(cluster,int)
+        self.neighbor = Num.array([n for i in self for n in i.neighbors],int)
+        self.neighbor_offset = Num.array([[x, y, 0] for i in self for (x,y) in\
+                                          zip(i.neighborsxoffset,\
+                                              i.neighborsyoffset)],float)
+        self.neighbor_offset = self.neighbor_offset.reshape(-1,3)
+        self.r0 = Num.array([r for i in self for r in i.r0s],float)
+        self.b = Num.array([b for i in self for b in i.bs],float)
+        self.g = Num.array([i.g for i in self],float).reshape(nc,3,3)
+        self.compiled = True
+
+    def calc_BVS(self, surface):
+        """
+        returns the bond valence sums of all clusters and the bond
+        lengths (flat, ordered by cluster and neighbor)
+        """
+        if not self.compiled: self.compile()
+        BVS, dist, bv, vector, g = self._calc(surface)
+        return BVS, dist
+
+    def _calc(self, surface):
+        xyz = Num.array([atom[1:4] for atom in surface],float)
+        centers = xyz[self.center] + self.center_offset
+        vector = xyz[self.neighbor] + self.neighbor_offset - \
+                 centers[self.cluster]
+        g = self.g[self.cluster]
+        gv = Num.sum(g * vector[:,Num.newaxis,:], axis=2)
+        dist = Num.sqrt(Num.sum(vector * gv, axis=1))
+        bv = Num.exp((self.r0 - dist)/self.b)
+        BVS = Num.bincount(self.cluster, bv, minlength=len(self))
+        return BVS, dist, bv, gv, g
+
+    def impact(self, surface, gradient=False):
+        """
+        returns the bond valence penalty of all clusters
+            sum((ip0 * abs(BVS - eqval)/eqval)**ip1)
+        if gradient is True the derivatives with respect to the
+        (fractional) atom positions (natoms x 3) are also returned
+        """
+        if not self.compiled: self.compile()
+        if len(self) == 0:
+            if gradient: return 0., Num.zeros((len(surface),3),float)
+            return 0.
+        BVS, dist, bv, gv, g = self._calc(surface)
+        BV_offset = Num.abs(BVS - self.eqval) / self.eqval
+        terms = (self.ip[:,0] * BV_offset)**self.ip[:,1]
+        impact = Num.sum(terms)
+        if not gradient:
+            return impact
+        # d impact/d BVS for each cluster
+        dBVS = Num.zeros(len(self),float)
+        ok = BV_offset > 0
+        dBVS[ok] = self.ip[ok,1] * terms[ok] / BV_offset[ok] * \
+                   Num.sign(BVS[ok] - self.eqval[ok]) / self.eqval[ok]
+        # d BVS/d dist = -bv/b, d dist/d vector = g.vector/dist
+        dvec = (dBVS[self.cluster] * -bv/self.b / dist)[:,Num.newaxis] * gv
+        grad = Num.zeros((len(surface),3),float)
+        Num.add.at(grad, self.neighbor, dvec)
+        Num.add.at(grad, self.center[self.cluster], -dvec)
+        return impact, grad
+
+def BV_impact(BVclusters, surface, gradient=False):
+    if not isinstance(BVclusters, BVclusterSet):
+        BVclusters = BVclusterSet(BVclusters)
+    return BVclusters.impact(surface, gradient=gradient)
 ################################################################################
 ######################  Parameter handling  ####################################
 def param_equal(param):
@@ -182,46 +367,91 @@ def param_unfold(param, param_use, surface, use_bulk_water, use_lay_el):
     Scale = param['Scale'][0]
     specScale = param['specScale'][0]
     beta = param['beta'][0]
-    surface_new = []
-    for i in range(len(surface)):
-        atom = ['a',0,0,0,0,0,0,0,0,0,0]
-        atom[0] = surface[i][0]
-        if param_use[i][1] != 'None':
-            atom[1] = surface[i][1]+ param_use[i][0]* param[param_use[i][1]][0]
-        else: atom[1] = surface[i][1]
-        if param_use[i][3] != 'None':
-            atom[2] = surface[i][2]+ param_use[i][2]* param[param_use[i][3]][0]
-        else: atom[2] = surface[i][2]
-        if param_use[i][5] != 'None':
-            atom[3] = surface[i][3]+ param_use[i][4]* param[param_use[i][5]][0]
-        else: atom[3] = surface[i][3]
-        if param_use[i][7] != 'None':
-            atom[4] = param_use[i][6]* param[param_use[i][7]][0]
-        else: atom[4] = surface[i][4]
-        if param_use[i][9] != 'None':
-            atom[5] = param_use[i][8]* param[param_use[i][9]][0]
-        else: atom[5] = surface[i][5]
-        if param_use[i][11] != 'None':
-            atom[6] = param_use[i][10]* param[param_use[i][11]][0]
-        else: atom[6] = surface[i][6]
-        if param_use[i][13] != 'None':
-            atom[7] = param_use[i][12]* param[param_use[i][13]][0]
-        else: atom[7] = surface[i][7]
-        if param_use[i][15] != 'None':
-            atom[8] = param_use[i][14]* param[param_use[i][15]][0]
-        else: atom[8] = surface[i][8]
-        if param_use[i][17] != 'None':
-            atom[9] = param_use[i][16]* param[param_use[i][17]][0]
-        else: atom[9] = surface[i][9]
-        if param_use[i][19] != 'None':
-            if param_use[i][18] >= 0: atom[10] = param_use[i][18]* \
-                                                 param[param_use[i][19]][0]
-            else: atom[10] = 1+ param_use[i][18]* param[param_use[i][19]][0]
-        else: atom[10] = surface[i][10]
-        surface_new.append(atom)
+    surface_new = get_surface_model(param_use, surface).unfold(param)
     global_parms = [occ_el, K,sig_el,sig_el_bar,d_el,d0_el,sig_water, \
                     sig_water_bar, d_water, zwater, Scale, specScale, beta]   
     return  global_parms, surface_new
+
+class SurfaceModel:
+    """
+    Parameter usage table of a surface compiled into sparse arrays.
+    The ten numeric fields of all atoms (x,y,z,u11,u22,u33,u12,u13,
+    u23,occ) are stacked in one flat array,
+        atoms = const + A * p
+    where p is the vector of the used parameter values and A is a
+    sparse matrix given by the (rows, cols, coef) arrays.  Positions
+    are shifts (surface value + coef*p), the other fields are set to
+    coef*p, or 1 + coef*p for occupancies with a negative coef.
+    """
+    def __init__(self, param_use, surface):
+        self.param_use = [list(u) for u in param_use]
+        self.surface = [list(atom) for atom in surface]
+        self.names = [atom[0] for atom in surface]
+        natoms = len(surface)
+        const = Num.array([atom[1:11] for atom in surface],float)
+        const = const.reshape(natoms,10)
+        self.labels = []
+        index = {}
+        rows = []
+        cols = []
+        coef = []
+        for i in range(natoms):
+            for j in range(10):
+                key = param_use[i][2*j+1]
+                if key == 'None': continue
+                c = param_use[i][2*j]
+                if key not in index:
+                    index[key] = len(self.labels)
+                    self.labels.append(key)
+                if j == 9 and c < 0:
+                    const[i][j] = 1.
+                elif j >= 3:
+                    const[i][j] = 0.
+                rows.append(10*i+j)
+                cols.append(index[key])
+                coef.append(c)
+        self.const = const.ravel()
+        self.rows = Num.array(rows, int)
+        self.cols = Num.array(cols, int)
+        self.coef = Num.array(coef, float)
+
+    def matches(self, param_use, surface):
+        return self.param_use == param_use and self.surface == surface
+
+    def calc(self, param):
+        """
+        stacked atom array (n_atoms x 10) for the parameter values
+        """
+        p = Num.array([param[key][0] for key in self.labels], float)
+        values = self.const + Num.bincount(self.rows, self.coef * p[self.cols],\
+                                           minlength = len(self.const))
+        return values.reshape(-1,10)
+
+    def unfold(self, param):
+        """
+        surface list (one [name, x, y, z, ..., occ] list per atom)
+        for the parameter values
+        """
+        atoms = self.calc(param).tolist()
+        return [[self.names[i]] + atoms[i] for i in range(len(atoms))]
+
+_surface_model = None
+
+def get_surface_model(param_use, surface):
+    """
+    compiled SurfaceModel of the parameter usage table, the last one
+    is kept and reused while param_use and surface are unchanged
+    """
+    global _surface_model
+    # module globals are not shipped to the pp workers
+    try:
+        model = _surface_model
+    except NameError:
+        model = None
+    if model is None or not model.matches(param_use, surface):
+        model = SurfaceModel(param_use, surface)
+        _surface_model = model
+    return model
 ################################################################################
 ##################  Structure Factor calculations  #############################
 class Fitting_Rod:
@@ -247,16 +477,16 @@ class Fitting_Rod:
         self.difference = Num.array([],float)
         #####################################################
     def calcFbulk(self, cell, bulk, g_inv, database):
-        self.re_bulk = Num.ndarray((len(self.L)),float)
-        self.im_bulk = Num.ndarray((len(self.L)),float)
-        for i in range(len(self.L)):
-            hkl = [self.H,self.K,self.L[i]]
-            zeta = self.L[i]+ self.H*cell[6]+ self.K*cell[7]
-            re_ctr = 0.5
-            im_ctr = -1/(2*Num.tan(Num.pi*zeta))
-            re_UC , im_UC = calc_Fuc(hkl,bulk,g_inv,database)
-            self.re_bulk[i] = re_ctr*re_UC - im_ctr*im_UC
-            self.im_bulk[i] = re_UC*im_ctr + re_ctr*im_UC
+        hkl = Num.zeros((len(self.L),3),float)
+        hkl[:,0] = self.H
+        hkl[:,1] = self.K
+        hkl[:,2] = self.L
+        zeta = self.L + self.H*cell[6] + self.K*cell[7]
+        re_ctr = 0.5
+        im_ctr = -1/(2*Num.tan(Num.pi*zeta))
+        re_UC , im_UC = calc_Fuc(hkl,bulk,g_inv,database)
+        self.re_bulk = re_ctr*re_UC - im_ctr*im_UC
+        self.im_bulk = re_UC*im_ctr + re_ctr*im_UC
             
     def calc_q_ang(self, g_inv):
         for l in self.L:
@@ -264,29 +494,35 @@ class Fitting_Rod:
             self.q_ang.append(q)
 
     def calc_fs(self, DB, g_inv):
-        for k in DB.keys():
-            if k not in self.fs.keys():
-                self.fs[k] = Num.array([],float)
-                for l in self.L:
-                    hkl = [self.H, self.K, l]
-                    q = Num.sqrt(Num.dot(Num.dot(hkl,g_inv),hkl))
-                    f_par = DB[k]
-                    f = (f_par[0]*Num.exp(-(q/4/Num.pi)**2*f_par[1]) + f_par[2]*Num.exp(-(q/4/Num.pi)**2*f_par[3]) +\
-                        f_par[4]*Num.exp(-(q/4/Num.pi)**2*f_par[5]) + f_par[6]*Num.exp(-(q/4/Num.pi)**2*f_par[7]) + f_par[8])
-                    self.fs[k] = Num.append(self.fs[k] , f)            
+        keys = [k for k in DB.keys() if k not in self.fs.keys()]
+        if len(keys) == 0: return
+        hkl = Num.zeros((len(self.L),3),float)
+        hkl[:,0] = self.H
+        hkl[:,1] = self.K
+        hkl[:,2] = self.L
+        q = Num.sqrt(Num.sum(Num.dot(hkl,g_inv)*hkl,axis=1))
+        fs = f0_table(keys, q/4/Num.pi, DB)
+        for i in range(len(keys)):
+            self.fs[keys[i]] = Num.array(fs[i])
                 
 ####################################################################################################    
 def calc_Fuc(hkl,bulk,g_inv,database):
-    a = 0
-    b = 0
-    q = Num.sqrt(Num.dot(Num.dot(hkl,g_inv),hkl))
-    for i in range(shape(bulk)[0]):
-        f_par = database[str.lower(bulk[i][0])]
-        f = (f_par[0]*Num.exp(-(q/4/Num.pi)**2*f_par[1]) + f_par[2]*Num.exp(-(q/4/Num.pi)**2*f_par[3]) +\
-            f_par[4]*Num.exp(-(q/4/Num.pi)**2*f_par[5]) + f_par[6]*Num.exp(-(q/4/Num.pi)**2*f_par[7]) + f_par[8])*\
-            Num.exp(-2 * Num.pi**2 * q**2 * bulk[i][4])
-        a = a + (f * Num.cos(2*Num.pi*(hkl[0]*bulk[i][1] + hkl[1]*bulk[i][2] + hkl[2]*bulk[i][3])))
-        b = b + (f * Num.sin(2*Num.pi*(hkl[0]*bulk[i][1] + hkl[1]*bulk[i][2] + hkl[2]*bulk[i][3])))
+    """
+    unit cell structure factor (real and imaginary part) of the bulk,
+    hkl is a single reflection or an array [n_hkl, 3]
+    """
+    hkl = Num.asarray(hkl,float)
+    hkl2 = Num.atleast_2d(hkl)
+    q = Num.sqrt(Num.sum(Num.dot(hkl2,g_inv)*hkl2,axis=1))
+    names = [str(atom[0]) for atom in bulk]
+    xyz = Num.array([atom[1:4] for atom in bulk],float).reshape(-1,3)
+    U = Num.array([atom[4] for atom in bulk],float)
+    f = f0_table(names, q/4/Num.pi, database) * \
+        Num.exp(-2 * Num.pi**2 * Num.outer(U, q**2))
+    x = 2*Num.pi*Num.dot(xyz,hkl2.T)
+    a = Num.sum(f * Num.cos(x), axis=0)
+    b = Num.sum(f * Num.sin(x), axis=0)
+    if hkl.ndim == 1: return a[0], b[0]
     return a, b
 
 def Fatom(atom,fs,U,pi,q_Ang,hkl,low,exp,dot,sinus,cosinus,sqrt):
@@ -631,7 +867,7 @@ def read_BV(BVfile, cell):
         BVC.ip[1] = float(tmp[12+(n-2)*5])
         BVC.g = calc_g(cell)
         BVclusters.append(BVC)
-    return BVclusters
+    return BVclusterSet(BVclusters)
 ################################################################################
 ########################  writing files  #######################################
 def write_surface(cell, surface,param,param_use, rigid_bodies, use_bulk_water, use_lay_el, filename = 'surface.sur'):
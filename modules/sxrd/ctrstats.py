@@ -0,0 +1,222 @@
+"""
+Parameter statistics for CTR fits used in pi-surf
+
+The finite-difference Jacobian is built with one model evaluation per
+column side; these evaluations are independent and are submitted to the
+Parallel Python job server when it is available.  Data weights are kept
+as a vector (1/Ferr**2), so no n x n array is ever formed and the
+covariance costs O(n*b**2) for n data points and b parameters.
+
+Authors/modifications:
+----------------------
+agent (agent@local)
+
+"""
+################################################################################
+
+import numpy as Num
+
+from tdl.modules.sxrd.ctrfitcalcs import param_equal, param_unfold, RB_update,\
+     SurfaceModel, get_surface_model, RB_transform, RB_rotations, calc_M,\
+     rigid_body_rotation, calcF, calc_Fsurf, calc_Fwater_layered,\
+     calc_F_layered_el, Fatom, calc_CTRs, parallel
+if parallel:
+    from tdl.modules.sxrd.ctrfitcalcs import jobserver
+
+################################################################################
+def weight_vector(dat):
+    """
+    Diagonal of the data weight matrix, 1/Ferr**2 for all rods
+    concatenated in the order of dat
+    """
+    return Num.concatenate([1./Num.asarray(ctr.Ferr, float)**2 for ctr in dat])
+
+def rod_slices(dat):
+    """
+    Index slices of each rod within the concatenated data vector
+    """
+    slices = []
+    n = 0
+    for ctr in dat:
+        slices.append(slice(n, n + len(ctr.L)))
+        n = n + len(ctr.L)
+    return slices
+
+def calc_Fcalc(parameter, param_usage, dat, cell, surface_tmp, NLayers,\
+               rigid_bodies, use_bulk_water, RMS_flag, use_lay_el, el):
+    """
+    Model structure factors of all rods for one parameter set,
+    concatenated in the order of dat.  This is the unit of work
+    shipped to the job server, so it only uses the structure factor
+    functions of ctrfitcalcs.
+    """
+    global_parms, surface_new = param_unfold(parameter, param_usage,\
+                                             surface_tmp, use_bulk_water,\
+                                             use_lay_el)
+    surface_new = RB_update(rigid_bodies, surface_new, parameter, cell)
+    Auc = cell[0]* Num.sin(Num.radians(cell[5]))* cell[1]
+    Fcalc = []
+    for ctr in dat:
+        ctr = calcF(ctr, global_parms, Auc, surface_new, NLayers,\
+                    use_bulk_water, RMS_flag, use_lay_el, el)
+        Fcalc.append(ctr.Fcalc)
+    return Num.concatenate(Fcalc)
+
+def fd_step(parameter, key, fpc):
+    """
+    Finite difference step for parameter key, returns the two parameter
+    values to evaluate and the step width h.  The step is centered on the
+    current value unless this would leave the parameter limits.
+    """
+    value, low, high = parameter[key][0], parameter[key][1], parameter[key][2]
+    h = value * fpc
+    if h == 0:
+        h = fpc
+    elif h < 0.:
+        h = -h
+    if value - 0.5*h >= low and value + 0.5*h <= high:
+        return value - 0.5*h, value + 0.5*h, h
+    elif value - 0.5*h < low:
+        return value, value + h, h
+    else:
+        return value - h, value, h
+
+def _set_param(parameter, key, value):
+    new = {}
+    for k in parameter.keys():
+        new[k] = list(parameter[k])
+    new[key][0] = value
+    return new
+
+def fd_jacobian(keys, fpc, parameter, param_usage, dat, cell, surface_tmp,\
+                NLayers, rigid_bodies, use_bulk_water, RMS_flag, use_lay_el,\
+                el):
+    """
+    Finite difference derivatives dFcalc/dp for the parameters in keys,
+    returned as an array of shape (len(keys), n).  All 2*len(keys) model
+    evaluations are submitted at once when Parallel Python is available.
+    """
+    args = (param_usage, dat, cell, surface_tmp, NLayers, rigid_bodies,\
+            use_bulk_water, RMS_flag, use_lay_el, el)
+    steps = []
+    points = []
+    for key in keys:
+        p1, p2, h = fd_step(parameter, key, fpc)
+        steps.append(h)
+        points.append(_set_param(parameter, key, p1))
+        points.append(_set_param(parameter, key, p2))
+    if parallel:
+        jobs = [jobserver.submit(calc_Fcalc, (p,) + args,\
+                (param_equal, param_unfold, SurfaceModel, get_surface_model,\
+                 RB_update, RB_transform, RB_rotations, calc_M,\
+                 rigid_body_rotation, calcF, calc_Fsurf, calc_Fwater_layered,\
+                 calc_F_layered_el, Fatom), ("numpy as Num",)) for p in points]
+        values = [job() for job in jobs]
+    else:
+        values = [calc_Fcalc(*((p,) + args)) for p in points]
+    D = Num.zeros((len(keys), len(values[0])), float)
+    for i in range(len(keys)):
+        D[i] = (values[2*i+1] - values[2*i])/steps[i]
+    return D
+
+def scaled_sensitivities(D, keys, parameter, w):
+    """
+    Sensitivities scaled with parameter value and data error:
+    X[i][j] = dFcalc_j/dp_i * p_i / Ferr_j
+    """
+    p = Num.array([parameter[key][0] for key in keys], float)
+    return D * p[:,Num.newaxis] * Num.sqrt(w)[Num.newaxis,:]
+
+def covariance(X, w, R):
+    """
+    Covariance matrix R * (X W X^T)^-1 with the diagonal weights w,
+    formed without the n x n weight matrix
+    """
+    V = Num.dot(X * w[Num.newaxis,:], Num.transpose(X))
+    return R * Num.linalg.inv(V)
+
+def correlations(V):
+    """
+    Standard deviations on the diagonal, correlation coefficients off the
+    diagonal (the layout used by pi-surf's correlation matrix)
+    """
+    sd = Num.sqrt(Num.diag(V))
+    C = V / Num.outer(sd, sd)
+    C[Num.diag_indices(len(sd))] = sd
+    return C
+
+def rod_sensitivities(X, dat):
+    """
+    Summed squared scaled sensitivity of each parameter on each rod,
+    array of shape (b, number of rods)
+    """
+    S = Num.zeros((len(X), len(dat)), float)
+    for i, s in enumerate(rod_slices(dat)):
+        S[:,i] = Num.sum(X[:,s]**2, axis = 1)
+    return S
+
+################################################################################
+def param_statistics(fpc, parameter, param_usage, dat, cell, surface_tmp,\
+                     NLayers, database, g_inv, Rod_weight, rigid_bodies,\
+                     use_bulk_water, use_BVC, BVclusters, RMS_flag,\
+                     use_lay_el, el):
+    """
+    Standard deviations and correlations of all refined parameters.
+    Standard deviations are written to parameter[key][4] (also for tied
+    parameters).  Returns parameter, scaled sensitivities X (b x n),
+    correlation matrix C, used parameter keys, chi**2 R and the per rod
+    sensitivities (b x number of rods).
+    """
+    used_params = []
+    for i in parameter.keys():
+        if parameter[i][3]:
+            used_params.append(i)
+    b = len(used_params)
+    w = weight_vector(dat)
+
+    D = fd_jacobian(used_params, fpc, parameter, param_usage, dat, cell,\
+                    surface_tmp, NLayers, rigid_bodies, use_bulk_water,\
+                    RMS_flag, use_lay_el, el)
+    X = scaled_sensitivities(D, used_params, parameter, w)
+
+    dat, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers,\
+                       database, g_inv, Rod_weight, rigid_bodies,\
+                       use_bulk_water, use_BVC, BVclusters, RMS_flag,\
+                       use_lay_el, el)
+    C = Num.zeros((b,b))
+    try:
+        C = correlations(covariance(X, w, R))
+        for i in range(b):
+            parameter[used_params[i]][4] = C[i][i]
+        keys = parameter.keys()
+        for key in keys:
+            if parameter[key][5] in keys:
+                parameter[key][4] = parameter[parameter[key][5]][4]
+    except Num.linalg.LinAlgError:
+        print "There's a hole in the matrix !!! Omit unused or insignificant parameters in the calculation.\n"
+
+    return parameter, X, C, used_params, R, rod_sensitivities(X, dat)
+
+def param_sensitivity(param_label, fpc, parameter, param_usage, dat, cell,\
+                      surface_tmp, NLayers, database, g_inv, Rod_weight,\
+                      rigid_bodies, use_bulk_water, use_BVC, BVclusters,\
+                      RMS_flag, use_lay_el, el):
+    """
+    Scaled sensitivities (n) and standard deviation of a single parameter
+    """
+    w = weight_vector(dat)
+    D = fd_jacobian([param_label], fpc, parameter, param_usage, dat, cell,\
+                    surface_tmp, NLayers, rigid_bodies, use_bulk_water,\
+                    RMS_flag, use_lay_el, el)
+    X = scaled_sensitivities(D, [param_label], parameter, w)[0]
+
+    dat, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers,\
+                       database, g_inv, Rod_weight, rigid_bodies,\
+                       use_bulk_water, use_BVC, BVclusters, RMS_flag,\
+                       use_lay_el, el)
+    V = Num.sum(X * w * X)
+    if V > 0:
+        dp = Num.sqrt(R/V)
+    else:
+        dp = 0.
+    return X, dp
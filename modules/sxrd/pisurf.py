@@ -607,6 +607,7 @@ class MainControlPanel(wx.Panel):
         self.el = 'h'
 
         self.sensitivities = Num.array([])
+        self.rod_sensitivities = Num.array([])
         self.correl_matrix = Num.array([])
         self.fpc = 0.0001
         self.used_params = ['None']
@@ -914,7 +915,7 @@ class MainControlPanel(wx.Panel):
     ################################################################################################################################
     def OnClickStatistics(self,e):
         self.nb.frame.SetStatusText(' computing parameter statistics ', 0)
-        self.nb.parameter, self.sensitivities, self.correl_matrix, self.used_params, self.RMS = statistics(self.fpc,self.nb.parameter,self.nb.parameter_usage, self.nb.data, self.nb.cell,self.nb.surface,\
+        self.nb.parameter, self.sensitivities, self.correl_matrix, self.used_params, self.RMS, self.rod_sensitivities = statistics(self.fpc,self.nb.parameter,self.nb.parameter_usage, self.nb.data, self.nb.cell,self.nb.surface,\
                                                                                self.nb.NLayers, self.nb.runningDB, self.nb.g_inv, self.Rod_weight, self.nb.rigid_bodies,\
                                                                                self.UBW_flag,self.use_BVC, self.BVclusters, self.RMS_flag, self.use_lay_el, self.el)
         
@@ -957,6 +958,11 @@ class MainControlPanel(wx.Panel):
                             print self.used_params[i] + ' & ' + self.used_params[j] + ': ' + str(round(self.correl_matrix[i][j],5))
             if n == 0: print 'None \n'
             else: print '\n'
+            print '\nMost sensitive rod of each parameter: \n'
+            for i in range(b):
+                j = Num.argmax(self.rod_sensitivities[i])
+                print self.used_params[i] + ': ' + str(self.nb.data[j].H) + ' ' + str(self.nb.data[j].K) + ' L (' + str(round(self.rod_sensitivities[i][j],5)) + ')'
+            print '\n'
             print 'statistics calculation finished, chi**2 = '+str(round(self.RMS,3))+'\n'
             print 'number of used variables = '+str(b)
         self.nb.frame.SetStatusText(' statistics calculation finished, chi**2 = '+str(round(self.RMS,3)), 0)
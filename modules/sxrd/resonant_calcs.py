@@ -12,9 +12,12 @@ from pylab import *
 from scipy.optimize import leastsq
 from scipy.interpolate import interp1d
 
-from tdl.modules.sxrd.ctrfitcalcs import param_unfold,RB_update, calc_g_inv
+from tdl.modules.sxrd.ctrfitcalcs import param_unfold,RB_update, calc_g_inv, parallel
+if parallel:
+    from tdl.modules.sxrd.ctrfitcalcs import jobserver
 from tdl.modules.sxrd.resonant_simplex import calc_F_lay_el
 from tdl.modules.xtab.atomic import f0data as database
+from tdl.modules.xtab import anomalous
 ###################################### calculations ####################################################
 def calc_FucNR(hkl,bulk,g_inv,database):
     a = 0
@@ -249,6 +252,18 @@ def read_f1f2(allrasd, f1f2_file):
     allrasd.f1 = f1f2[1]
     allrasd.f2 = f1f2[2]
     return allrasd
+
+def table_f1f2(allrasd, element, E = None, width = 0.):
+    """
+    set allrasd.E, f1 and f2 from the tabulated anomalous scattering
+    factors (xtab.anomalous) of element instead of an f1f2 file.
+    E defaults to the energies of all Rasd data sets in allrasd.list
+    """
+    if E is None:
+        E = Num.unique(Num.concatenate([Rasd.E for Rasd in allrasd.list]))
+    allrasd.E = Num.array(E, float)
+    allrasd.f1, allrasd.f2 = anomalous.f1f2(element, allrasd.E, width = width)
+    return allrasd
 #############################################################################################################################
 def read_RSD(allrasd, bulk_tmp, surface_tmp, parameter, param_usage, rigid_bodies, database, rasddata, use_bulk_water, use_lay_el, el, dirname, parent):
     """    
@@ -355,54 +370,47 @@ def abs_correct(allrasd):
             rasd.F = rasd.F * rasd.abs_corr
             rasd.abs_corr = Num.ones((len(rasd.F)),float)
             
-    for i in range(len(allrasd.list)):
-        allrasd.list[i] = RASD_Fourier(allrasd, i)            
+    allrasd = RASD_Fourier_batch(allrasd)
 ########################## Fit Fourier Components ####################################################        
-def RASD_Fourier(allrasd, pnt):
-    Rasd = allrasd.list[pnt]
+def rasd_f1f2(allrasd, Rasd):
+    """
+    copy f1 and f2 of allrasd to the energies of Rasd
+    """
+    lookup = dict(zip(allrasd.E, range(len(allrasd.E))))
     for i in range(Rasd.ndata):
-        j = 0
-        for j in range(len(allrasd.E)):
-            if Rasd.E[i] == allrasd.E[j]:
-                Rasd.f1[i] = allrasd.f1[j]
-                Rasd.f2[i] = allrasd.f2[j]
-
-    vec = Num.array([Rasd.a ,Rasd.b , Rasd.AR, Rasd.PR], float)
-
-    def Wiggle(vec, Rasd):
-        a , b, AR, PR = vec
-        re_Fq = AR * Num.cos(2*Num.pi*PR)
-        im_Fq = AR * Num.sin(2*Num.pi*PR)
-        re_FR = Rasd.f1 * re_Fq - Rasd.f2 * im_Fq
-        im_FR = Rasd.f1 * im_Fq + Rasd.f2 * re_Fq
-        return Rasd.F - ((a + b*(Rasd.E-Rasd.E0))* ((Rasd.re_FNR + re_FR)**2 + (Rasd.im_FNR + im_FR)**2))
+        if Rasd.E[i] in lookup:
+            Rasd.f1[i] = allrasd.f1[lookup[Rasd.E[i]]]
+            Rasd.f2[i] = allrasd.f2[lookup[Rasd.E[i]]]
+    return Rasd
 
-    def Jacobi(vec, Rasd):
-        J = Num.ndarray((4, Rasd.ndata), float)
-        a , b, AR, PR = vec
-        re_Fq = AR * Num.cos(2*Num.pi*PR)
-        im_Fq = AR * Num.sin(2*Num.pi*PR)
-        re_FR = Rasd.f1 * re_Fq - Rasd.f2 * im_Fq
-        im_FR = Rasd.f1 * im_Fq + Rasd.f2 * re_Fq
-
-        J[0,:] = -(Rasd.re_FNR + re_FR)**2 - (Rasd.im_FNR + im_FR)**2
-
-        J[1,:] = -(Rasd.E-Rasd.E0) * ((Rasd.re_FNR + re_FR)**2 + (Rasd.im_FNR + im_FR)**2)
-        J[2,:] = -2 *(a+b*(Rasd.E-Rasd.E0))* ((Rasd.f1*Num.cos(2*Num.pi*PR)-Rasd.f2*Num.sin(2*Num.pi*PR))*(Rasd.re_FNR + re_FR)+\
-                                          (Rasd.f1*Num.sin(2*Num.pi*PR)+Rasd.f2*Num.cos(2*Num.pi*PR))*(Rasd.im_FNR + im_FR))
-                 
-        J[3,:] = -4 *Num.pi* (a+b*(Rasd.E-Rasd.E0))* ((-Num.sin(2*Num.pi*PR)*AR*Rasd.f1- Num.cos(2*Num.pi*PR)*Rasd.f2*AR)*(Rasd.re_FNR + re_FR) +\
-                                                  ( Num.cos(2*Num.pi*PR)*AR*Rasd.f1- Num.sin(2*Num.pi*PR)*Rasd.f2*AR)*(Rasd.im_FNR + im_FR))
-        return J
-    
-    result = leastsq(Wiggle, vec,args = (Rasd), Dfun = Jacobi, col_deriv = 1, full_output = 1)
-    Rasd.a , Rasd.b, Rasd.AR, Rasd.PR = result[0]
-    X = Jacobi(result[0], Rasd)
-    w = Num.zeros((len(Rasd.Ferr),len(Rasd.Ferr)))
-    for i in range(len(Rasd.Ferr)):
-        w[i][i] = 1/Rasd.Ferr[i]**2
-    cov = Num.linalg.inv(Num.dot(X,Num.dot(w,Num.transpose(X))))  
-                          
+def rasd_model(vec, dE, f1, f2, re_FNR, im_FNR):
+    """
+    model RASD intensity and its Jacobian with respect to (a, b, AR, PR).
+    vec holds the parameters along its last axis, all other arguments
+    broadcast against each other, so the same function serves single
+    points (1d data) and batches (2d data, one point per row).
+    Returns F_calc and J with the parameter index first.
+    """
+    vec = Num.asarray(vec, float)
+    a, b, AR, PR = [vec[...,i] for i in range(4)]
+    if vec.ndim > 1:
+        a, b, AR, PR, re_FNR, im_FNR = [Num.asarray(x)[...,Num.newaxis] for x in (a, b, AR, PR, re_FNR, im_FNR)]
+    cos = Num.cos(2*Num.pi*PR)
+    sin = Num.sin(2*Num.pi*PR)
+    re = re_FNR + f1 * AR * cos - f2 * AR * sin
+    im = im_FNR + f1 * AR * sin + f2 * AR * cos
+    S = re**2 + im**2
+    scale = a + b*dE
+    J = Num.array([S, dE * S,\
+                   2 * scale * ((f1*cos - f2*sin)*re + (f1*sin + f2*cos)*im),\
+                   4 * Num.pi * scale * ((-sin*AR*f1 - cos*AR*f2)*re + (cos*AR*f1 - sin*AR*f2)*im)])
+    return scale * S, J
+
+def rasd_fit_results(Rasd, vec, cov):
+    """
+    store fitted parameters, errors and calculated curves in Rasd
+    """
+    Rasd.a , Rasd.b, Rasd.AR, Rasd.PR = vec
     re_Fq = Rasd.AR * Num.cos(2*Num.pi*Rasd.PR)
     im_Fq = Rasd.AR * Num.sin(2*Num.pi*Rasd.PR)
     Rasd.re_FR = Rasd.f1 * re_Fq - Rasd.f2 * im_Fq
@@ -428,8 +436,146 @@ def RASD_Fourier(allrasd, pnt):
         Rasd.PR = Rasd.PR +0.5
     if Rasd.PR > 1:
         Rasd.PR = Rasd.PR -1
-    
     return Rasd
+
+def RASD_Fourier(allrasd, pnt):
+    Rasd = rasd_f1f2(allrasd, allrasd.list[pnt])
+    vec = Num.array([Rasd.a ,Rasd.b , Rasd.AR, Rasd.PR], float)
+    dE = Rasd.E - Rasd.E0
+
+    def Wiggle(vec, Rasd):
+        return Rasd.F - rasd_model(vec, dE, Rasd.f1, Rasd.f2, Rasd.re_FNR, Rasd.im_FNR)[0]
+
+    def Jacobi(vec, Rasd):
+        return -rasd_model(vec, dE, Rasd.f1, Rasd.f2, Rasd.re_FNR, Rasd.im_FNR)[1]
+    
+    result = leastsq(Wiggle, vec,args = (Rasd), Dfun = Jacobi, col_deriv = 1, full_output = 1)
+    X = Jacobi(result[0], Rasd)
+    w = 1/Rasd.Ferr**2
+    cov = Num.linalg.inv(Num.dot(X*w,Num.transpose(X)))
+    return rasd_fit_results(Rasd, result[0], cov)
+
+def solve_points(A, b):
+    """
+    solve A[p] x[p] = b[p] for a stack of points (b = None gives the
+    inverses). A singular point gives nan, rather than failing the batch
+    """
+    try:
+        if b is None:
+            return Num.linalg.inv(A)
+        return Num.linalg.solve(A, b)
+    except Num.linalg.LinAlgError:
+        if b is None:
+            x = Num.zeros(A.shape) + Num.nan
+        else:
+            x = Num.zeros(b.shape) + Num.nan
+        for i in range(len(A)):
+            try:
+                if b is None:
+                    x[i] = Num.linalg.inv(A[i])
+                else:
+                    x[i] = Num.linalg.solve(A[i], b[i])
+            except Num.linalg.LinAlgError:
+                pass
+        return x
+
+def fit_rasd_batch(vec, dE, F, f1, f2, w, re_FNR, im_FNR, maxiter = 1000, ftol = 1.49012e-8, xtol = 1.49012e-8):
+    """
+    Levenberg-Marquardt fit of (a, b, AR, PR) for many RASD points at
+    once. All data arguments are (npoints x nmax) arrays, shorter points
+    padded with w = 0 (w only masks data in the fit, as in RASD_Fourier
+    the fit itself is unweighted; w are the 1/Ferr**2 weights used for
+    the covariance). Each point has its own damping and convergence
+    state. AR is returned positive and PR reduced to [0,1).
+    Returns the fitted vectors (npoints x 4) and covariances (npoints x 4 x 4).
+    Points with a singular normal matrix get a nan covariance.
+    """
+    vec = Num.array(vec, float)
+    mask = Num.asarray(w > 0, float)
+    npnt = len(vec)
+
+    def cost(vec, p):
+        model, J = rasd_model(vec, dE[p], f1[p], f2[p], re_FNR[p], im_FNR[p])
+        r = (F[p] - model) * mask[p]
+        return Num.sum(r*r, 1), r, Num.transpose(J * mask[p], (1,0,2))
+
+    lam = Num.ones(npnt) * 1e-3
+    p = Num.arange(npnt)
+    for it in range(maxiter):
+        if len(p) == 0:
+            break
+        # only the points that have not converged yet are carried along
+        c, r, J = cost(vec[p], p)
+        JJ = Num.einsum('pin,pjn->pij', J, J)
+        g = Num.einsum('pin,pn->pi', J, r)
+        d = Num.maximum(Num.diagonal(JJ, axis1 = 1, axis2 = 2), 1e-12)
+        # a singular point gives a nan step, ie it is not improved
+        # and drops out when lam gets too large
+        step = solve_points(JJ + lam[p,Num.newaxis,Num.newaxis] * d[:,Num.newaxis,:] * Num.eye(4), g)
+        new_chi = cost(vec[p] + step, p)[0]
+        better = new_chi < c
+        small = (Num.abs(c - new_chi) <= ftol * c) | \
+                (Num.sqrt(Num.sum(step**2,1)) <= xtol * (Num.sqrt(Num.sum(vec[p]**2,1)) + xtol))
+        vec[p[better]] = vec[p[better]] + step[better]
+        lam[p] = Num.where(better, lam[p]/10., lam[p]*10.)
+        p = p[~(small & better) & (lam[p] < 1e16)]
+
+    X = rasd_model(vec, dE, f1, f2, re_FNR, im_FNR)[1] * mask
+    X = Num.transpose(X, (1,0,2))
+    cov = solve_points(Num.einsum('pin,pjn->pij', X * w[:,Num.newaxis,:], X), None)
+    neg = vec[:,2] < 0
+    vec[neg,2] = -vec[neg,2]
+    vec[neg,3] = vec[neg,3] + 0.5
+    vec[:,3] = Num.mod(vec[:,3], 1.)
+    return vec, cov
+
+def fit_rasd_chunk(args, kws):
+    """
+    fit_rasd_batch(*args, **kws), for the job server
+    """
+    return fit_rasd_batch(*args, **kws)
+
+def RASD_Fourier_batch(allrasd, pnts = None, use_parallel = False, **kws):
+    """
+    fit the Fourier components of all (or the listed) RASD points of
+    allrasd together with fit_rasd_batch, fills the same quantities as
+    RASD_Fourier. With use_parallel the points are split over the
+    Parallel Python job server, when available. kws are passed to
+    fit_rasd_batch (maxiter, ftol, xtol). Points whose covariance is
+    singular are reported and get nan errors.
+    """
+    if pnts == None:
+        pnts = range(len(allrasd.list))
+    if len(pnts) == 0:
+        return allrasd
+    rasds = [rasd_f1f2(allrasd, allrasd.list[i]) for i in pnts]
+    nmax = max([Rasd.ndata for Rasd in rasds])
+    arrays = Num.zeros((5, len(rasds), nmax), float)
+    for i in range(len(rasds)):
+        Rasd = rasds[i]
+        n = Rasd.ndata
+        arrays[:,i,:n] = [Rasd.E - Rasd.E0, Rasd.F, Rasd.f1, Rasd.f2, 1/Rasd.Ferr**2]
+    vec = Num.array([[Rasd.a, Rasd.b, Rasd.AR, Rasd.PR] for Rasd in rasds], float)
+    FNR = Num.array([[Rasd.re_FNR, Rasd.im_FNR] for Rasd in rasds], float)
+
+    if use_parallel and parallel:
+        nchunk = max(1, len(rasds) / jobserver.get_ncpus())
+        chunks = range(0, len(rasds), nchunk)
+        jobs = [jobserver.submit(fit_rasd_chunk, ((vec[c:c+nchunk],) + tuple(arrays[:,c:c+nchunk]) +\
+                                 (FNR[c:c+nchunk,0], FNR[c:c+nchunk,1]), kws),\
+                                 (fit_rasd_batch, rasd_model, solve_points),\
+                                 ("numpy as Num",)) for c in chunks]
+        results = [job() for job in jobs]
+        vec = Num.concatenate([res[0] for res in results])
+        cov = Num.concatenate([res[1] for res in results])
+    else:
+        vec, cov = fit_rasd_batch(vec, *(tuple(arrays) + (FNR[:,0], FNR[:,1])), **kws)
+
+    for i in range(len(rasds)):
+        if Num.isnan(cov[i]).any():
+            print 'Warning: singular covariance for RASD point %i' % pnts[i]
+        allrasd.list[pnts[i]] = rasd_fit_results(rasds[i], vec[i], cov[i])
+    return allrasd
 #################  Fourier Synthese  ###########################################
 def calc_rho(Fourier, r, ginv):
     rho = 0
@@ -439,24 +585,69 @@ def calc_rho(Fourier, r, ginv):
         rho = rho + (F_comp[3] * Num.cos(2*Num.pi*(F_comp[4] - Num.dot(r,Q))))
     return rho
 
-def Fourier_synthesis(Fourier, cell, ZR, xf, yf, zf, an, bn, cn, zmin):
-    
+def fourier_axes(Fourier, ginv, axis, length, n, offset):
+    """
+    Phase factors exp(-2 pi i r.Q) of all Fourier components along one
+    grid axis (0, 1 or 2) sampled with n points over length (Angstroem)
+    starting at offset. Returns the (n x ncomp) phase array and the
+    component frequencies in units of 1/length.
+    """
+    Q = Num.asarray(Fourier, float)[:,axis] * ginv[axis][axis]**0.5
+    r = length / n * Num.arange(n) + offset
+    return Num.exp(-2j*Num.pi*Num.outer(r, Q)), Q * length
+
+def _rho_fft(coef, freqs, an, bn, cn):
+    grid = Num.zeros((an,bn,cn), complex)
+    idx = [Num.mod(Num.round_(f).astype(int), n) for f, n in zip(freqs, (an,bn,cn))]
+    Num.add.at(grid, tuple(idx), coef)
+    return Num.fft.fftn(grid).real
+
+def _rho_direct(coef, Ex, Ey, Ez, chunk):
+    an, bn, cn = len(Ex), len(Ey), len(Ez)
     Rho = Num.ndarray((an,bn,cn),float)
+    step = max(1, int(chunk // max(1, bn*len(coef))))
+    EzT = Num.transpose(Ez)
+    for i in range(0, an, step):
+        xy = (Ex[i:i+step,Num.newaxis,:] * coef) * Ey[Num.newaxis,:,:]
+        n = len(xy)
+        Rho[i:i+n] = Num.dot(xy.reshape(n*bn, len(coef)), EzT).real.reshape(n,bn,cn)
+    return Rho
+
+def Fourier_synthesis(Fourier, cell, ZR, xf, yf, zf, an, bn, cn, zmin, method = 'auto', chunk = 2**22):
+    """
+    Electron density map from RASD Fourier components (rows of
+    [H, K, L, AR, PR]) on an an x bn x cn grid, returns Rho[i][j][k] and
+    the sampled cell lengths.
+
+    rho(r) = sum AR cos(2 pi (PR - r.Q)) is separable in x, y and z, so
+    the map is evaluated as a matrix product of the per-axis phase
+    factors, chunked over x so that at most ~chunk complex numbers are
+    held in memory. If all component frequencies fall on the sampling
+    grid (integer H*xf, K*yf, L*zf for orthogonal cells) a single FFT is
+    used instead. method is 'auto', 'fft' or 'direct'.
+    """
+    Fourier = Num.asarray(Fourier, float)
+    an, bn, cn = int(an), int(bn), int(cn)
     sampx = cell[0]* xf
     sampy = cell[1]* yf
     sampz = cell[2]* zf
     g_inv = calc_g_inv(cell)
     g_inv2 = calc_g_inv([sampx,sampy,sampz,cell[3],cell[4],cell[5]])
     V = Num.linalg.det(Num.linalg.inv(g_inv2))**0.5
-    
-    for i in range(int(an)):
-        x = sampx /an * float(i)
-        for j in range(int(bn)):
-            y = sampy /bn * float(j)
-            for k in range(int(cn)):
-                z = sampz /cn * float(k) + sampz/zf *zmin
-                R = Num.array([x,y,z],float)
-                Rho[i][j][k]= calc_rho(Fourier, R, g_inv)
+
+    Ex, fx = fourier_axes(Fourier, g_inv, 0, sampx, an, 0.)
+    Ey, fy = fourier_axes(Fourier, g_inv, 1, sampy, bn, 0.)
+    Ez, fz = fourier_axes(Fourier, g_inv, 2, sampz, cn, sampz/zf *zmin)
+    coef = Fourier[:,3] * Num.exp(2j*Num.pi*Fourier[:,4])
+
+    on_grid = Num.allclose(Num.concatenate((fx,fy,fz)),\
+                           Num.round_(Num.concatenate((fx,fy,fz))), atol = 1e-9)
+    if method == 'fft' or (method == 'auto' and on_grid):
+        if not on_grid:
+            raise ValueError("Fourier components are not on the sampling grid, use method = 'direct'")
+        Rho = _rho_fft(coef * Ez[0], (fx,fy,fz), an, bn, cn)
+    else:
+        Rho = _rho_direct(coef, Ex, Ey, Ez, chunk)
     Rho = Rho * ZR/(V*2*Num.pi)
     return Rho, [sampx,sampy,sampz]
 	
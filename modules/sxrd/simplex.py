@@ -13,6 +13,7 @@ import random
 import wx
 
 from tdl.modules.sxrd.ctrfitcalcs import *
+from tdl.modules.sxrd.ctrstats import param_statistics, param_sensitivity
 ############################### methods used by simplex ############################################################################################
 def insert(used_params, point, parameter):
     for i in range(len(used_params)):
@@ -231,143 +232,7 @@ def extract_values(data):
     return y
 
 def statistics(fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el):
-    n = 0
-    used_params = []
-    for i in range(len(dat)):
-        n = n + len(dat[i].L)
-    w = Num.zeros((n,n))
-    n = 0
-    for i in range(len(dat)):
-        for j in range(len(dat[i].L)):
-            w[n][n] = (1/dat[i].Ferr[j])**2
-            n = n+1
-                   
-    for i in parameter.keys():
-        if parameter[i][3]:
-            used_params.append(i)
-    
-    b = len(used_params)
-    X = Num.zeros((b,n))
-    
-    for i in range(b):
-        h = parameter[used_params[i]][0] * fpc
-        if h == 0:
-            h = fpc
-        elif h < 0.:
-            h = -h
-        if parameter[used_params[i]][0] -0.5*h >= parameter[used_params[i]][1] and parameter[used_params[i]][0] +0.5*h <= parameter[used_params[i]][2]:
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] -0.5*h
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y1 = extract_values(data)
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] +h
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y2 = extract_values(data)
-            y1 = (y2 - y1)/h
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] -0.5*h
-            
-        elif parameter[used_params[i]][0] -0.5*h < parameter[used_params[i]][1]:
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y1 = extract_values(data)
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] +h
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y2 = extract_values(data)
-            y1 = (y2 - y1)/h
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] -h
-            
-        elif parameter[used_params[i]][0] +0.5*h > parameter[used_params[i]][2]:
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] -h
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y1 = extract_values(data)
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] +h
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y2 = extract_values(data)
-            y1 = (y2 - y1)/h
-            
-        for j in range(n):
-            X[i][j] = y1[j] * parameter[used_params[i]][0] * Num.sqrt(w[j][j])
-
-    data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            
-    V = Num.dot(X, Num.dot( w, Num.transpose(X)))
-    C = Num.zeros((b,b))
-    try:
-        V = R* Num.linalg.inv(V)
-        for i in range(b):
-            for j in range(b):
-                if i == j:
-                    C[i][j] = Num.sqrt(V[i][j])
-                    parameter[used_params[i]][4] = C[i][j]
-                else:
-                    C[i][j] = V[i][j]/Num.sqrt(V[i][i]*V[j][j])
-        keys = parameter.keys()
-        for key in keys:
-            if parameter[key][5] in keys:
-                parameter[key][4] = parameter[parameter[key][5]][4]
-    except:
-        print "There's a hole in the matrix !!! Omit unused or insignificant parameters in the calculation.\n"
-        
-    return parameter, X, C, used_params, R
+    return param_statistics(fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
 
 def single_param_sensitivities(param_label, fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el):
-    n = 0
-    for i in range(len(dat)):
-        n = n + len(dat[i].L)
-    w = Num.zeros((n,n))
-    n = 0
-    for i in range(len(dat)):
-        for j in range(len(dat[i].L)):
-            w[n][n] = (1/dat[i].Ferr[j])**2
-            n = n+1
-
-    X = Num.zeros((n))
-    
-    h = parameter[param_label][0] * fpc
-    if h == 0.:
-        h = fpc
-    elif h < 0.:
-        h = -h
-    if parameter[param_label][0] -0.5*h >= parameter[param_label][1] and parameter[param_label][0] +0.5*h <= parameter[param_label][2]:
-        parameter[param_label][0] = parameter[param_label][0] -0.5*h
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y1 = extract_values(data)
-        parameter[param_label][0] = parameter[param_label][0] +h
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y2 = extract_values(data)
-        y1 = (y2 - y1)/h
-        parameter[param_label][0] = parameter[param_label][0] -0.5*h
-            
-    elif parameter[param_label][0] -0.5*h < parameter[param_label][1]:
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y1 = extract_values(data)
-        parameter[param_label][0] = parameter[param_label][0] +h
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y2 = extract_values(data)
-        y1 = (y2 - y1)/h
-        parameter[param_label][0] = parameter[param_label][0] -h
-            
-    elif parameter[param_label][0] +0.5*h > parameter[param_label][2]:
-        parameter[param_label][0] = parameter[param_label][0] -h
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y1 = extract_values(data)
-        parameter[param_label][0] = parameter[param_label][0] +h
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y2 = extract_values(data)
-        y1 = (y2 - y1)/h
-            
-    for j in range(n):
-        X[j] = y1[j] * parameter[param_label][0] * Num.sqrt(w[j][j])
-
-    data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-    V = Num.dot(X,Num.dot(w,Num.transpose(X)))
-    if V > 0:
-        dp = Num.sqrt(R/V)
-    else:
-        dp = 0.
-
-    return X, dp
-                              
-                              
-                              
-            
-    
-    
+    return param_sensitivity(param_label, fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
@@ -0,0 +1,487 @@
+"""
+Columnar storage for per point data
+
+Notes:
+------
+ColumnStore holds a set of columns (numpy arrays) of equal length
+in buffers whose capacity grows geometrically.  Appending n points
+therefore costs O(n) (amortized), rather than the copy of all
+existing data made by num.append.  The data are accessed through
+views of the filled part of the buffers, e.g.
+  >>store = ColumnStore([('H',float),('K',float),('scan_index',int,(2,))])
+  >>store.extend({'H':[1,1],'K':[0,0],'scan_index':[(0,0),(0,1)]})
+  >>H = store['H']     # view, ie H[0] = 2. modifies the store
+
+ParamColumn holds a per point parameter (e.g. a string label or a
+dictionary of correction parameters) as an array of integer codes
+into a table of the distinct values.  It is indexed like a list:
+  >>lbl = ParamColumn()
+  >>lbl.extend_value('I',100)
+  >>lbl[5]      -> 'I'
+  >>lbl[5] = 'I_c'
+Hashable values are shared by equality, others (e.g. dictionaries)
+by identity, so all points appended with the same dictionary return
+that dictionary.
+
+PointStore is a mixin for the data classes (CtrData, RasdData) that
+keep their per point arrays (self.H etc.) as views of a ColumnStore
+and their per point labels as ParamColumns.
+
+RodIndex maps rounded (H,K) values to the point indicies of each rod,
+sorted by L.  It is updated incrementally as points are added, moved
+or deleted, so selecting a rod (or an L range of a rod) costs O(rod
+size) rather than a pass over all points.
+"""
+##########################################################################
+
+import numpy as num
+
+##########################################################################
+class ColumnStore:
+    """
+    Equal length columns with amortized growth
+    """
+    def __init__(self,columns=[],capacity=16):
+        """
+        Parameters:
+        -----------
+        * columns is a list of (name,dtype) or (name,dtype,shape)
+          tuples, where shape is the shape of each point's entry
+        * capacity is the initial number of points allocated
+        """
+        self.n        = 0
+        self.capacity = max(int(capacity),1)
+        self.names    = []
+        self.buffers  = {}
+        for c in columns:
+            self.add_column(*c)
+
+    def __repr__(self):
+        return "ColumnStore: %i points, columns=%s\n" % (self.n,str(self.names))
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self,name):
+        """ view of the filled part of a column """
+        return self.buffers[name][:self.n]
+
+    def add_column(self,name,dtype=float,shape=()):
+        """
+        Add a (zero filled) column
+        """
+        if name in self.buffers: return
+        self.names.append(name)
+        self.buffers[name] = num.zeros((self.capacity,)+tuple(shape),dtype=dtype)
+
+    def reserve(self,npts):
+        """
+        Make sure there is room for npts points, the capacity is
+        at least doubled when the buffers are reallocated
+        """
+        if npts <= self.capacity: return
+        cap = max(npts,2*self.capacity)
+        for name in self.names:
+            old = self.buffers[name]
+            buf = num.zeros((cap,)+old.shape[1:],dtype=old.dtype)
+            buf[:self.n] = old[:self.n]
+            self.buffers[name] = buf
+        self.capacity = cap
+
+    def extend(self,data):
+        """
+        Append points.  data is a dictionary of arrays (or lists)
+        of equal length keyed by column name.  Columns not in
+        data are zero filled.
+        """
+        npts = None
+        for name in data.keys():
+            if name not in self.buffers: continue
+            m = len(data[name])
+            if npts == None:
+                npts = m
+            elif m != npts:
+                raise ValueError, "Columns must have equal length"
+        if not npts: return
+        self.reserve(self.n + npts)
+        for name in self.names:
+            buf = self.buffers[name]
+            if name in data:
+                buf[self.n:self.n+npts] = num.asarray(data[name],dtype=buf.dtype)
+            else:
+                buf[self.n:self.n+npts] = 0
+        self.n = self.n + npts
+
+    def set_column(self,name,values):
+        """
+        Replace the data of a column (values must have one
+        entry per point)
+        """
+        self.buffers[name][:self.n] = num.asarray(values)[:self.n]
+
+    def take(self,idx,names=None):
+        """
+        Dictionary of the column data for the points in idx.
+        If idx is a slice the arrays are views
+        """
+        if names == None: names = self.names
+        d = {}
+        for name in names:
+            d[name] = self[name][idx]
+        return d
+
+    def delete(self,idx):
+        """
+        Remove the points in idx
+        """
+        keep = num.ones(self.n,dtype=bool)
+        keep[idx] = False
+        m = num.sum(keep)
+        for name in self.names:
+            buf = self.buffers[name]
+            buf[:m] = buf[:self.n][keep]
+        self.n = m
+
+##########################################################################
+class ParamColumn:
+    """
+    Per point parameter column, list-like access to a table of
+    distinct values through integer codes
+    """
+    def __init__(self,values=[]):
+        self.table = []
+        self._keys = {}
+        self._codes = ColumnStore([('code',int)])
+        self.extend(values)
+
+    def __repr__(self):
+        return "ParamColumn: %i points, %i values\n" % (len(self),len(self.table))
+
+    def __getstate__(self):
+        # identity keys are not valid in a new session
+        return {'table':self.table,'_codes':self._codes}
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._keys = {}
+        for j in range(len(self.table)):
+            self._keys[self._key(self.table[j])] = j
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __iter__(self):
+        table = self.table
+        for c in self.codes:
+            yield table[c]
+
+    def __getitem__(self,idx):
+        if isinstance(idx,(int,long,num.integer)):
+            return self.table[self.codes[idx]]
+        return [self.table[c] for c in self.codes[idx]]
+
+    def __setitem__(self,idx,value):
+        self.codes[idx] = self._code(value)
+
+    def _key(self,value):
+        try:
+            hash(value)
+            return (0,value)
+        except TypeError:
+            return (1,id(value))
+
+    def _code(self,value):
+        key = self._key(value)
+        code = self._keys.get(key)
+        if code == None:
+            code = len(self.table)
+            self.table.append(value)
+            self._keys[key] = code
+        return code
+
+    def _get_codes(self):
+        return self._codes['code']
+    codes = property(_get_codes,doc="array of value codes (view)")
+
+    def append(self,value):
+        self.extend_value(value,1)
+
+    def extend(self,values):
+        """ append a list of values """
+        codes = [self._code(v) for v in values]
+        self._codes.extend({'code':codes})
+
+    def extend_value(self,value,npts):
+        """ append npts points with the same value """
+        self._codes.extend({'code':num.repeat(self._code(value),npts)})
+
+    def set_codes(self,table,codes):
+        """
+        Replace the data by a table of distinct values and an
+        array of (per point) codes into the table
+        """
+        self.__setstate__({'table':list(table),
+                           '_codes':ColumnStore([('code',int)])})
+        self._codes.extend({'code':codes})
+
+    def take(self,idx):
+        """ new ParamColumn with the points in idx """
+        new = ParamColumn()
+        new.extend(self[idx])
+        return new
+
+    def delete(self,idx):
+        """ remove the points in idx """
+        self._codes.delete(idx)
+
+    def index(self,value):
+        """ point indicies with the given value """
+        code = self._keys.get(self._key(value))
+        if code == None: return num.array([],dtype=int)
+        return num.where(self.codes == code)[0]
+
+def as_param_column(values):
+    """ values as a ParamColumn (a ParamColumn is returned as is) """
+    if isinstance(values,ParamColumn): return values
+    return ParamColumn(values)
+
+##########################################################################
+class RodIndex:
+    """
+    Index of the points of each rod, keyed by the (H,K) values
+    rounded to hkdecimal decimals.  For each rod the point indicies
+    and L values are kept sorted by L.
+    """
+    def __init__(self,hkdecimal=3):
+        self.hkdecimal = hkdecimal
+        self.npts = 0
+        self.rods = {}
+
+    def __repr__(self):
+        return "RodIndex: %i points, %i rods\n" % (self.npts,len(self.rods))
+
+    def __len__(self):
+        return len(self.rods)
+
+    def key(self,H,K):
+        """ dictionary key of a rod """
+        return (float(num.around(H,decimals=self.hkdecimal)),
+                float(num.around(K,decimals=self.hkdecimal)))
+
+    def keys(self):
+        """ sorted list of the rod (H,K) keys """
+        keys = self.rods.keys()
+        keys.sort()
+        return keys
+
+    def add(self,H,K,L,idx=None):
+        """
+        Add points.  If idx is None the points are appended (ie given
+        the indicies npts, npts+1, ...), otherwise idx are the point
+        indicies (e.g. of points being moved, see update)
+        """
+        H = num.around(num.asarray(H,dtype=float),decimals=self.hkdecimal)
+        K = num.around(num.asarray(K,dtype=float),decimals=self.hkdecimal)
+        L = num.asarray(L,dtype=float)
+        if idx is None:
+            idx = num.arange(self.npts,self.npts+len(L))
+            self.npts = self.npts + len(L)
+        else:
+            idx = num.asarray(idx,dtype=int)
+        if len(L) == 0: return
+        order = num.lexsort((L,K,H))
+        (H,K,L,idx) = (H[order],K[order],L[order],idx[order])
+        brk = num.where((num.diff(H) != 0.) | (num.diff(K) != 0.))[0] + 1
+        start = num.concatenate(([0],brk))
+        stop  = num.concatenate((brk,[len(L)]))
+        for (i0,i1) in zip(start,stop):
+            key = (float(H[i0]),float(K[i0]))
+            rod = self.rods.get(key)
+            if rod == None:
+                self.rods[key] = [idx[i0:i1],L[i0:i1]]
+            else:
+                ridx = num.concatenate((rod[0],idx[i0:i1]))
+                rL   = num.concatenate((rod[1],L[i0:i1]))
+                s    = num.argsort(rL,kind='mergesort')
+                self.rods[key] = [ridx[s],rL[s]]
+
+    def remove(self,points,H=None,K=None,renumber=False):
+        """
+        Remove points from the index.  If the (H,K) values of the
+        points are given only those rods are searched.  If renumber
+        is True the indicies of the following points are shifted down
+        (ie the points are deleted, see delete)
+        """
+        points = num.unique(num.asarray(points,dtype=int))
+        if H is None or renumber:
+            keys = self.rods.keys()
+        else:
+            keys = set([self.key(h,k) for (h,k) in
+                        zip(num.atleast_1d(H),num.atleast_1d(K))])
+        for key in keys:
+            rod = self.rods.get(key)
+            if rod == None: continue
+            keep = ~num.in1d(rod[0],points)
+            ridx = rod[0][keep]
+            if renumber:
+                ridx = ridx - num.searchsorted(points,ridx)
+            if len(ridx) == 0:
+                del self.rods[key]
+            else:
+                self.rods[key] = [ridx,rod[1][keep]]
+
+    def delete(self,points):
+        """ delete points, the following points are renumbered """
+        points = num.unique(num.asarray(points,dtype=int))
+        self.remove(points,renumber=True)
+        self.npts = self.npts - len(points)
+
+    def update(self,points,H,K,L,oldH=None,oldK=None):
+        """
+        Move points to new (H,K,L) values.  oldH and oldK are the
+        previous values (if known)
+        """
+        self.remove(points,H=oldH,K=oldK)
+        self.add(num.atleast_1d(H),num.atleast_1d(K),num.atleast_1d(L),
+                 idx=num.atleast_1d(points))
+
+    def rod(self,H,K):
+        """ point indicies of a rod, sorted by L """
+        rod = self.rods.get(self.key(H,K))
+        if rod == None: return num.array([],dtype=int)
+        return rod[0]
+
+    def select(self,H,K,Lmin,Lmax):
+        """ point indicies of a rod with Lmin <= L <= Lmax, sorted by L """
+        rod = self.rods.get(self.key(H,K))
+        if rod == None: return num.array([],dtype=int)
+        i0 = num.searchsorted(rod[1],Lmin,side='left')
+        i1 = num.searchsorted(rod[1],Lmax,side='right')
+        return rod[0][i0:i1]
+
+    def nearest(self,H,K,L):
+        """ point indicies of a rod with L closest to the given value """
+        rod = self.rods.get(self.key(H,K))
+        if rod == None: return num.array([],dtype=int)
+        j  = num.searchsorted(rod[1],L)
+        lo = max(j-1,0)
+        hi = min(j+1,len(rod[1]))
+        Lnear = rod[1][lo + num.argmin(num.fabs(rod[1][lo:hi] - L))]
+        i0 = num.searchsorted(rod[1],Lnear,side='left')
+        i1 = num.searchsorted(rod[1],Lnear,side='right')
+        return rod[0][i0:i1]
+
+##########################################################################
+class PointStore:
+    """
+    Mixin for data classes with per point columns.  The float
+    columns named in _columns and scan_index (N x 2) are kept in
+    a ColumnStore, self.<column> are views of the store columns.
+    labels ('I','Inorm','Ierr','Ibgr'), corr_params and scan_type
+    are ParamColumns.  If _rod_index is True self.rods is the
+    RodIndex of the points.
+    """
+    _columns   = []
+    _rod_index = False
+
+    def _init_store(self):
+        """
+        Create the columnar data store.  Existing data, e.g. of an
+        instance pickled before the store was used, is copied into
+        the store.
+        """
+        store = ColumnStore([(c,float) for c in self._columns] +
+                            [('scan_index',int,(2,))])
+        if hasattr(self,'L'):
+            old = {}
+            for c in self._columns:
+                old[c] = getattr(self,c)
+            old['scan_index'] = num.reshape(self.scan_index,(-1,2))
+            store.extend(old)
+        self._store = store
+        labels = getattr(self,'labels',{})
+        self.labels = {}
+        for key in ('I','Inorm','Ierr','Ibgr'):
+            self.labels[key] = as_param_column(labels.get(key,[]))
+        self.corr_params = as_param_column(getattr(self,'corr_params',[]))
+        self.scan_type   = as_param_column(getattr(self,'scan_type',[]))
+        self._set_views()
+        if self._rod_index:
+            self.rods = RodIndex()
+            self.rods.add(self.H,self.K,self.L)
+
+    def _set_views(self):
+        for c in self._columns + ['scan_index']:
+            setattr(self,c,self._store[c])
+
+    def _sync_store(self):
+        """
+        Copy data arrays that were replaced (rather than modified
+        in place) back into the store
+        """
+        if not hasattr(self,'_store'):
+            self._init_store()
+            return
+        reindex = False
+        for c in self._columns + ['scan_index']:
+            a = getattr(self,c)
+            if not (isinstance(a,num.ndarray) and a.base is self._store.buffers[c]):
+                self._store.set_column(c,a)
+                if c in ('H','K','L'): reindex = True
+        self._set_views()
+        if self._rod_index and (reindex or not hasattr(self,'rods')):
+            self.rods = RodIndex()
+            self.rods.add(self.H,self.K,self.L)
+
+    def _extend_store(self,new):
+        """
+        Append the point data of a list of _scan_data dictionaries
+        """
+        if len(new) == 0: return
+        cols = {}
+        for c in self._columns:
+            cols[c] = num.concatenate([num.asarray(d[c],dtype=float) for d in new])
+        cols['scan_index'] = num.concatenate([num.reshape(d['scan_index'],(-1,2))
+                                              for d in new])
+        self._store.extend(cols)
+        if self._rod_index:
+            self.rods.add(cols['H'],cols['K'],cols['L'])
+        for d in new:
+            self.labels['I'].extend(d['I_lbl'])
+            self.labels['Inorm'].extend(d['Inorm_lbl'])
+            self.labels['Ierr'].extend(d['Ierr_lbl'])
+            self.labels['Ibgr'].extend(d['Ibgr_lbl'])
+            self.corr_params.extend(d['corr_params'])
+            self.scan_type.extend(d['scan_type'])
+        self._set_views()
+
+    def get_data(self,idx=None,columns=None):
+        """
+        Dictionary of per point data arrays (keyed by column name)
+        for the points in idx (e.g. the points of one rod).  The
+        default is all points, in which case the arrays are views.
+        """
+        self._sync_store()
+        if idx is None: idx = slice(None)
+        return self._store.take(idx,names=columns)
+
+##########################################################################
+def test():
+    store = ColumnStore([('H',float),('scan_index',int,(2,))],capacity=2)
+    for j in range(10):
+        store.extend({'H':[j,j],'scan_index':[(j,0),(j,1)]})
+    print store
+    print store['H'], store['scan_index'][-1]
+    lbl = ParamColumn()
+    d = {'scale':1.}
+    lbl.extend_value(d,5)
+    lbl.extend(['a','b','a'])
+    lbl[0] = 'b'
+    print lbl[1] is d, lbl[0], list(lbl.index('a')), len(lbl.table)
+    rods = RodIndex()
+    rods.add([1,0,1,0.0001],[0,0,0,0],[2.,1.,0.5,3.])
+    rods.delete([1])
+    print rods.keys(), rods.rod(1,0), rods.select(0,0,0,5), rods.nearest(1,0,1.)
+
+if __name__ == "__main__":
+    test()
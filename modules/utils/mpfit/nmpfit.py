@@ -409,6 +409,11 @@ MODIFICATION HISTORY
 
 import numpy
 import types
+try:
+    import scipy.linalg
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
 
 
 #     Original FORTRAN documentation
@@ -857,7 +862,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
         self.machar = machar(double=1)
         machep = self.machar.machep
 
-        if (fcn==None):
+        if (fcn is None):
             self.errmsg = "Usage: parms = mpfit('myfunt', ... )"
             return
 
@@ -870,12 +875,12 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
             return
 
         ## Parameters can either be stored in parinfo, or x. x takes precedence if it exists
-        if (xall == None) and (parinfo == None):
+        if (xall is None) and (parinfo is None):
             self.errmsg = 'ERROR: must pass parameters in P or PARINFO'
             return
 
         ## Be sure that PARINFO is of the right type
-        if (parinfo != None):
+        if (parinfo is not None):
             if (type(parinfo) != types.ListType):
                 self.errmsg = 'ERROR: PARINFO must be a list of dictionaries.'
                 return
@@ -883,15 +888,15 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
                 if (type(parinfo[0]) != types.DictionaryType):
                     self.errmsg = 'ERROR: PARINFO must be a list of dictionaries.'
                     return
-            if ((xall != None) and (len(xall) != len(parinfo))):
+            if ((xall is not None) and (len(xall) != len(parinfo))):
                 self.errmsg = 'ERROR: number of elements in PARINFO and P must agree'
                 return
 
         ## If the parameters were not specified at the command line, then
         ## extract them from PARINFO
-        if (xall == None):
+        if (xall is None):
             xall = self.parinfo(parinfo, 'value')
-            if (xall == None):
+            if (xall is None):
                 self.errmsg = 'ERROR: either P or PARINFO(*)["value"] must be supplied.'
                 return
 
@@ -954,7 +959,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
         limited = self.parinfo(parinfo, 'limited', default=[0,0], n=npar)
         limits = self.parinfo(parinfo, 'limits', default=[0.,0.], n=npar)
 
-        if (limited != None) and (limits != None):
+        if (limited is not None) and (limits is not None):
             ## Error checking on limits in parinfo
             wh = numpy.nonzero((limited[:,0] & (xall < limits[:,0])) |
                                                                     (limited[:,1] & (xall > limits[:,1])))
@@ -1029,7 +1034,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
             numpy.put(self.params, ifree, x)
             if (self.qanytied): self.params = self.tie(self.params, ptied)
 
-            if (nprint > 0) and (iterfunct != None):
+            if (nprint > 0) and (iterfunct is not None):
                 if (((self.niter-1) % nprint) == 0):
                     mperr = 0
                     xnew0 = self.params.copy()
@@ -1038,7 +1043,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
                     status = iterfunct(fcn, self.params, self.niter, self.fnorm**2,
                             functkw=functkw, parinfo=parinfo, quiet=quiet,
                             dof=dof, **iterkw)
-                    if (status != None): self.status = status
+                    if (status is not None): self.status = status
 
                     ## Check for user termination
                     if (self.status < 0):
@@ -1058,7 +1063,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
                                                     epsfcn=epsfcn,
                                                     autoderivative=autoderivative, dstep=dstep,
                                                     functkw=functkw, ifree=ifree, xall=self.params)
-            if (fjac == None):
+            if (fjac is None):
                 self.errmsg = 'WARNING: premature termination by FDJAC2'
                 return
 
@@ -1316,15 +1321,15 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
             catch_msg = 'in the termination phase'
             self.fnorm = self.enorm(fvec)
 
-        if ((self.fnorm != None) and (fnorm1 != None)):
+        if ((self.fnorm is not None) and (fnorm1 is not None)):
             self.fnorm = max([self.fnorm, fnorm1])
             self.fnorm = self.fnorm**2.
 
         self.covar = None
         self.perror = None
         ## (very carefully) set the covariance matrix COVAR
-        if ((self.status > 0) and (nocovar==0) and (n != None)
-                                                and (fjac != None) and (ipvt != None)):
+        if ((self.status > 0) and (nocovar==0) and (n is not None)
+                                                and (fjac is not None) and (ipvt is not None)):
             sz = numpy.shape(fjac)
             if ((n > 0) and (sz[0] >= n) and (sz[1] >= n)
                             and (len(ipvt) >= n)):
@@ -1338,9 +1343,8 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
                 self.covar = numpy.zeros([nn, nn], numpy.float)
 
                 for i in range(n):
-                    #indices = ifree+ifree[i]*n
-                    #numpy.put(self.covar, indices, cv[:,i])
-                    numpy.put(self.covar, i, cv[:,i])
+                    indices = ifree+ifree[i]*nn
+                    numpy.put(self.covar, indices, cv[:,i])
                 ## Compute errors in parameters
                 catch_msg = 'computing parameter errors'
                 self.perror = numpy.zeros(nn, numpy.float)
@@ -1359,7 +1363,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
 
         if (self.debug): print 'Entering defiter...'
         if (quiet): return
-        if (fnorm == None):
+        if (fnorm is None):
             [status, fvec] = self.call(fcn, x, functkw)
             fnorm = self.enorm(fvec)**2
 
@@ -1367,11 +1371,11 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
         nprint = len(x)
         print "Iter ", ('%6i' % iter),"   CHI-SQUARE = ",('%.10g' % fnorm)," DOF = ", ('%i' % dof)
         for i in range(nprint):
-            if (parinfo != None) and (parinfo[i].has_key('parname')):
+            if (parinfo is not None) and (parinfo[i].has_key('parname')):
                 p = '   ' + parinfo[i]['parname'] + ' = '
             else:
                 p = '   P' + str(i) + ' = '
-            if (parinfo != None) and (parinfo[i].has_key('mpprint')):
+            if (parinfo is not None) and (parinfo[i].has_key('mpprint')):
                 iprint = parinfo[i]['mpprint']
             else:
                 iprint = 1
@@ -1399,14 +1403,14 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
     ## Procedure to parse the parameter values in PARINFO, which is a list of dictionaries
     def parinfo(self, parinfo=None, key='a', default=None, n=0):
         if (self.debug): print 'Entering parinfo...'
-        if (n == 0) and (parinfo != None): n = len(parinfo)
+        if (n == 0) and (parinfo is not None): n = len(parinfo)
         if (n == 0):
             values = default
             return(values)
 
         values = []
         for i in range(n):
-            if ((parinfo != None) and (parinfo[i].has_key(key))):
+            if ((parinfo is not None) and (parinfo[i].has_key(key))):
                 values.append(parinfo[i][key])
             else:
                 values.append(default)
@@ -1427,7 +1431,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
         if (self.debug): print 'Entering call...'
         if (self.qanytied): x = self.tie(x, self.ptied)
         self.nfev = self.nfev + 1
-        if (fjac == None):
+        if (fjac is None):
             [status, f] = fcn(x, fjac=fjac, **functkw)
 
             if (self.damp > 0):
@@ -1477,10 +1481,10 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
 
         if (self.debug): print 'Entering fdjac2...'
         machep = self.machar.machep
-        if epsfcn == None:  epsfcn = machep
-        if xall == None:    xall = x
-        if ifree == None:   ifree = numpy.arange(len(xall))
-        if step == None:    step = x * 0.
+        if epsfcn is None:  epsfcn = machep
+        if xall is None:    xall = x
+        if ifree is None:   ifree = numpy.arange(len(xall))
+        if step is None:    step = x * 0.
         nall = len(xall)
 
         eps = numpy.sqrt(max([epsfcn, machep]))
@@ -1514,7 +1518,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
         h = eps * abs(x)
 
         ## if STEP is given, use that
-        if step != None:
+        if step is not None:
             stepi = numpy.take(step, ifree)
             wh = (numpy.nonzero(stepi > 0) )[0]
             if (len(wh) > 0): numpy.put(h, wh, numpy.take(stepi, wh))
@@ -1857,7 +1861,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
 
         for j in range(n):
             r[j:n,j] = r[j,j:n]
-        x = numpy.diagonal(r)
+        x = numpy.diagonal(r).copy()
         wa = qtb.copy()
 
         ## Eliminate the diagonal matrix d using a givens rotation
@@ -2124,7 +2128,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
     ## Procedure to tie one parameter to another.
     def tie(self, p, ptied=None):
         if (self.debug): print 'Entering tie...'
-        if (ptied == None): return
+        if (ptied is None): return
         for i in range(len(ptied)):
             if ptied[i] == '': continue
             cmd = 'p[' + str(i) + '] = ' + ptied[i]
@@ -2202,7 +2206,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
     def calc_covar(self, rr, ipvt=None, tol=1.e-14):
 
         if (self.debug): print 'Entering calc_covar...'
-        if numpy.rank(rr) != 2:
+        if numpy.ndim(rr) != 2:
             print 'ERROR: r must be a two-dimensional matrix'
             return(-1)
         s = numpy.shape(rr)
@@ -2211,7 +2215,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
             print 'ERROR: r must be a square matrix'
             return(-1)
 
-        if (ipvt == None): ipvt = numpy.arange(n)
+        if (ipvt is None): ipvt = numpy.arange(n)
         r = rr.copy()
         r.shape = [n,n]
 
@@ -2257,6 +2261,194 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
 
         return(r)
 
+class lapack_mpfit(mpfit):
+    """
+    mpfit with the linear algebra of the Levenberg-Marquardt steps
+    (pivoted QR factorization, the trust region solve and the
+    covariance) done by LAPACK (through scipy.linalg / numpy.linalg)
+    instead of the column-by-column Householder and Givens loops.
+
+    The arguments, the parinfo limits/ties/fixed semantics and the
+    results are those of mpfit.  This pays off for fits with many free
+    parameters; without scipy the mpfit routines are used.
+    """
+
+    ## Same contract as mpfit.qrfac: the householder vectors of column
+    ## ipvt[j] are stored in a[j:,ipvt[j]] such that the transformation
+    ## is  w - a[j:,lj]*sum(a[j:,lj]*w)/a[j,lj],  the strict upper
+    ## triangle of r is in the rows above, and rdiag holds the diagonal
+    ## of r.  LAPACK's reflectors  I - tau*v*v^T  (v[0] = 1) map to
+    ## this form with  a[j:,lj] = tau*v.
+    def qrfac(self, a, pivot=0):
+        if not HAS_SCIPY: return mpfit.qrfac(self, a, pivot=pivot)
+        if (self.debug): print 'Entering qrfac...'
+        sz = numpy.shape(a)
+        m = sz[0]
+        n = sz[1]
+        acnorm = numpy.sqrt(numpy.sum(a*a, axis=0))
+        if pivot != 0:
+            [(qr, tau), r, ipvt] = scipy.linalg.qr(a, mode='raw', pivoting=True)
+        else:
+            [(qr, tau), r] = scipy.linalg.qr(a, mode='raw')
+            ipvt = numpy.arange(n)
+        minmn = min([m,n])
+        rdiag = numpy.zeros(n, numpy.float)
+        rdiag[0:minmn] = numpy.diagonal(qr)[0:minmn]
+        v = numpy.tril(qr[:,0:minmn], -1)
+        v[numpy.arange(minmn), numpy.arange(minmn)] = 1.
+        qr[:,0:minmn] = numpy.triu(qr[:,0:minmn], 1) + v*tau[0:minmn]
+        a = numpy.zeros((m,n), numpy.float)
+        a[:,ipvt] = qr
+        return([a, ipvt, rdiag, acnorm])
+
+    ## Same contract as mpfit.qrsolv.  S is the triangular factor of
+    ## the stacked system [r ; p^T*d*p], computed with one QR.
+    def qrsolv(self, r, ipvt, diag, qtb, sdiag):
+        if not HAS_SCIPY: return mpfit.qrsolv(self, r, ipvt, diag, qtb, sdiag)
+        if (self.debug): print 'Entering qrsolv...'
+        n = numpy.shape(r)[1]
+        a = numpy.zeros((2*n, n), numpy.float)
+        a[0:n] = numpy.triu(r)
+        a[n+numpy.arange(n), numpy.arange(n)] = numpy.take(diag, ipvt)
+        (q, s) = numpy.linalg.qr(a)
+        wa = numpy.dot(qtb, q[0:n])
+        sdiag = numpy.diagonal(s).copy()
+
+        ## Solve the triangular system for z.  If the system is singular
+        ## then obtain a least squares solution
+        nsing = n
+        wh = (numpy.nonzero(sdiag == 0) )[0]
+        if (len(wh) > 0):
+            nsing = wh[0]
+            wa[nsing:] = 0
+        if (nsing >= 1):
+            wa[0:nsing] = scipy.linalg.solve_triangular(s[0:nsing,0:nsing],
+                                                        wa[0:nsing])
+        ## strict lower triangle of r holds the strict upper one of s
+        lower = numpy.tril_indices(n, -1)
+        r[lower] = s.T[lower]
+        x = numpy.zeros(n, numpy.float)
+        numpy.put(x, ipvt, wa)
+        return(r, x, sdiag)
+
+    ## Same contract as mpfit.lmpar, with the triangular solves done
+    ## by LAPACK
+    def lmpar(self, r, ipvt, diag, qtb, delta, x, sdiag, par=None):
+        if not HAS_SCIPY:
+            return mpfit.lmpar(self, r, ipvt, diag, qtb, delta, x, sdiag, par=par)
+        if (self.debug): print 'Entering lmpar...'
+        dwarf = self.machar.minnum
+        n = numpy.shape(r)[1]
+        rr = numpy.triu(r)
+
+        ## Compute and store in x the gauss-newton direction.  If the
+        ## jacobian is rank-deficient, obtain a least-squares solution
+        nsing = n
+        wa1 = qtb.copy()
+        wh = (numpy.nonzero(numpy.diagonal(r) == 0) )[0]
+        if len(wh) > 0:
+            nsing = wh[0]
+            wa1[wh[0]:] = 0
+        if nsing >= 1:
+            wa1[0:nsing] = scipy.linalg.solve_triangular(rr[0:nsing,0:nsing],
+                                                         wa1[0:nsing])
+        x = numpy.zeros(n, numpy.float)
+        numpy.put(x, ipvt, wa1)
+
+        ## Evaluate the function at the origin, and test for acceptance
+        ## of the gauss-newton direction
+        iter = 0
+        wa2 = diag * x
+        dxnorm = self.enorm(wa2)
+        fp = dxnorm - delta
+        if (fp <= 0.1*delta):
+            return[r, 0., x, sdiag]
+
+        ## Lower bound parl from the newton step (zero if the jacobian
+        ## is rank deficient)
+        parl = 0.
+        if nsing >= n:
+            wa1 = numpy.take(diag, ipvt)*numpy.take(wa2, ipvt)/dxnorm
+            wa1 = scipy.linalg.solve_triangular(rr, wa1, trans='T')
+            temp = self.enorm(wa1)
+            parl = ((fp/delta)/temp)/temp
+
+        ## Upper bound paru
+        wa1 = numpy.dot(qtb, rr)/numpy.take(diag, ipvt)
+        gnorm = self.enorm(wa1)
+        paru = gnorm/delta
+        if paru == 0: paru = dwarf/min([delta,0.1])
+
+        par = max([par,parl])
+        par = min([par,paru])
+        if par == 0: par = gnorm/dxnorm
+
+        ## Beginning of an interation
+        while(1):
+            iter = iter + 1
+
+            ## Evaluate the function at the current value of par
+            if par == 0: par = max([dwarf, paru*0.001])
+            temp = numpy.sqrt(par)
+            wa1 = temp * diag
+            [r, x, sdiag] = self.qrsolv(r, ipvt, wa1, qtb, sdiag)
+            wa2 = diag*x
+            dxnorm = self.enorm(wa2)
+            temp = fp
+            fp = dxnorm - delta
+
+            if ((abs(fp) <= 0.1*delta) or
+                    ((parl == 0) and (fp <= temp) and (temp < 0)) or
+                    (iter == 10)): break;
+
+            ## Compute the newton correction, s^T*wa1 = p^T*d*wa2/dxnorm
+            wa1 = numpy.take(diag, ipvt)*numpy.take(wa2, ipvt)/dxnorm
+            s = numpy.tril(r, -1).T
+            s[numpy.arange(n), numpy.arange(n)] = sdiag
+            wa1 = scipy.linalg.solve_triangular(s, wa1, trans='T')
+
+            temp = self.enorm(wa1)
+            parc = ((fp/delta)/temp)/temp
+
+            ## Depending on the sign of the function, update parl or paru
+            if fp > 0: parl = max([parl,par])
+            if fp < 0: paru = min([paru,par])
+
+            ## Compute an improved estimate for par
+            par = max([parl, par+parc])
+
+        ## Termination
+        return[r, par, x, sdiag]
+
+    ## Same contract as mpfit.calc_covar: p*inverse(r^T*r)*p^T of the
+    ## first l columns with abs(r[l,l]) > tol*abs(r[0,0]), rows and
+    ## columns of the other parameters are zero
+    def calc_covar(self, rr, ipvt=None, tol=1.e-14):
+        if not HAS_SCIPY: return mpfit.calc_covar(self, rr, ipvt=ipvt, tol=tol)
+        if (self.debug): print 'Entering calc_covar...'
+        if numpy.ndim(rr) != 2:
+            print 'ERROR: r must be a two-dimensional matrix'
+            return(-1)
+        s = numpy.shape(rr)
+        n = s[0]
+        if s[0] != s[1]:
+            print 'ERROR: r must be a square matrix'
+            return(-1)
+
+        if (ipvt is None): ipvt = numpy.arange(n)
+        ipvt = numpy.asarray(ipvt)
+        d = abs(numpy.diagonal(rr))
+        wh = (numpy.nonzero(d <= tol*d[0]) )[0]
+        l = n
+        if len(wh) > 0: l = wh[0]
+        covar = numpy.zeros((n,n), numpy.float)
+        if l > 0:
+            rinv = scipy.linalg.solve_triangular(numpy.triu(rr[0:l,0:l]),
+                                                 numpy.identity(l))
+            cv = numpy.dot(rinv, rinv.T)
+            covar[numpy.ix_(ipvt[0:l], ipvt[0:l])] = cv
+        return(covar)
+
 class machar:
     def __init__(self, double=1):
         if (double == 0):
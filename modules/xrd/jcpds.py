@@ -20,6 +20,7 @@ Todo:
 import string 
 import math
 import os
+import numpy as num
 
 #import CARSMath
 
@@ -406,17 +407,55 @@ class jcpds:
       self.alphat = self.alphat0 + self.dalphadt*(temperature-298.)
       self.k0p = self.k0p0 + self.dk0pdt*(temperature-298.)
 
-      if (pressure == 0.):
-         self.v = self.v0 * (1 + self.alphat*(temperature-298.))
-      else:
+      if (pressure != 0.):
          if (self.k0 <= 0.):
             print 'K0 is zero, computing zero pressure volume'
-            self.v = self.v0
          else:
             self.mod_pressure = pressure - \
                                     self.alphat*self.k0*(temperature-298.)
-            v0_v = CARSMath.newton(self.bm3_inverse, 1.)
-            self.v = self.v0/v0_v
+      self.v = float(self.compute_volumes(pressure, temperature))
+
+   def compute_volumes(self, pressure=0., temperature=0.):
+      """
+      Computes the unit cell volume of the material for arrays of
+      pressures and temperatures (see compute_volume).
+
+      Parameters:
+      -----------
+      * pressure: Scalar or array of pressures in GPa.
+            
+      * temperature: Scalar or array of temperatures in K (zero means
+        298K).  pressure and temperature are broadcast against each
+        other.
+
+      Outputs:
+      --------
+      * Array of volumes with the broadcast shape of pressure and
+        temperature.  The Birch-Murnaghan equation is solved for all
+        conditions at once (see bm3_solve).
+
+      Example:
+      --------
+      v = j.compute_volumes(num.linspace(0,100,1000), 300.)
+      """
+      (pressure, temperature) = num.broadcast_arrays(
+                                   num.asarray(pressure, dtype=float),
+                                   num.asarray(temperature, dtype=float))
+      shape = pressure.shape
+      pressure = num.ravel(pressure)
+      temperature = num.where(temperature == 0., 298., num.ravel(temperature))
+      dt = temperature - 298.
+      alphat = self.alphat0 + self.dalphadt*dt
+      k0p = self.k0p0 + self.dk0pdt*dt
+      v = self.v0 * (1 + alphat*dt)
+      if (self.k0 > 0.):
+         hp = (pressure != 0.)
+         if num.any(hp):
+            mod_pressure = pressure[hp] - alphat[hp]*self.k0*dt[hp]
+            v[hp] = self.v0/bm3_solve(mod_pressure, self.k0, k0p[hp])
+      else:
+         v[pressure != 0.] = self.v0
+      return v.reshape(shape)
 
    def bm3_inverse(self, v0_v):
       """
@@ -503,53 +542,96 @@ class jcpds:
       self.b = self.b0 * ratio
       self.c = self.c0 * ratio
 
-      a = self.a
-      b = self.b
-      c = self.c
-      dtor = math.pi/180.
-      alpha = self.alpha * dtor
-      beta = self.beta * dtor
-      gamma = self.gamma * dtor
       refl = self.get_reflections()
-      for r in refl:
-         h = float(r.h)
-         k = float(r.k)
-         l = float(r.l)
-         if (self.symmetry == 'CUBIC'): 
-            d2inv = (h**2 + k**2 + l**2) / a**2
-         elif (self.symmetry == 'TETRAGONAL'): 
-            d2inv = (h**2 + k**2) / a**2 + l**2 / c**2
-         elif (self.symmetry == 'ORTHORHOMBIC'):
-            d2inv = h**2 / a**2 + k**2 / b**2 + l**2 / c**2
-         elif (self.symmetry == 'HEXAGONAL'): 
-            d2inv = (h**2 + h*k + k**2)*4./3./a**2 + l**2/c**2
-         elif (self.symmetry == 'RHOMBOHEDRAL'): 
-            d2inv = (((1. + math.cos(alpha)) * ((h**2 + k**2 + l**2) - 
-                     (1 - math.tan(0.5*alpha)**2)*(h*k + k*l + l*h))) / 
-                     (a**2 * (1 + math.cos(alpha) - 2*math.cos(alpha)**2)))
-         elif (self.symmetry == 'MONOCLINIC'):
-            d2inv = (h**2 / math.sin(beta)**2 / a**2 + 
-                     k**2 / b**2 + 
-                     l**2 / math.sin(beta)**2 / c**2 + 
-                     2 * h * l * math.cos(beta) / (a * c * math.sin(beta)**2))
-         elif (self.symmetry == 'TRICLINIC'):
-            V = (a**2 * b**2 * c**2 * 
-                (1. - math.cos(alpha)**2 - math.cos(beta)**2 - 
-                                                           math.cos(gamma)**2 + 
-                 2 * math.cos(alpha) * math.cos(beta) * math.cos(gamma)))
-            s11 = b**2 * c**2 * math.sin(alpha)**2
-            s22 = a**2 * c**2 * math.sin(beta)**2
-            s33 = a**2 * b**2 * math.sin(gamma)**2
-            s12 = a * b * c**2 * (math.cos(alpha) * math.cos(beta) - 
-                                                           math.cos(gamma))
-            s23 = a**2 * b * c * (math.cos(beta) * math.cos(gamma) - 
-                                                           math.cos(alpha))
-            s31 = a * b**2 * c * (math.cos(gamma) * math.cos(alpha) - 
-                                                           math.cos(beta))
-            d2inv = (s11 * h**2 + s22 * k**2 + s33 * l**2 + 
-                    2.*s12*h*k + 2.*s23*k*l + 2.*s31*l*h) / V**2
-         else:   print 'Unknown crystal symmetry = ' + self.symmetry
-         r.d = math.sqrt(1./d2inv)
+      if len(refl) == 0: return
+      d = ratio * self.compute_d0()
+      for j in range(len(refl)):
+         refl[j].d = float(d[j])
+
+   def cell_parameters(self):
+      """
+      Returns the zero-pressure lattice parameters
+      (a, b, c, alpha, beta, gamma) with the constraints of the
+      symmetry class applied, or None if the symmetry is unknown
+      """
+      a = self.a0
+      b = self.b0
+      c = self.c0
+      alpha = self.alpha
+      beta = self.beta
+      gamma = self.gamma
+      if (self.symmetry == 'CUBIC'):
+         (b, c, alpha, beta, gamma) = (a, a, 90., 90., 90.)
+      elif (self.symmetry == 'TETRAGONAL'):
+         (b, alpha, beta, gamma) = (a, 90., 90., 90.)
+      elif (self.symmetry == 'ORTHORHOMBIC'):
+         (alpha, beta, gamma) = (90., 90., 90.)
+      elif (self.symmetry == 'HEXAGONAL'):
+         (b, alpha, beta, gamma) = (a, 90., 90., 120.)
+      elif (self.symmetry == 'RHOMBOHEDRAL'):
+         (b, c, beta, gamma) = (a, a, alpha, alpha)
+      elif (self.symmetry == 'MONOCLINIC'):
+         (alpha, gamma) = (90., 90.)
+      elif (self.symmetry == 'TRICLINIC'):
+         pass
+      else:
+         print 'Unknown crystal symmetry = ' + self.symmetry
+         return None
+      return (a, b, c, alpha, beta, gamma)
+
+   def hkl_array(self):
+      """
+      Returns an array (n_reflections x 3) of the reflection HKLs
+      """
+      refl = self.get_reflections()
+      return num.array([[r.h, r.k, r.l] for r in refl], dtype=float).reshape(-1,3)
+
+   def compute_d0(self):
+      """
+      Returns an array of the zero-pressure, room temperature D spacings
+      of the reflections, computed from the reciprocal metric tensor of
+      the cell (see d_spacing)
+      """
+      cell = self.cell_parameters()
+      if cell == None:
+         return num.zeros(len(self.get_reflections())) + num.nan
+      return d_spacing(self.hkl_array(), *cell)
+
+   def compute_ds(self, pressure=0., temperature=0.):
+      """
+      Computes the D spacings of all reflections for arrays of
+      pressures and temperatures.
+
+      Parameters:
+      -----------
+      * pressure: Scalar or array of pressures in GPa.
+            
+      * temperature: Scalar or array of temperatures in K (zero means
+        298K).  pressure and temperature are broadcast against each
+        other.
+
+      Outputs:
+      --------
+      * Array [n_conditions, n_reflections] of D spacings, where
+        n_conditions is the size of the broadcast pressure and
+        temperature.  The reflection objects are not modified.
+
+      Notes:
+      ------
+      As in compute_d each cell dimension changes by the cube root of
+      the volume change, so d = d0 * (V/V0)**(1/3) with the volumes
+      of all conditions from compute_volumes.
+          
+      Example:
+      --------
+      Compute the D spacings of alumina along a P ramp at 300 K
+      j=jcpds()
+      j.read_file('alumina.jcpds')
+      d = j.compute_ds(num.linspace(0, 100, 5000), 300.)
+      """
+      v = num.ravel(self.compute_volumes(pressure, temperature))
+      ratio = (v / self.v0)**(1.0/3.0)
+      return ratio[:,num.newaxis] * self.compute_d0()[num.newaxis,:]
 
    def get_reflections(self):
       """
@@ -558,6 +640,72 @@ class jcpds:
       """
       return self.reflections
 
+##########################################################################
+def bm3_pressure(v0_v, k0, k0p):
+   """
+   Third order Birch-Murnaghan pressure for (arrays of) V0/V, K0 and K0'
+   """
+   v0_v = num.asarray(v0_v, dtype=float)
+   x = v0_v**(2./3.)
+   return (1.5*k0*(v0_v**(7./3.) - v0_v**(5./3.)) * 
+           (1 + 0.75*(k0p - 4.) * (x - 1.0)))
+
+def bm3_solve(pressure, k0, k0p, tol=1.e-12, max_iter=100):
+   """
+   Solves the third order Birch-Murnaghan equation for V0/V.
+
+   Parameters:
+   -----------
+   * pressure: Scalar or array of pressures (same units as k0)
+   * k0, k0p: Bulk modulus and its pressure derivative (scalars or
+     arrays that broadcast with pressure)
+   * tol: Relative convergence tolerance of V0/V
+   * max_iter: Maximum number of Newton iterations
+
+   Outputs:
+   --------
+   * Array of V0/V.  All conditions are solved together with Newton
+     steps (analytic derivative) starting from V0/V = 1.
+   """
+   (pressure, k0, k0p) = num.broadcast_arrays(num.asarray(pressure, dtype=float),
+                                             num.asarray(k0, dtype=float),
+                                             num.asarray(k0p, dtype=float))
+   x = num.ones(pressure.shape)
+   for j in range(max_iter):
+      x23 = x**(2./3.)
+      x53 = x23*x
+      x73 = x53*x23
+      g = 1 + 0.75*(k0p - 4.)*(x23 - 1.0)
+      f = 1.5*k0*(x73 - x53)*g - pressure
+      df = 1.5*k0*((7./3.*x73 - 5./3.*x53)*g/x + 
+                   (x73 - x53)*0.5*(k0p - 4.)*x23/x)
+      step = f/df
+      xnew = x - step
+      # keep V0/V positive
+      xnew = num.where(xnew > 0., xnew, 0.5*x)
+      done = num.all(num.abs(xnew - x) <= tol*xnew)
+      x = xnew
+      if done: break
+   return x
+
+def d_spacing(hkl, a, b, c, alpha, beta, gamma):
+   """
+   D spacings of an array (n x 3) of HKLs from the reciprocal metric
+   tensor of the cell (angles in degrees), valid for all symmetry
+   classes
+   """
+   dtor = math.pi/180.
+   (ca, cb, cg) = (math.cos(alpha*dtor), math.cos(beta*dtor), 
+                   math.cos(gamma*dtor))
+   g = num.array([[a*a,   a*b*cg, a*c*cb],
+                  [a*b*cg, b*b,   b*c*ca],
+                  [a*c*cb, b*c*ca, c*c  ]])
+   gs = num.linalg.inv(g)
+   hkl = num.asarray(hkl, dtype=float).reshape(-1,3)
+   d2inv = num.sum(num.dot(hkl, gs) * hkl, axis=1)
+   return 1./num.sqrt(d2inv)
+
+##########################################################################
 def lookup_jcpds_line(in_string, 
                       pressure=0., 
                       temperature=0., 
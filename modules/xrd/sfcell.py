@@ -16,8 +16,115 @@ Todo
 import string
 import numpy as num
 
-import Ifeffit
+try:
+    import Ifeffit
+except ImportError:
+    Ifeffit = None
 from tdl.modules.xtab import atomic
+from tdl.modules.xtab import anomalous
+
+##########################################################################
+def _element(sym):
+    """ element symbol of an atom/ion symbol (e.g. 'Fe3+' -> 'Fe') """
+    el = ''
+    for c in sym.strip():
+        if not c.isalpha(): break
+        el = el + c
+    return el.capitalize()
+
+def _d2inv(hkl,cell=None):
+    """
+    (1/d)^2 of an array (n x 3) of hkls from the reciprocal metric
+    tensor.  cell = (a,b,c) or (a,b,c,alpha,beta,gamma), default
+    is a unit cube
+    """
+    hkl = num.asarray(hkl,dtype=float).reshape(-1,3)
+    if cell is None:
+        return num.sum(hkl*hkl,axis=1)
+    cell = list(cell) + [90.,90.,90.][len(cell)-3:]
+    (a,b,c) = cell[:3]
+    (ca,cb,cg) = num.cos(num.radians(cell[3:6]))
+    g = num.array([[a*a,   a*b*cg, a*c*cb],
+                   [a*b*cg, b*b,   b*c*ca],
+                   [a*c*cb, b*c*ca, c*c  ]])
+    return num.sum(num.dot(hkl,num.linalg.inv(g))*hkl,axis=1)
+
+def structure_factors(hkl,energy,sym,xyz,occ=None,bfac=None,cell=None,
+                      width=0.0,species=None,anom=None):
+    """
+    Structure factors F(hkl,E) for a list of reflections and energies
+
+    Parameters:
+    -----------
+    * hkl is an array (n_hkl x 3) of reflections
+    * energy is an array of energies (eV), or None for the
+      non-resonant structure factors
+    * sym is a list of the atom symbols (n_atoms)
+    * xyz is an array (n_atoms x 3) of fractional coordinates
+    * occ and bfac are arrays of the occupancies (default 1.) and
+      Debye-Waller B factors (default 0.)
+    * cell = (a,b,c) or (a,b,c,alpha,beta,gamma) (default unit cube)
+    * width is the broadening (fwhm, eV) of the tabulated f', f''
+    * species is an optional list of species labels (n_atoms), atoms
+      with the same label share f0, f' and f''.  Default is sym
+    * anom is an optional dictionary {species:(f',f'')} of arrays on
+      the energy grid used instead of the tabulated values (e.g. from
+      diffkk)
+
+    Returns:
+    --------
+    * complex array [n_hkl, n_E] (n_E = 1 if energy is None)
+
+    Notes:
+    ------
+    F = sum_j occ_j*exp(-B_j/(4d^2))*(f0_j + f'_j(E) + i f''_j(E))*exp(2 pi i hkl.r_j)
+    The atoms are grouped by species, the phase sums of each species
+      P_s(hkl) = sum_(j in s) occ_j*exp(-B_j/(4d^2))*exp(2 pi i hkl.r_j)
+    are computed with one array product and f0(q), f', f'' once per
+    species, so F = sum_s P_s(hkl)*(f0_s(q) + f'_s(E) + i f''_s(E))
+    """
+    hkl  = num.asarray(hkl,dtype=float).reshape(-1,3)
+    xyz  = num.asarray(xyz,dtype=float).reshape(-1,3)
+    natm = len(xyz)
+    if occ is None:  occ = num.ones(natm)
+    if bfac is None: bfac = num.zeros(natm)
+    if species == None: species = sym
+    if anom == None: anom = {}
+    occ  = num.asarray(occ,dtype=float)
+    bfac = num.asarray(bfac,dtype=float)
+    # species index of each atom
+    labels = []
+    idx    = num.zeros(natm,dtype=int)
+    for j in range(natm):
+        if species[j] not in labels: labels.append(species[j])
+        idx[j] = labels.index(species[j])
+    nspc = len(labels)
+    # phase sums, [n_hkl, n_species]
+    d2inv = _d2inv(hkl,cell)
+    phase = num.exp(2j*num.pi*num.dot(hkl,xyz.T))
+    phase = phase * occ * num.exp(-num.outer(d2inv,bfac)/4.)
+    select = num.zeros((natm,nspc))
+    select[num.arange(natm),idx] = 1.
+    psum = num.dot(phase,select)
+    # form factors of each species
+    q = num.sqrt(d2inv)/2.
+    spc_sym = [sym[list(idx).index(k)] for k in range(nspc)]
+    f0 = atomic.f0_table(spc_sym,q)
+    if energy is None:
+        return num.sum(psum*f0.T,axis=1)[:,num.newaxis]
+    energy = num.atleast_1d(num.asarray(energy,dtype=float))
+    fp  = num.zeros((nspc,len(energy)))
+    fpp = num.zeros((nspc,len(energy)))
+    tab = [k for k in range(nspc) if not anom.has_key(labels[k])]
+    if len(tab) > 0:
+        (fp[tab],fpp[tab]) = anomalous.f1f2([_element(spc_sym[k]) for k in tab],
+                                            energy,width=width)
+    for k in range(nspc):
+        if anom.has_key(labels[k]):
+            (fp[k],fpp[k]) = anom[labels[k]]
+    # F = sum_s P_s (f0_s + f'_s + i f''_s)
+    sf = num.sum(psum*f0.T,axis=1)[:,num.newaxis] + num.dot(psum,fp + 1j*fpp)
+    return sf
 
 ##########################################################################
 class P1Cell:
@@ -38,14 +145,102 @@ class P1Cell:
                         'edge':'K','rmax':0.}
         self.__file_read = 0
         self.structure_factor = 0.
-        self.iff = Ifeffit.Ifeffit(use_numeric=1)
+        self.iff = None
 
+    def _init_ifeffit(self):
+        """
+        start ifeffit, only needed for the legacy structure_factor
+        calc (calc_structure_factors works without it)
+        """
+        if self.iff != None: return
+        if Ifeffit == None:
+            raise ImportError, "Ifeffit is required for structure_factor"
+        self.iff = Ifeffit.Ifeffit(use_numeric=1)
 
     def do_ifeffit(self,cmd):
         """ execute ifefit command """
         # print cmd
+        self._init_ifeffit()
         self.iff.ifeffit(cmd)
 
+    def _core(self):
+        """
+        (symbol, edge energy, edge width) of the resonant (core)
+        atom, or None if no core atom is defined
+        """
+        coresym = ''
+        for at in self.atoms:
+            if (at['tag'] == self.p1_data['core']):  coresym = at['atom']
+        if (coresym == ''): return None
+        edge = self.p1_data['edge'].lower()
+        fcn_edge = atomic.kedge
+        if (edge == 'l1'): fcn_edge =atomic.l1edge
+        if (edge == 'l2'): fcn_edge =atomic.l2edge
+        if (edge == 'l3'): fcn_edge =atomic.l3edge
+        fcn_width = atomic.kwidth
+        if (edge == 'l1'): fcn_width =atomic.l1width
+        if (edge == 'l2'): fcn_width =atomic.l2width
+        if (edge == 'l3'): fcn_width =atomic.l3width
+        z = atomic.z(_element(coresym))
+        return (coresym, fcn_edge(z), fcn_width(z))
+
+    def energy_grid(self):
+        """
+        energy grid (emin to emax about the core atom edge, step based
+        on the edge width), None if no core atom is defined
+        """
+        core = self._core()
+        if core == None: return None
+        (coresym,e0,ewid) = core
+        estep = ewid
+        if (ewid > 5.0):                 estep = 5.0
+        if (ewid > 1.0  and ewid < 5.0): estep = 1.0
+        if (ewid > 0.5  and ewid < 1.0): estep = 0.5
+        return num.arange(e0+self.p1_data['emin'],
+                          e0+self.p1_data['emax']+estep/2.,estep)
+
+    def calc_structure_factors(self,hkl=None,energy=None,use_diffkk=1):
+        """
+        calculate the structure factors F(hkl,E) of a list of
+        reflections over an energy grid (see structure_factors)
+
+        Parameters:
+        -----------
+        * hkl is an array (n_hkl x 3), default is self.hkl
+        * energy is an array of energies, default is energy_grid()
+          (None if there is no core atom, ie non-resonant)
+        * use_diffkk is a flag to use the f', f'' of the atom
+          diffkk files (columns energy, f', f'')
+
+        Returns:
+        --------
+        * complex array [n_hkl, n_E]
+        """
+        if hkl is None: hkl = self.hkl
+        if energy is None: energy = self.energy_grid()
+        core  = self._core()
+        width = 0.0
+        if core != None: width = core[2]
+        sym     = [at['atom'] for at in self.atoms]
+        xyz     = [(at['x'],at['y'],at['z']) for at in self.atoms]
+        occ     = [at['occupancy'] for at in self.atoms]
+        bfac    = [at['dwf_b'] for at in self.atoms]
+        species = list(sym)
+        anom    = {}
+        if use_diffkk == 1 and energy is not None:
+            for j in range(len(self.atoms)):
+                fname = self.atoms[j].get('diffkk_file','')
+                if len(fname) <= 2: continue
+                species[j] = "%s:%s" % (sym[j],fname)
+                if not anom.has_key(species[j]):
+                    (en,fp,fpp) = anomalous.read_table(fname)
+                    anom[species[j]] = (num.interp(energy,en,fp),
+                                        num.interp(energy,en,fpp))
+        cell = [self.p1_data[p] for p in ('a','b','c','alpha','beta','gamma')]
+        return structure_factors(hkl,energy,sym,xyz,occ=occ,bfac=bfac,
+                                 cell=cell,width=width,species=species,
+                                 anom=anom)
+
     def structure_factor(self,use_diffkk=1):
         """
         calculate structure factor
@@ -54,6 +249,7 @@ class P1Cell:
         if (self.__file_read == 0):
             print 'need to read a p1.inp file before structure factor calc.'
             return sfact
+        self._init_ifeffit()
        
         # determine if we're including resonant corrections (is core atom known?)
         do_resonant = 0
@@ -136,13 +332,16 @@ class P1Cell:
                         f1 = self.iff.get_array("%s.f1" % group)
                         f2 = self.iff.get_array("%s.f2" % group)
                     else:
-                        self.do_ifeffit("f1f2(z=%i, energy=st.energy, group=%s,width=%g)" % (z,sym,ewid))
-                        self.do_ifeffit("set %s.f1 = -1*%s.f1" % (sym,sym))
-                        f1  = self.iff.get_array("%s.f1" % sym)
-                        f2  = self.iff.get_array("%s.f2" % sym)
+                        # tabulated f', f'' (Cromer-Liberman, or Henke
+                        # if no CL values are available, see xtab.anomalous)
+                        (f1,f2) = anomalous.f1f2(z,energy,width=ewid)
+                        src = anomalous.table_source(z)
+                        f1 = -1*f1
+                        self.iff.put_array("%s.f1" % sym, f1)
+                        self.iff.put_array("%s.f2" % sym, f2)
                         if (sym == coresym):
-                            self.do_ifeffit(' newplot st.energy, %s.f1, key="CL f1"' % (sym))
-                            self.do_ifeffit(' plot st.energy, %s.f2, key="CL f2"' % (sym))
+                            self.do_ifeffit(' newplot st.energy, %s.f1, key="%s f1"' % (sym,src))
+                            self.do_ifeffit(' plot st.energy, %s.f2, key="%s f2"' % (sym,src))
                                 
                 f  = f + f1 + 1j*f2
                 # f0 includes the resonant part of non-central atoms
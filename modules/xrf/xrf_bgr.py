@@ -134,7 +134,6 @@ Todo:
 
 #############################################################################
 
-import copy
 import numpy as num
 
 #############################################################################
@@ -260,128 +259,18 @@ class Background:
 
         Parameters:
         -----------
-        * data is the spectrum
+        * data is the spectrum, or a 2D array of spectra
+          (nspectra,nchans) that are fit together
         * slope is the slope of conversion channels to energy
+
+        The background (same shape as data) is stored in self.bgr
         """
-        REFERENCE_AMPL=100.
-        TINY = 1.E-20
-        HUGE = 1.E20
-        MAX_TANGENT=2
-
-        bottom_width = self.bottom_width
-        top_width    = self.top_width
-        exponent     = self.exponent
-        tangent      = self.tangent
-        compress     = self.compress
-
-        #bgr         = copy.copy(data)
-        nchans      = len(data)
-        self.bgr    = num.zeros(nchans,dtype=num.int)
-        scratch     = copy.copy(data)
-
-        # Compress scratch spectrum
-        if (compress > 1):
-            tmp = compress_array(scratch, compress)
-            if tmp == None:
-                compress = 1
-            else:
-                scratch = tmp
-                slope = slope * compress
-                nchans = nchans / compress
-
-        # Copy scratch spectrum to background spectrum
-        bckgnd = copy.copy(scratch)
-
-        # Find maximum counts in input spectrum. This information is used to
-        # limit the size of the function lookup table
-        max_counts = max(scratch)
-
-        ####################################################
-        #  Fit functions which come down from top
-        if (top_width > 0.):
-            #   First make a lookup table of this function
-            chan_width  = top_width / (2. * slope)
-            denom       = chan_width**exponent
-            indices     = num.arange(float(nchans*2+1)) - nchans
-            power_funct = indices**exponent * (REFERENCE_AMPL / denom)
-            power_funct = num.compress((power_funct <= max_counts), power_funct)
-            max_index   = len(power_funct)/2 - 1
-
-            for center_chan in range(nchans):
-                first_chan  = max((center_chan - max_index), 0)
-                last_chan   = min((center_chan + max_index), (nchans-1))
-                f           = first_chan - center_chan + max_index
-                l           = last_chan - center_chan + max_index
-                test        = scratch[center_chan] + power_funct[f:l+1]
-                sub         = bckgnd[first_chan:last_chan+1] 
-                bckgnd[first_chan:last_chan+1] = num.maximum(sub, test)
-
-        # Copy this approximation of background to scratch
-        scratch = copy.copy(bckgnd)
-
-        # Find maximum counts in scratch spectrum. This information is used to
-        #   limit the size of the function lookup table
-        max_counts = max(scratch)
-
-        ####################################################
-        # Fit functions which come up from below
-        bckgnd = num.arange(float(nchans)) - HUGE
-
-        # First make a lookup table of this function
-        chan_width = bottom_width / (2. * slope)
-        if (chan_width == 0.):
-            denom = TINY
-        else:
-            denom = chan_width**exponent
-        
-        indices     = num.arange(float(nchans*2+1)) - nchans
-        power_funct = indices**exponent  * (REFERENCE_AMPL / denom)
-        power_funct = num.compress((power_funct <= max_counts), power_funct)
-        max_index   = len(power_funct)/2 - 1
-
-        for center_chan in range(nchans-1):
-            tangent_slope = 0.
-            if tangent:
-                # Find slope of tangent to spectrum at this channel
-                first_chan    = max((center_chan - MAX_TANGENT), 0)
-                last_chan     = min((center_chan + MAX_TANGENT), (nchans-1))
-                denom         = center_chan - num.arange(float(last_chan - first_chan + 1))
-                # is this correct?
-                denom         = max(max(denom), 1)
-                tangent_slope = (scratch[center_chan] - scratch[first_chan:last_chan+1]) / denom
-                tangent_slope = num.sum(tangent_slope) / (last_chan - first_chan)
-
-            first_chan = max((center_chan - max_index), 0)
-            last_chan  = min((center_chan + max_index), (nchans-1))
-            last_chan  = max(last_chan, first_chan)
-            nc         = last_chan - first_chan + 1
-            lin_offset = scratch[center_chan] + (num.arange(float(nc)) - nc/2) * tangent_slope
-
-            # Find the maximum height of a function centered on this channel
-            # such that it is never higher than the counts in any channel
-
-            f      = first_chan - center_chan + max_index
-            l      = last_chan - center_chan + max_index
-            test   = scratch[first_chan:last_chan+1] - lin_offset + power_funct[f:l+1]
-            height = min(test)
-
-            # We now have the function height. Set the background to the
-            # height of the maximum function amplitude at each channel
-
-            test = height + lin_offset - power_funct[f:l+1]
-            sub  = bckgnd[first_chan:last_chan+1]
-            bckgnd[first_chan:last_chan+1] = num.maximum(sub, test)
-
-        ####################################################
-        # Expand spectrum
-        if (compress > 1):
-            bckgnd = expand_array(bckgnd, compress)
-
-        # Bgr should be positive integers??
-        bgr = bckgnd.astype(int)
-        idx = num.where(bgr <= 0)
-        bgr[idx] = 0
-        self.bgr = bgr
+        self.bgr = calc_bgr(data, slope=slope,
+                            bottom_width=self.bottom_width,
+                            top_width=self.top_width,
+                            exponent=self.exponent,
+                            tangent=self.tangent,
+                            compress=self.compress)
 
     ##################################################################################
     def _update(self,parameters):
@@ -393,6 +282,199 @@ class Background:
         self.bottom_width = parameters[0]
         self.top_width    = parameters[1]
 
+############################################################
+REFERENCE_AMPL = 100.
+TINY           = 1.E-20
+HUGE           = 1.E20
+MAX_TANGENT    = 2
+
+def calc_bgr(data, slope=1.0, bottom_width=4.0, top_width=0.0,
+             exponent=2, tangent=False, compress=4):
+    """
+    Compute the background of one or many spectra
+
+    Parameters:
+    -----------
+    * data is a spectrum or a 2D array of spectra (nspectra,nchans)
+    * slope is the slope of conversion channels to energy
+    * bottom_width, top_width, exponent, tangent and compress
+      are the background parameters (see Background)
+
+    Returns an integer array of the same shape as data
+
+    Notes:
+    ------
+    The envelopes are computed as sliding window max/min's:
+    for each channel offset k in the polynomial lookup table
+    all (center) channels of all spectra are updated at once,
+    rather than looping over center channels.  This gives the
+    same result as the channel by channel calc.  As there, an
+    integer spectrum is compressed with integer division and the
+    top envelope is truncated to integers (the tangents are computed
+    in float, so unsigned spectra do not wrap around).
+    """
+    data    = num.asarray(data)
+    scratch = num.array(data,ndmin=2)
+    if scratch.dtype.kind not in 'iu':
+        scratch = scratch.astype(float)
+    nchans  = scratch.shape[1]
+
+    # Compress scratch spectra
+    if (compress > 1):
+        if ((nchans % compress) != 0):
+            print 'Warning compress must be integer divisor of array length'
+            compress = 1
+        else:
+            scratch = scratch.reshape((len(scratch), nchans/compress, compress))
+            scratch = num.sum(scratch, 2)/compress
+            slope   = slope * compress
+            nchans  = nchans / compress
+
+    ####################################################
+    #  Fit functions which come down from top
+    if (top_width > 0.):
+        chan_width = top_width / (2. * slope)
+        denom      = chan_width**exponent
+        scratch    = _top_envelope(scratch, denom, exponent)
+
+    ####################################################
+    # Fit functions which come up from below
+    integer = scratch.dtype.kind in 'iu'
+    scratch = scratch.astype(float)
+    chan_width = bottom_width / (2. * slope)
+    if (chan_width == 0.):
+        denom = TINY
+    else:
+        denom = chan_width**exponent
+    bckgnd = _bottom_envelope(scratch, denom, exponent, tangent, integer)
+
+    ####################################################
+    # Expand spectra
+    if (compress > 1):
+        bckgnd = num.array([expand_array(b, compress) for b in bckgnd])
+
+    # Bgr should be positive integers??
+    bgr = bckgnd.astype(int)
+    bgr[bgr <= 0] = 0
+    return bgr.reshape(data.shape)
+
+def _power_table(max_counts, nchans, denom, exponent, bottom=False, pad=HUGE):
+    """
+    Polynomial lookup tables of each spectrum, limited to values
+    <= the max counts of the spectrum.
+
+    Returns (table,K,max_index), where table[s,K+k] is the polynomial
+    value at channel offset k (= channel - center channel) for spectrum
+    s, and pad for offsets outside the window of that spectrum.
+    max_index[s] is the half width of the window
+    """
+    indices     = num.arange(float(nchans*2+1)) - nchans
+    power_funct = indices**exponent * (REFERENCE_AMPL / denom)
+    pfs = []
+    ks  = []
+    max_index = num.zeros(len(max_counts),dtype=int)
+    for s in range(len(max_counts)):
+        pf = num.compress((power_funct <= max_counts[s]), power_funct)
+        max_index[s] = len(pf)/2 - 1
+        if max_index[s] >= 0:
+            k = num.arange(-max_index[s], max_index[s]+1)
+        elif bottom and len(pf) > 0:
+            # only the next channel is in the window
+            k = num.array([1])
+        else:
+            k = num.array([],dtype=int)
+        pfs.append(pf[max_index[s]+k])
+        ks.append(k)
+    K = max([1] + [num.max(num.abs(k)) for k in ks if len(k)])
+    table = num.zeros((len(max_counts), 2*K+1)) + pad
+    for s in range(len(max_counts)):
+        table[s, K+ks[s]] = pfs[s]
+    return (table, K, max_index)
+
+def _top_envelope(scratch, denom, exponent):
+    """
+    Max of the concave up polynomials centered on each channel
+    (truncated to the dtype of scratch)
+    """
+    (nspec, nchans) = scratch.shape
+    (table, K, max_index) = _power_table(num.max(scratch,1), nchans, denom,
+                                         exponent, pad=-num.inf)
+    bckgnd = scratch.copy()
+    for k in range(-K, K+1):
+        # center channels i0..i1-1, channels i0+k..i1+k-1
+        i0 = max(0, -k)
+        i1 = min(nchans, nchans-k)
+        if i1 <= i0: continue
+        test = scratch[:,i0:i1] + table[:,K+k:K+k+1]
+        sub  = bckgnd[:,i0+k:i1+k]
+        bckgnd[:,i0+k:i1+k] = num.maximum(sub, test)
+    return bckgnd
+
+def _bottom_envelope(scratch, denom, exponent, tangent, integer=False):
+    """
+    Max of the concave down polynomials that are centered on each
+    channel (but the last) and just touch the spectrum.  integer
+    is True for integer spectra (see below)
+    """
+    (nspec, nchans) = scratch.shape
+    (table, K, max_index) = _power_table(num.max(scratch,1), nchans, denom,
+                                         exponent, bottom=True, pad=num.inf)
+    ncen = nchans - 1
+    cen  = num.arange(ncen)
+
+    # Find slope of tangent to spectrum at each channel
+    tangent_slope = num.zeros((nspec, ncen))
+    if tangent and ncen > 0:
+        tdenom = num.maximum(cen, 1).astype(float)
+        for d in range(-MAX_TANGENT, MAX_TANGENT+1):
+            j  = num.clip(cen + d, 0, nchans-1)
+            ok = (cen + d >= 0) & (cen + d <= nchans-1)
+            tangent_slope = num.where(ok, tangent_slope +
+                                      (scratch[:,cen] - scratch[:,j]) / tdenom,
+                                      tangent_slope)
+        first_chan = num.maximum(cen - MAX_TANGENT, 0)
+        last_chan  = num.minimum(cen + MAX_TANGENT, nchans-1)
+        tangent_slope = tangent_slope / (last_chan - first_chan)
+        if integer:
+            # the channel by channel calc used integer division
+            # for the first channel of integer spectra
+            tangent_slope[:,0] = num.floor(tangent_slope[:,0])
+
+    # The linear offset of a center channel is referenced to the
+    # middle of its window (first_chan + nc/2)
+    max_index  = max_index[:,num.newaxis]
+    first_chan = num.maximum(cen - max_index, 0)
+    last_chan  = num.minimum(cen + max_index, nchans-1)
+    last_chan  = num.maximum(last_chan, first_chan)
+    nc         = last_chan - first_chan + 1
+    offset     = first_chan + nc/2
+
+    # Find the maximum height of a function centered on each channel
+    # such that it is never higher than the counts in any channel
+    height = num.zeros((nspec, ncen)) + num.inf
+    for k in range(-K, K+1):
+        i0 = max(0, -k)
+        i1 = min(ncen, nchans-k)
+        if i1 <= i0: continue
+        lin  = scratch[:,i0:i1] + (cen[i0:i1] + k - offset[:,i0:i1]) * \
+               tangent_slope[:,i0:i1]
+        test = scratch[:,i0+k:i1+k] - lin + table[:,K+k:K+k+1]
+        height[:,i0:i1] = num.minimum(height[:,i0:i1], test)
+
+    # Set the background to the height of the maximum function
+    # amplitude at each channel
+    bckgnd = num.zeros((nspec, nchans)) + (num.arange(float(nchans)) - HUGE)
+    for k in range(-K, K+1):
+        i0 = max(0, -k)
+        i1 = min(ncen, nchans-k)
+        if i1 <= i0: continue
+        lin  = scratch[:,i0:i1] + (cen[i0:i1] + k - offset[:,i0:i1]) * \
+               tangent_slope[:,i0:i1]
+        test = height[:,i0:i1] + lin - table[:,K+k:K+k+1]
+        sub  = bckgnd[:,i0+k:i1+k]
+        bckgnd[:,i0+k:i1+k] = num.maximum(sub, test)
+    return bckgnd
+
 ############################################################
 def compress_array(array, compress):
    """
@@ -449,6 +531,10 @@ def test():
     bgr = Background(bottom_width=4.,compress=4)
     bgr.calc(data,slope=slope)
     print bgr
+    # integer counts, a stack of spectra
+    idata = num.array([data,2*data]).astype(int)
+    ibgr = calc_bgr(idata,slope=slope,bottom_width=4.,top_width=1.,compress=4)
+    print ibgr.dtype, ibgr.shape, num.all(ibgr[0] <= idata[0])
     pyplot.plot(en,bgr.bgr,'r')
     #
     pyplot.show()
@@ -763,8 +763,8 @@ class XrfSpectrum:
         # Prep and call lsq
         self._preFit(guess=guess)
         functkw = {'fit':self}
-        m = mpfit.mpfit(_fit_peaks, parinfo=self.parinfo, functkw=functkw, 
-                        quiet=quiet, xtol=self.tolerance, maxiter=self.max_iter)
+        m = mpfit.lapack_mpfit(_fit_peaks, parinfo=self.parinfo, functkw=functkw,
+                               quiet=quiet, xtol=self.tolerance, maxiter=self.max_iter)
 
         # Make sure final results are updated
         self._update(m.params)
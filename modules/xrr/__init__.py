@@ -4,3 +4,4 @@ reflection standing wave data
 """
 from .xref import RefModel
 from .interface_model import Layer, Model
+from .ref_fit import RefFit, FitParam
@@ -21,29 +21,9 @@ Todo:
 * Add plotting specific component/element profiles.  
 
 * Fitting/modeling (single and mult spectra)
-  * new class holds:
-        [{'params':{},'R':[],'FY':[]}, ...]
-        params = {'energy':10000,'fyidx':'Fe','fyenergy':'Fe Ka',etc}
-
-  * First make a script/function to model/plot the sequence
-
+  * see ref_fit.RefFit for joint R/FY fitting with linked parameters
   * Area correction for data
 
-  * loop through and compute R/FY for each
-    - fitting loop compute total (wieghted) residual
-    
-  * need a parameter map - set of (linked) parameters...
-    - list of params with some corresponding list of identifier for where
-      they plug into the model (maybe mult. places).  eg. sig of interface
-      dist for 2 components may be the same 'parameter'
-    - may be able to do using lambda's / eval expressions (inefficient)....
-       param[0] = 10.
-       param_map[0] = ['self.model.slab.distpar[0].inter[0]['sig']',
-                       'self.model.slab.distpar[1].inter[0]['sig']']
-       for var in param_map[0]:
-           src = "%s=%f" % (var, param[0])
-           eval(src)
-
 * Allow constructing stiochiometry of species from wt% numbers
   ==> see species.set in compound.py
   
@@ -63,6 +43,9 @@ from tdl.modules.xtab     import xrf_lookup
 from tdl.modules.utils  import elements
 from tdl.modules.utils  import compound
 
+# max number of cached distribution profiles
+MAX_BASIS = 2000
+
 #######################################################################
 class Layer(compound.Material):
     """
@@ -205,6 +188,25 @@ class DistParams:
         """
         pass
     
+###########################################################################
+def _dist_key(dist,interface='i'):
+    """
+    Cache key of the unit profile of a distribution
+    """
+    key = (interface,dist['type'],dist.get('zst'),dist.get('zen'),
+           dist.get('cen'),dist.get('sig'))
+    if dist['type'] == 'linear':
+        key = key + (dist.get('CX'),dist.get('CXen'))
+    return key
+
+def _dist_ampl(dist):
+    """
+    Amplitude of a distribution profile
+    (linear profiles include the amplitudes)
+    """
+    if dist['type'] == 'linear': return 1.0
+    return dist['CX']
+
 ###########################################################################
 class Slab:
     """
@@ -268,7 +270,10 @@ class Slab:
         self.zidx   = []      # which layer z belongs to, len=numz
         self.d      = []      # thickness of each z segment, len=numz
         self.sig    = []      # roughnesses, len=numz-1
+        self.zc     = []      # z-values at the center of each slab, len=numz
         self.layer_range = [] # zrange etc spanned by each layer
+        self._zkey  = None    # layer geometry of the z grid
+        self._basis = {}      # cached distribution profiles
         ### distribution
         self.distpar = []     # component dist parameters, len = numX 
         self.CX      = []     # component concetrations, mole/cm^3, shape=(numX,numz)
@@ -277,6 +282,8 @@ class Slab:
         self.rhoscale = True  # flag for rescaling dist ampls given density constraint
         self.CZ      = []     # element concentrations, mole/cm^3, shape=(numEl,numz)
         self.fZ      = []     # element mole fractions, shape=(numEl,numz) 
+        self._nuZ    = []     # moles element per mole comp, shape=(numEl,numX)
+        self._amuZ   = []     # element amu's, shape=(numEl,)
         ###
         self.init()
 
@@ -335,6 +342,10 @@ class Slab:
         for mat in self.layer:
             _add(mat)
         self.elem_z = num.array(self.elem_z,dtype=num.double)
+        self._nuZ   = num.array([[comp.nuZ(el) for comp in self.comp]
+                                 for el in self.elem],dtype='float')
+        self._nuZ   = self._nuZ.reshape((len(self.elem),len(self.comp)))
+        self._amuZ  = num.array([elements.amu(el) for el in self.elem],dtype='float')
 
         ### Get 'interface' volume
         ### (excluding top and bottom layers)
@@ -405,6 +416,16 @@ class Slab:
         else:
             return cidx
         
+    ########################################################################
+    def _geom_key(self):
+        """
+        Layer geometry that defines the z grid
+        """
+        key = [float(self.delta)]
+        for mat in self.layer:
+            key.append((num.abs(float(mat.thickness)),num.abs(float(mat.roughness))))
+        return tuple(key)
+
     ########################################################################
     def _init_z(self,):
         """
@@ -421,66 +442,46 @@ class Slab:
         * If delta > 0 , we turn off roughness at top of
           any interface layer.
         * To index use: self.z[num.where(self.zidx==layer)]
+        * The grid is only rebuilt if the layer thicknesses,
+          roughnesses or delta changed (see _geom_key).  The
+          cached distribution basis profiles are reset when
+          the grid changes
         """
-        self.z      = []    # z-values, len=numz
-        self.zidx   = []    # which layer z belongs to, len=numz
-        self.d      = []    # thickness of each z segment, len=numz
-        self.sig    = []    # roughnesses, len=numz-1 (ignore top)
+        key = self._geom_key()
+        if key == self._zkey: return
         #
         delta0 = float(self.delta)
         nlayer = len(self.layer)
-        zb     = 0.0
-        zt     = 0.0
+        thick  = num.array([k[0] for k in key[1:]],dtype='float')
+        rough  = num.array([k[1] for k in key[1:]],dtype='float')
+        # number of slabs per layer
+        nn = num.ones(nlayer,dtype='int')
+        if delta0 > 0:
+            nn[1:-1] = num.ceil(thick[1:-1]/delta0).astype('int')
+        step = thick/num.maximum(nn,1)
+        # bottom of each layer, z=0 at the top of the substrate
+        zbot = num.zeros(nlayer,dtype='float')
+        zbot[0] = -1.0*thick[0]
+        zbot[1:-1] = num.cumsum(thick[1:-1]) - thick[1:-1]
+        zbot[-1] = num.sum(thick[1:-1])
+        # slab index within each layer
+        zzidx = num.repeat(num.arange(nlayer),nn)
+        first = num.cumsum(nn) - nn
+        nslab = num.arange(len(zzidx)) - first[zzidx]
         #
-        for j in range(nlayer):
-            mat    = self.layer[j]
-            thick  = num.abs(float(mat.thickness))
-            rough  = num.abs(float(mat.roughness))
-            # sustrate
-            if j == 0:
-                zz     = num.array([-1.0*thick])
-                zzidx  = num.array([0])
-                dd     = num.array([thick])
-                sig    = num.array([rough])
-            # top
-            elif j == nlayer - 1:
-                zz     = num.concatenate((zz, num.array([zt])) )
-                zzidx  = num.concatenate((zzidx, num.array([j])) )
-                dd     = num.concatenate((dd, num.array([thick])))
-                # ignore top sig
-                # sig  = num.concatenate((sig, num.array([rough])))
-            # slab using layer thick
-            elif delta0 <= 0:
-                zz     = num.concatenate((zz, num.array([zt])) )
-                zt     = zt + thick
-                zzidx  = num.concatenate((zzidx, num.array([j])) )
-                dd     = num.concatenate((dd, num.array([thick])))
-                sig    = num.concatenate((sig, num.array([rough])))
-            # slabify interface layer
-            else:
-                zt     = zt + thick
-                nn     = num.ceil((zt-zb)/delta0)
-                delta  = (zt-zb)/nn
-                #
-                tmp    = num.arange(zb,zt,delta,dtype='float')
-                zz     = num.concatenate((zz,tmp))
-                #
-                tmp    = num.ones(len(tmp),dtype='float')
-                zzidx  = num.concatenate((zzidx,tmp*(j)))
-                dd     = num.concatenate((dd,tmp*delta))
-                #
-                tmp    = num.zeros(len(tmp),dtype='float')
-                sig    = num.concatenate((sig,tmp))
-                # no sigs for slabified!!
-                #sig[len(sig)-1] = rough 
-                #
-                zb = zt
-                
-        #############
-        self.z     = zz
+        self.z     = zbot[zzidx] + nslab*step[zzidx]
         self.zidx  = zzidx.astype('int')
-        self.d     = dd
-        self.sig   = sig
+        self.d     = step[zzidx]
+        # ignore top sig, no sigs for slabified!!
+        if delta0 > 0:
+            sig = num.zeros(len(zzidx),dtype='float')
+            sig[0] = rough[0]
+        else:
+            sig = rough[zzidx]
+        self.sig   = sig[:-1]
+        self.zc    = self.z + self.d/2.
+        self._zkey  = key
+        self._basis = {}
         self._get_zrange()
 
     ########################################################################
@@ -490,16 +491,15 @@ class Slab:
         """
         self.layer_range = []
         nlayer = len(self.layer)
+        nz    = num.bincount(self.zidx,minlength=nlayer)
+        first = num.cumsum(nz) - nz
         for idx in range(nlayer):
             xx = {}
-            idx = num.where(self.zidx==idx)
-            zz  = self.z[idx]
-            nz  = len(zz)
-            xx['nz']     = nz
-            xx['zmin']   = zz[0]
-            xx['zmax']   = zz[nz-1]
-            xx['idxmin'] = idx[0][0]
-            xx['idxmax'] = idx[0][-1]
+            xx['nz']     = nz[idx]
+            xx['zmin']   = self.z[first[idx]]
+            xx['zmax']   = self.z[first[idx]+nz[idx]-1]
+            xx['idxmin'] = first[idx]
+            xx['idxmax'] = first[idx]+nz[idx]-1
             self.layer_range.append(xx)
 
     def get_zidx(self,z):
@@ -511,6 +511,14 @@ class Slab:
         idx = num.where(zz == min(zz))
         return idx[0][0]
     
+    def _get_zidx_array(self,z):
+        """
+        Get the (first) idx closest to each value of the array z
+        """
+        z = num.asarray(z,dtype='float')
+        if len(z) == 0: return num.zeros(0,dtype='int')
+        return num.argmin(num.abs(self.z[num.newaxis,:] - z[:,num.newaxis]),axis=1)
+
     ########################################################################
     def _init_dist(self):
         """
@@ -624,65 +632,40 @@ class Slab:
                               component distribution amplitudes 
         Note we are trying to keep the memory locations of 
         self.fZ and self.rho fixed in the calc.  
+
+        The element concentrations are computed from the component
+        concentrations with matrix products:
+           CZ  = nuZ * CX   (nuZ[el,comp] = moles el per mole comp)
+           rho = amuZ * CZ
         """
-        # reset self.CX, assume array sizes havent changed
-        # compute self.CX
-        self.CX.fill(0.0)
+        # compute self.CX (in place, assume array sizes havent changed)
+        self._calc_CX()
         ncomp = len(self.distpar)
-        for cidx in range(ncomp):
-            self._calc_dist(cidx)
-
-        # other arrays (these dont need to be reset)
-        #self.CZ.fill(0.0)
-        #self.fZ.fill(0.0)
-        #self.rho.fill(0.0)
-        CZ   = num.zeros(self.CZ.shape)
-        fZ   = num.zeros(self.fZ.shape)
-        rho  = num.zeros(self.rho.shape)
 
         # compute elem conc and slab densities
-        nelem = len(self.elem)
-        for j in range(nelem):
-            el = self.elem[j]
-            amu = elements.amu(el)
-            for k in range(ncomp):
-                nu    = self.comp[k].nuZ(el)
-                CZ[j] = CZ[j] + self.CX[k] * nu
-            rho = rho + CZ[j] * amu
-            fZ[j] = CZ[j] * self.d
+        CZ  = num.dot(self._nuZ,self.CX)
+        rho = num.dot(self._amuZ,CZ)
+        fZ  = CZ * self.d
         denom = fZ.sum(0)
-        if num.min(denom) > 0:
+        if len(denom) and num.min(denom) > 0:
             fZ = fZ / denom
 
         # see if there are density constraints
-
+        f = None
         # scale to substrate
         if (self.rhoflag == 1) and (rho[1]>0):
-            # rescale density
             f = rho[0]/rho[1]
-            rho[1:-1] = f*(rho[1:-1])
-            # rescale CZ
-            for j in range(nelem):
-                CZ[j][1:-1] = f*(CZ[j][1:-1])
-            # rescale CX
-            for k in range(ncomp):
-                self.CX[k][1:-1] = f*(self.CX[k][1:-1])
-                # adjust ampls
-                if self.rhoscale == True:
-                    self._scale_dist_ampl(k,scale=f)
         # scale to top
         elif (self.rhoflag == 2) and (rho[-2]>0):
-            # rescale density
             f = rho[-1]/rho[-2]
-            rho[1:-1] = f*(rho[1:-1])
-            # rescale CZ
-            for j in range(nelem):
-                CZ[j][1:-1] = f*(CZ[j][1:-1])
-            # rescale CX
-            for k in range(ncomp):
-                self.CX[k][1:-1] = f*(self.CX[k][1:-1])
-                # adjust ampls
-                if self.rhoscale == True:
+        if f != None:
+            # rescale density, CZ and CX
+            rho[1:-1]     = f*(rho[1:-1])
+            CZ[:,1:-1]    = f*(CZ[:,1:-1])
+            self.CX[:,1:-1] = f*(self.CX[:,1:-1])
+            # adjust ampls
+            if self.rhoscale == True:
+                for k in range(ncomp):
                     self._scale_dist_ampl(k,scale=f)
  
         # This should keep the original
@@ -692,87 +675,69 @@ class Slab:
         self.rho.flat[:] = rho.ravel()[:]
     
     ########################################################################
-    def _calc_dist(self,cidx):
+    def _calc_CX(self):
         """
+        Compute the component concentrations self.CX
+
         Notes:
         ------
-        All (interface) distributions are assumed to be of form:
+        All distributions are assumed to be of form:
            CX[cidx][zrange]= CX[cidx][zrange] + dist['CX']*f(z[zrange])
           
         ie the total component distribution is a sum over indidual dists
         and each distribution is assumed to have a 'scale' = dist['CX']
         that weights to contribution.  This allows us apply normalization
-        factors to the distr parameters (ie make normalization stick)
+        factors to the distr parameters (ie make normalization stick).
+        The unit profiles f(z) of all distributions are rows of a basis
+        matrix (see _dist_basis), so for ndist distributions
+           CX = S * (ampl * basis)
+        where S[cidx,jdist] = 1 if dist j belongs to component cidx.
 
         if self.distpar[cidx].norm == 0  no normalization
         if self.distpar[cidx].norm == 1  mass balance is conserved
         if self.distpar[cidx].norm == 2  normalize to substrate concentration
         if self.distpar[cidx].norm == 3  normalize to top concentration
         """
-        # gather all params
-        dpar = [self.distpar[cidx].subs]
-        for dist in self.distpar[cidx].inter:
-            dpar.append(dist)
-        dpar.append(self.distpar[cidx].top)
-
-        # loop over dist's and add to self.CX
-        # for dist in dpar:
-        ndist = len(dpar)
-        dist = None
-        for j in range(ndist):
-            # set interface flag
-            if (j == 0):
-                interface='s'
-            elif (j==ndist-1):
-                interface='t'
-            else:
-                interface='i'
-            #
-            dist = dpar[j]
-            if dist['type'] == 'box':
-                self._calc_box(dist,cidx,interface=interface)
-            elif dist['type'] in ('erf','erfc'):
-                self._calc_erf(dist,cidx,interface=interface)
-            elif dist['type'] in ('exp','expc'):
-                self._calc_exp(dist,cidx,interface=interface)
-            elif dist['type'] == 'gauss':
-                self._calc_gauss(dist,cidx,interface=interface)
-            elif dist['type'] == 'linear':
-                self._calc_linear(dist,cidx,interface=interface)
+        ncomp = len(self.distpar)
+        dists = []
+        iface = []
+        owner = []
+        for cidx in range(ncomp):
+            dpar = self.distpar[cidx]
+            dd   = [dpar.subs] + dpar.inter + [dpar.top]
+            dists.extend(dd)
+            iface.extend(['s'] + ['i']*len(dpar.inter) + ['t'])
+            owner.extend([cidx]*len(dd))
+        if len(dists) == 0:
+            self.CX.fill(0.0)
+            return
+        basis = self._dist_basis(dists,iface)
+        ampl  = num.array([_dist_ampl(dist) for dist in dists],dtype='float')
+        S = num.zeros((ncomp,len(dists)),dtype='float')
+        S[owner,num.arange(len(dists))] = 1.0
+        CX = num.dot(S,ampl[:,num.newaxis]*basis)
 
         # check normalization
-
+        norm = num.array([dpar.norm for dpar in self.distpar])
+        f = num.ones(ncomp,dtype='float')
         # fixed mass bal
-        if self.distpar[cidx].norm == 1:
-            f = 1.0
-            moles     = self._comp_mb(cidx)
-            moles_tot = self.distpar[cidx].totNX
-            if moles > 0:
-                f = (moles_tot/moles)
-            self.CX[cidx][1:-1] = f*(self.CX[cidx][1:-1])
-            # adjust amplitudes
-            if self.distpar[cidx].scale_to_norm == True:
-                self._scale_dist_ampl(cidx,scale=f)
-
+        moles     = (CX[:,1:-1]*self.d[1:-1]).sum(1)*1.e-8
+        moles_tot = num.array([dpar.totNX for dpar in self.distpar],dtype='float')
+        idx = (norm == 1) & (moles > 0)
+        f[idx] = moles_tot[idx]/moles[idx]
         # fixed first point
-        elif (self.distpar[cidx].norm == 2):
-            f = 1.0
-            if self.CX[cidx][1] != 0:
-                f = self.CX[cidx][0]/self.CX[cidx][1]
-            self.CX[cidx][1:-1] = f*(self.CX[cidx][1:-1])
-            # adjust amplitudes
-            if self.distpar[cidx].scale_to_norm == True:
-                self._scale_dist_ampl(cidx,scale=f)
-
+        idx = (norm == 2) & (CX[:,1] != 0)
+        f[idx] = CX[idx,0]/CX[idx,1]
         # fixed end point
-        elif (self.distpar[cidx].norm == 3):
-            f = 1.0
-            if self.CX[cidx][-2] != 0:
-                f = self.CX[cidx][-1]/self.CX[cidx][-2]
-            self.CX[cidx][1:-1] = f*(self.CX[cidx][1:-1])
-            # adjust amplitudes
-            if self.distpar[cidx].scale_to_norm == True:
-                self._scale_dist_ampl(cidx,scale=f)
+        idx = (norm == 3) & (CX[:,-2] != 0)
+        f[idx] = CX[idx,-1]/CX[idx,-2]
+        CX[:,1:-1] = f[:,num.newaxis]*CX[:,1:-1]
+        self.CX[:] = CX
+        # adjust amplitudes
+        for cidx in range(ncomp):
+            if self.distpar[cidx].norm in (1,2,3) and \
+               self.distpar[cidx].scale_to_norm == True:
+                self._scale_dist_ampl(cidx,scale=f[cidx])
 
     ########################################################################
     def _scale_dist_ampl(self,cidx,scale=1.):
@@ -786,153 +751,116 @@ class Slab:
             dist['CX'] = scale*(dist['CX'])
 
     ########################################################################
-    def _dist_range(self,dist,interface='i'):
+    def _dist_range(self,dists,iface):
         """
-        Get indicies for distro. These index z array as:
-            zz[idxmin:idxmax+1]
+        Get index ranges for a list of distros. Dist j covers
+        z[idxmin[j]:idxmax[j]+1]
 
         Notes:
         -------
-        interface='i' means constrained to between subs/top
-        interface='s' means subs
-        interface='t' means top
+        iface[j]='i' means constrained to between subs/top
+        iface[j]='s' means subs
+        iface[j]='t' means top
         """
-        numz = len(self.z)
-        #
-        if interface == 's':
-            idxmin = 0
-            idxmax = 0
-            return (idxmin,idxmax)
-        #
-        if interface == 't':
-            idxmin = numz-1
-            idxmax = numz-1
-            return (idxmin,idxmax)
-        #
-        if dist.has_key('zst'):
-            idxmin = self.get_zidx(dist['zst'])
-            if (idxmin < 1): idxmin = 1
-            if (idxmin > numz-2): idxmin = 1
-        else:
-            idxmin = 1
+        numz   = len(self.z)
+        nd     = len(dists)
+        iface  = num.array(iface)
+        idxmin = num.ones(nd,dtype='int')
+        idxmax = num.zeros(nd,dtype='int') + numz-2
         #
-        if dist.has_key('zen'):
-            idxmax = self.get_zidx(dist['zen'])
-            if (idxmax < 1): idxmax = numz-2
-            if (idxmax > numz-2): idxmax = numz-2
-        else:
-            idxmax = numz-2
+        jj = [j for j in range(nd) if dists[j].has_key('zst')]
+        if len(jj) > 0:
+            idx = self._get_zidx_array([dists[j]['zst'] for j in jj])
+            idx[(idx < 1) | (idx > numz-2)] = 1
+            idxmin[jj] = idx
+        jj = [j for j in range(nd) if dists[j].has_key('zen')]
+        if len(jj) > 0:
+            idx = self._get_zidx_array([dists[j]['zen'] for j in jj])
+            idx[idx < 1] = numz-2
+            idx[idx > numz-2] = numz-2
+            idxmax[jj] = idx
         #
+        idxmin[iface == 's'] = 0
+        idxmax[iface == 's'] = 0
+        idxmin[iface == 't'] = numz-1
+        idxmax[iface == 't'] = numz-1
         return (idxmin,idxmax)
 
     ########################################################################
-    def _calc_box(self,dist,cidx,interface='i'):
-        """
-        dist = {'type':'box','zst':10.0,'zen':100,'CX':1.0}
-        """
-        (idxmin,idxmax) = self._dist_range(dist,interface=interface)
-        CX  = dist['CX']
-        self.CX[cidx][idxmin:idxmax+1] = self.CX[cidx][idxmin:idxmax+1] + CX
-
-    ########################################################################
-    def _calc_linear(self,dist,cidx,interface='i'):
-        """
-        dist = {'type':'linear','zst':10.0,'zen':100,'CX':1.0,'CXen':1.0}
-        """
-        CX   = dist['CX']
-        CXen = dist['CXen']
-        (idxmin,idxmax) = self._dist_range(dist,interface=interface)
-        zst   = self.z[idxmin]
-        zen   = self.z[idxmax]
-        denom = num.fabs(zen - zst)
-        if denom == 0.0:
-            print "Error, linear model requires z-range!"
-            return
-        slope = (CXen - CX)/denom
-
-        # compute at center of each increment
-        zz  = self.z[idxmin:idxmax+1] + self.d[idxmin:idxmax+1]/2.
-        #
-        y   = CX + slope*(zz - zst)
-        if y.min() < 0:
-            y[num.where(y<0)] = 0.0
-        #
-        self.CX[cidx][idxmin:idxmax+1] = self.CX[cidx][idxmin:idxmax+1] + y
-    
-    ########################################################################
-    def _calc_erf(self,dist,cidx,interface='i'):
-        """
-        dist = {'type':'erf/c','zst':10.0,'zen':100,
-                'cen':50.0,'sig':100.,'CX':1.0}
-        """
-        CX  = dist['CX']
-        cen = dist['cen']
-        sig = dist['sig']
-        if sig == 0.0: sig = 1.0e-9
-        if dist['type'] == 'erfc': compliment = True
-        else: compliment = False
-
-        # conc values are computed at the center of each increment
-        (idxmin,idxmax) = self._dist_range(dist,interface=interface)
-        zz  = self.z[idxmin:idxmax+1] + self.d[idxmin:idxmax+1]/2.
-        #
-        y   = 0.5*(scipy.special.erf((cen-zz)/(sig/2.))+1.)
-        if compliment:
-            y = 1. - y
-        y  = CX * y
-        #
-        self.CX[cidx][idxmin:idxmax+1] = self.CX[cidx][idxmin:idxmax+1] + y
-
-    ########################################################################
-    def _calc_exp(self,dist,cidx,interface='i'):
+    def _dist_basis(self,dists,iface):
         """
-        dist = {'type':'exp/c','zst':10.0,'zen':100,
-                'cen':50.0,'sig':100.,'CX':1.0}
-        """
-        CX  = dist['CX']
-        cen = dist['cen']
-        sig = dist['sig']
-        if sig == 0.0: sig = 1.0e-9
-        if dist['type'] == 'expc': compliment = True
-        else: compliment = False
-
-        # conc values are computed at the center of each increment
-        (idxmin,idxmax) = self._dist_range(dist,interface=interface)
-        zz  = self.z[idxmin:idxmax+1] + self.d[idxmin:idxmax+1]/2.
-        #
-        if compliment:
-            y   = num.exp((zz-cen)/(sig))
-        else:
-            y   = num.exp((cen-zz)/(sig))
-        y[y>1.] = 1.
-        y  = CX * y
-        #
-        self.CX[cidx][idxmin:idxmax+1] = self.CX[cidx][idxmin:idxmax+1] + y
+        Unit amplitude profiles of a list of distributions on the
+        z grid, returns an array of shape (ndist,numz).
 
-    ########################################################################
-    def _calc_gauss(self,dist,cidx,interface='i'):
-        """
-        dist = {'type':'gauss','zst':10.0,'zen':100,
-                'cen':50.0,'sig':100.,'CX':1.0}
+        Notes:
+        ------
+        Profiles are cached (keyed by the shape parameters of the
+        distribution) until the z grid changes, so changing only
+        the amplitudes (dist['CX']) does not recompute them.  The
+        profiles not in the cache are computed for all distributions
+        of the same type at once.  Conc values are computed at the
+        center of each increment.  The supported types are:
+          dist = {'type':'box','zst':10.0,'zen':100,'CX':1.0}
+          dist = {'type':'linear','zst':10.0,'zen':100,'CX':1.0,'CXen':1.0}
+          dist = {'type':'erf/c','zst':10.0,'zen':100,
+                  'cen':50.0,'sig':100.,'CX':1.0}
+          dist = {'type':'exp/c','zst':10.0,'zen':100,
+                  'cen':50.0,'sig':100.,'CX':1.0}
+          dist = {'type':'gauss','zst':10.0,'zen':100,
+                  'cen':50.0,'sig':100.,'CX':1.0}
+        The linear profile is not scaled by dist['CX'] (see _dist_ampl)
         """
-        CX   = dist['CX']
-        cen  = dist['cen']
-        sig  = dist['sig']
-        
-        # conc values are computed at the center of each increment
-        (idxmin,idxmax) = self._dist_range(dist,interface=interface)
-        zz  = self.z[idxmin:idxmax+1] + self.d[idxmin:idxmax+1]/2.
-        
-        # Note below amp is 'correct' gaussian
-        # ampl, ie makes the distribution normalized
-        # such that the integral is equal to CX
-        #      amp = CX/(sig*num.sqrt(2*num.pi))
-        # Use this amp instead so that max of dist = CX
-        amp = CX
-        #
-        y   = amp*num.exp( -1.*(zz-cen)**2. / (2.*(sig**2.)) )
-        #
-        self.CX[cidx][idxmin:idxmax+1] = self.CX[cidx][idxmin:idxmax+1] + y
+        numz = len(self.z)
+        keys = [_dist_key(dists[j],iface[j]) for j in range(len(dists))]
+        new  = {}
+        for j in range(len(dists)):
+            if self._basis.has_key(keys[j]) or new.has_key(keys[j]): continue
+            new[keys[j]] = j
+        if len(self._basis) + len(new) > MAX_BASIS: self._basis = {}
+        # compute the missing profiles, grouped by type
+        groups = {}
+        for j in new.values():
+            groups.setdefault(dists[j]['type'],[]).append(j)
+        for (ty,jj) in groups.items():
+            dd = [dists[j] for j in jj]
+            (idxmin,idxmax) = self._dist_range(dd,[iface[j] for j in jj])
+            zi  = num.arange(numz)
+            msk = (zi >= idxmin[:,num.newaxis]) & (zi <= idxmax[:,num.newaxis])
+            zz  = self.zc[num.newaxis,:]
+            err = num.seterr(all='ignore')
+            if ty == 'box':
+                y = num.ones((len(jj),numz),dtype='float')
+            elif ty == 'linear':
+                CX   = num.array([d['CX'] for d in dd],dtype='float')[:,num.newaxis]
+                CXen = num.array([d['CXen'] for d in dd],dtype='float')[:,num.newaxis]
+                zst   = self.z[idxmin][:,num.newaxis]
+                denom = num.fabs(self.z[idxmax] - self.z[idxmin])[:,num.newaxis]
+                if num.min(denom) == 0.0:
+                    print "Error, linear model requires z-range!"
+                    msk = msk & (denom != 0.0)
+                y = CX + (CXen - CX)/denom*(zz - zst)
+                y[y < 0] = 0.0
+            elif ty in ('erf','erfc','exp','expc','gauss'):
+                cen = num.array([d['cen'] for d in dd],dtype='float')[:,num.newaxis]
+                sig = num.array([d['sig'] for d in dd],dtype='float')[:,num.newaxis]
+                if ty != 'gauss': sig[sig == 0.0] = 1.0e-9
+                if ty in ('erf','erfc'):
+                    y = 0.5*(scipy.special.erf((cen-zz)/(sig/2.))+1.)
+                    if ty == 'erfc': y = 1. - y
+                elif ty == 'exp':
+                    y = num.minimum(num.exp((cen-zz)/(sig)),1.)
+                elif ty == 'expc':
+                    y = num.minimum(num.exp((zz-cen)/(sig)),1.)
+                else:
+                    # max of dist = CX (not the normalized gaussian ampl)
+                    y = num.exp( -1.*(zz-cen)**2. / (2.*(sig**2.)) )
+            else:
+                y = num.zeros((len(jj),numz),dtype='float')
+            num.seterr(**err)
+            y = num.where(msk,y,0.0)
+            for k in range(len(jj)):
+                self._basis[keys[jj[k]]] = y[k]
+        return num.array([self._basis[key] for key in keys])
 
     ########################################################################
     def _comp_mb(self,cidx):
@@ -1161,8 +1089,16 @@ class Model:
         -----------
         * delta is the slab thickness
           use delta <= 0 for just slabs...
+
+        If the layers are those of the current slab model it is
+        re-initialized, and the z grid and distribution profiles
+        are reused if the layer geometry did not change
         """
-        self.slab = Slab(self.layer,delta=delta)
+        if self.slab != None and self.slab.layer is self.layer:
+            self.slab.delta = delta
+            self.slab.init()
+        else:
+            self.slab = Slab(self.layer,delta=delta)
         self._initR = True
 
     #######################################################################
@@ -1200,6 +1136,24 @@ class Model:
             self._init_ref()
         self.ref.calc_FY()
 
+    def calc_energies(self,energies,theta=None,fyel=None,fyenergy=None):
+        """
+        Calc reflectivity (and FY) for a set of energies, see
+        RefModel.calc_energies.  FY is computed for fyel, or if fyel
+        is None for the FY element of the model (if it is set and
+        in the model).  Returns R or (Y,R) arrays of shape
+        (n_energy,n_theta)
+        """
+        fy = (fyel != None)
+        if fyel == None:
+            fyel = self.params.get('fyel')
+        self.set_param(fyel=fyel,fyenergy=fyenergy)
+        if not fy:
+            fy = (self.params.get('fyidx',-1.) >= 0)
+        if self._initR:
+            self._init_ref()
+        return self.ref.calc_energies(energies,theta=theta,fy=fy)
+
     #######################################################################
     #def set_param(self,energy=None,el=None,fyenergy=None):
     def set_theta(self,theta):
@@ -1274,7 +1228,7 @@ class Model:
         if self.ref:
             params = self.ref.get_params()
         else:
-            params = DEFAULT_PARAMS
+            params = copy.copy(DEFAULT_PARAMS)
         params.update(self.params)
         return params
 
@@ -0,0 +1,607 @@
+"""
+Least squares fitting of reflectivity / reflection FY data
+
+Authors/Modifications:
+----------------------
+* agent (agent@local)
+
+Notes:
+------
+A RefFit instance holds an interface_model.Model, a list of data
+sets and a list of fit parameters.  Each data set is a dictionary:
+    {'theta':[],'R':[],'Rerr':[],'FY':[],'FYerr':[],'params':{}, ...}
+where params are the reflectivity/FY parameters of the measurement
+(energy, fyel, fyenergy etc., see xref.RefModel.set_params).  R and
+FY data of all data sets are fit jointly, the residual of each data
+set being weighted by wR and wFY (chi^2 weights).
+
+Each fit parameter (FitParam) maps one value onto one or more places
+in the model (linked parameters), given as target tuples:
+    ('layer',j,'thickness')      layer j thickness, density or roughness
+    ('dist',comp,didx,key)       distribution parameter key (e.g. 'sig',
+                                 'cen','CX') of component comp, didx is
+                                 the interface distribution index or
+                                 'top'/'subs'
+    ('param',key)                calc parameter (e.g. 'rscale','wconv')
+                                 applied to all data sets
+Layer parameters require the model to be re-slabified, which resets
+the component distributions.  Use the setup argument (a function
+called as setup(model) after each slabify) to re-create distributions.
+
+The fit is a Levenberg-Marquardt minimization with a finite
+difference Jacobian.  The slab model of each Jacobian column is
+built in Python, and the reflectivity kernel (wrxrr._XrayRefl) calls
+for all columns and data sets are then submitted together to the
+Parallel Python job server (if available).  The f', f'' and mu
+values of each data set are computed once (via the model's
+RefModel) and reused in all kernel calls.
+
+Example:
+--------
+>>fit = RefFit(model,delta=5.)
+>>fit.add_data(theta,R=R,Rerr=Rerr,FY=FY,params={'energy':10000.,
+               'fyel':'Fe','fyenergy':'Fe Ka'})
+>>fit.add_param('sig',10.,vmin=0.,targets=[('dist','Fe2_O3',0,'sig')])
+>>fit.add_param('rho1',2.4,targets=[('layer',1,'density')])
+>>fit.fit()
+>>print fit
+"""
+#######################################################################
+
+import types, copy
+import numpy as num
+
+from tdl.modules.xrr import wrxrr
+from tdl.modules.xrr.xref import DEFAULT_PARAMS, calc_factors
+from tdl.modules.xtab import xrf_lookup
+from tdl.modules.utils import elements
+
+try:
+    import pp
+    parallel = True
+except ImportError:
+    parallel = False
+
+# the job server is started by the first parallel calc
+jobserver = None
+
+def get_jobserver():
+    """ the shared Parallel Python job server """
+    global jobserver
+    if jobserver == None: jobserver = pp.Server()
+    return jobserver
+
+#######################################################################
+
+# order of the parameters in the calc_params array (see wrxrr)
+CALC_PARAMS = ['energy','wconv','slen','bvert','bhorz','aflag','fyidx',
+               'fyenergy','adet','tnorm','rflag','delz','pdepth','rscale']
+
+LAYER_PARAMS = ['thickness','density','roughness']
+
+#######################################################################
+def calc_kernel(calc_params,d,rho,sigma,comp,elem_z,fp,fpp,amu,mu_at,theta):
+    """
+    Compute reflectivity and FY with the C library for one slab model.
+    All arrays are numpy double arrays (see wrxrr._XrayRefl).  This
+    is the unit of work shipped to the job server.
+
+    Returns (R,Y)
+    """
+    ker = wrxrr._XrayRefl()
+    ker.nlayer = len(d)
+    ker.nelem  = len(elem_z)
+    ker.nthet  = len(theta)
+    ker.calc_params = calc_params
+    ker.d      = d
+    ker.rho    = rho
+    ker.sigma  = sigma
+    ker.comp   = comp
+    ker.elem_z = elem_z
+    ker.fp     = fp
+    ker.fpp    = fpp
+    ker.amu    = amu
+    ker.mu_at  = mu_at
+    ker.theta  = theta
+    ker._calc(init_ptrs=True,init_arrs=True)
+    return (ker.R, ker.Y)
+
+#######################################################################
+class FitParam:
+    """
+    Fit parameter
+    """
+    def __init__(self,name,value=0.0,vmin=None,vmax=None,fixed=False,
+                 targets=[],step=None):
+        """
+        Parameters:
+        -----------
+        * name is the parameter name
+        * value is the (initial) value
+        * vmin, vmax are the limits (None for no limit)
+        * fixed is a flag to hold the parameter fixed
+        * targets is a list of target tuples (see module notes)
+        * step is the finite difference step (default is
+          1e-3*value, or 1e-3 if value is zero)
+        """
+        self.name    = name
+        self.value   = float(value)
+        self.vmin    = vmin
+        self.vmax    = vmax
+        self.fixed   = fixed
+        self.targets = list(targets)
+        self.step    = step
+        self.error   = 0.0
+
+    def __repr__(self):
+        lout = "%-12s = %12.6g +/- %-10.4g" % (self.name,self.value,self.error)
+        if self.fixed: lout = lout + " (fixed)"
+        return lout
+
+    def clip(self,value):
+        if self.vmin != None: value = max(value,self.vmin)
+        if self.vmax != None: value = min(value,self.vmax)
+        return value
+
+#######################################################################
+class RefFit:
+    """
+    Joint least squares fit of reflectivity and FY data sets
+    """
+    def __init__(self,model,delta=None,setup=None,fpc=1.0e-3):
+        """
+        Parameters:
+        -----------
+        * model is an interface_model.Model instance
+        * delta is the slab thickness used when the model is
+          re-slabified (default is that of the current slab)
+        * setup is an optional function called as setup(model)
+          after each slabify (e.g. to add distributions)
+        * fpc is the default relative finite difference step
+        """
+        self.model  = model
+        if delta == None:
+            if model.slab != None: delta = model.slab.delta
+            else: delta = 10.
+        self.delta  = delta
+        self.setup  = setup
+        self.fpc    = fpc
+        self.data   = []
+        self.params = []
+        # results
+        self.chi2   = None
+        self.redchi2 = None
+        self.covar  = None
+        self.niter  = 0
+        self.nfev   = 0
+        #
+        self._fcache = {}
+        if self.model.slab == None or self.setup != None:
+            self._slabify()
+        # the model parameters (model.get_params) are those of the
+        # model.ref RefModel, init it once so that all evaluations
+        # use the same parameters
+        if self.model.ref == None:
+            self.model._init_ref()
+
+    def __repr__(self):
+        lout = "==== RefFit: %i data sets, %i parameters ====\n" % (len(self.data),
+                                                                  len(self.params))
+        for p in self.params:
+            lout = "%s%s\n" % (lout,repr(p))
+        if self.chi2 != None:
+            lout = "%schi2 = %g, reduced chi2 = %g, iterations = %i\n" % (lout,
+                            self.chi2,self.redchi2,self.niter)
+        return lout
+
+    ##################################################################
+    def add_data(self,theta,R=None,Rerr=None,FY=None,FYerr=None,params={},
+                 wR=1.0,wFY=1.0,logR=True,fyscale=True):
+        """
+        Add a data set
+
+        Parameters:
+        -----------
+        * theta is the array of angles (degrees)
+        * R, Rerr are the reflectivity data and errors
+        * FY, FYerr are the fluorescent yield data and errors
+        * params is a dictionary of reflectivity/FY parameters
+          (energy, fyel, fyenergy etc)
+        * wR, wFY are the weights of the R and FY residuals
+        * logR is a flag to fit log10(R) (errors are propagated)
+        * fyscale is a flag to refine a scale factor for the FY
+          data (computed analytically at each step)
+        """
+        ds = {'theta':num.array(theta,dtype=num.double),
+              'R':None,'Rerr':None,'FY':None,'FYerr':None,
+              'params':copy.copy(params),'wR':float(wR),'wFY':float(wFY),
+              'logR':logR,'fyscale':fyscale,'scale':1.0}
+        npts = len(ds['theta'])
+        if R is not None:
+            ds['R'] = num.array(R,dtype=float)
+            if Rerr is None: ds['Rerr'] = num.ones(npts)
+            else:            ds['Rerr'] = num.array(Rerr,dtype=float)
+            if logR:
+                # error of log10(R)
+                if Rerr is None: ds['lRerr'] = num.ones(npts)
+                else: ds['lRerr'] = ds['Rerr']/(num.fabs(ds['R'])*num.log(10.))
+        if FY is not None:
+            ds['FY'] = num.array(FY,dtype=float)
+            if FYerr is None: ds['FYerr'] = num.ones(npts)
+            else:             ds['FYerr'] = num.array(FYerr,dtype=float)
+        self.data.append(ds)
+
+    def add_param(self,name,value=0.0,vmin=None,vmax=None,fixed=False,
+                  targets=[],step=None):
+        """
+        Add a fit parameter (see FitParam)
+        """
+        p = FitParam(name,value=value,vmin=vmin,vmax=vmax,fixed=fixed,
+                     targets=targets,step=step)
+        self.params.append(p)
+        return p
+
+    def get_param(self,name):
+        for p in self.params:
+            if p.name == name: return p
+        return None
+
+    ##################################################################
+    def _slabify(self):
+        self.model.slabify(delta=self.delta)
+        if self.setup != None:
+            self.setup(self.model)
+
+    def _apply(self,values):
+        """
+        Put parameter values into the model and recompute
+        the slab model. Returns the dictionary of calc
+        parameter overrides
+        """
+        layer = self.model.layer
+        relayer = False
+        dist = []
+        calc = {}
+        for (p,v) in zip(self.params,values):
+            for t in p.targets:
+                if t[0] == 'layer':
+                    (j,attr) = (t[1],t[2])
+                    if attr not in LAYER_PARAMS:
+                        raise ValueError, "Unknown layer parameter %s" % attr
+                    if getattr(layer[j],attr) != v:
+                        setattr(layer[j],attr,v)
+                        if attr == 'thickness': layer[j]._compute_vol()
+                        relayer = True
+                elif t[0] == 'dist':
+                    dist.append((t[1],t[2],t[3],v))
+                elif t[0] == 'param':
+                    calc[t[1]] = v
+                else:
+                    raise ValueError, "Unknown parameter target %s" % str(t)
+        if relayer:
+            self._slabify()
+        slab = self.model.slab
+        for (comp,didx,key,v) in dist:
+            cidx = slab._comp_idx(comp)
+            if cidx == -1:
+                raise ValueError, "Unknown component %s" % str(comp)
+            if didx == 'top':    slab.distpar[cidx].top[key] = v
+            elif didx == 'subs': slab.distpar[cidx].subs[key] = v
+            else:                slab.distpar[cidx].inter[didx][key] = v
+        slab.calc_dist()
+        return calc
+
+    def _snapshot(self):
+        """ copy of the slab arrays passed to the kernel """
+        slab = self.model.slab
+        return (num.array(slab.d,dtype=num.double),
+                num.array(slab.rho,dtype=num.double),
+                num.array(slab.sig,dtype=num.double),
+                num.array(slab.fZ,dtype=num.double),
+                num.array(slab.elem_z,dtype=num.double))
+
+    ##################################################################
+    def _ds_params(self,ds,calc={}):
+        """
+        calc_params array of a data set
+        """
+        params = copy.copy(DEFAULT_PARAMS)
+        params.update(self.model.get_params())
+        for key in ('fyel','fyidx'):
+            if params.has_key(key): params.pop(key)
+        params.update(ds['params'])
+        params.update(calc)
+        # fy element index
+        fyidx = -1.
+        fyel = params.pop('fyel',None)
+        if fyel != None:
+            if type(fyel) == types.StringType:
+                fyel = elements.number(fyel.strip())
+            elem_z = list(self.model.slab.elem_z)
+            if fyel in elem_z:
+                fyidx = float(elem_z.index(fyel))
+            else:
+                print "Warning element %s not found" % str(fyel)
+        params['fyidx'] = fyidx
+        fyenergy = params.get('fyenergy')
+        if type(fyenergy) == types.StringType:
+            params['fyenergy'] = 1000.*xrf_lookup.lookup_xrf_line(fyenergy)
+        return num.array([float(params[k]) for k in CALC_PARAMS],dtype=num.double)
+
+    def _factors(self,calc_params,elem_z):
+        """
+        f', f'', amu and mu_at of the model elements for the
+        energy and fy energy of calc_params (cached)
+        """
+        key = (calc_params[0],calc_params[7],tuple(elem_z))
+        if not self._fcache.has_key(key):
+            self._fcache[key] = calc_factors(elem_z,calc_params[0],
+                                             calc_params[7])
+        return self._fcache[key]
+
+    def _jobs(self,values):
+        """
+        Apply values to the model and return the kernel arguments
+        for each data set
+        """
+        calc = self._apply(values)
+        (d,rho,sig,fZ,elem_z) = self._snapshot()
+        args = []
+        for ds in self.data:
+            cp = self._ds_params(ds,calc)
+            (fp,fpp,amu,mu_at) = self._factors(cp,elem_z)
+            args.append((cp,d,rho,sig,fZ,elem_z,fp,fpp,amu,mu_at,ds['theta']))
+        return args
+
+    def _calc_many(self,values_list):
+        """
+        Compute (R,Y) of all data sets for a list of parameter
+        vectors.  The kernel calls are submitted together when
+        Parallel Python is available.
+        """
+        args = []
+        for values in values_list:
+            args.extend(self._jobs(values))
+        self.nfev = self.nfev + len(values_list)
+        if parallel:
+            server = get_jobserver()
+            jobs = [server.submit(calc_kernel,a,(),("numpy as num",
+                    "tdl.modules.xrr.wrxrr as wrxrr")) for a in args]
+            results = [job() for job in jobs]
+        else:
+            results = [calc_kernel(*a) for a in args]
+        nds = len(self.data)
+        return [results[j*nds:(j+1)*nds] for j in range(len(values_list))]
+
+    ##################################################################
+    def _residual(self,results):
+        """
+        Weighted residual vector of all data sets
+        """
+        res = []
+        for (ds,(R,Y)) in zip(self.data,results):
+            if ds['R'] is not None:
+                if ds['logR']:
+                    Rc = num.log10(num.maximum(R,1.0e-300))
+                    r  = (Rc - num.log10(ds['R']))/ds['lRerr']
+                else:
+                    r  = (R - ds['R'])/ds['Rerr']
+                res.append(num.sqrt(ds['wR'])*r)
+            if ds['FY'] is not None:
+                w = 1./ds['FYerr']**2
+                if ds['fyscale']:
+                    den = num.sum(w*Y*Y)
+                    if den > 0: ds['scale'] = num.sum(w*Y*ds['FY'])/den
+                r = (ds['scale']*Y - ds['FY'])/ds['FYerr']
+                res.append(num.sqrt(ds['wFY'])*r)
+        if len(res) == 0: return num.array([])
+        return num.concatenate(res)
+
+    def _values(self,x):
+        """ full parameter vector from the free values x """
+        values = num.array([p.value for p in self.params],dtype=float)
+        values[self._free] = x
+        return values
+
+    def _step(self,j,x):
+        """ forward (or backward near vmax) difference step """
+        p = self.params[self._free[j]]
+        h = p.step
+        if h == None:
+            h = num.fabs(x[j])*self.fpc
+            if h == 0: h = self.fpc
+        if p.vmax != None and x[j] + h > p.vmax: h = -h
+        return h
+
+    def jacobian(self,x,r0=None):
+        """
+        Finite difference Jacobian (m x n) of the residual with
+        respect to the free parameters x.  All columns (and the
+        base point if r0 is None) are computed in one batch.
+        """
+        n = len(x)
+        steps = [self._step(j,x) for j in range(n)]
+        points = []
+        if r0 is None: points.append(self._values(x))
+        for j in range(n):
+            xj = x.copy()
+            xj[j] = xj[j] + steps[j]
+            points.append(self._values(xj))
+        results = self._calc_many(points)
+        if r0 is None:
+            r0 = self._residual(results[0])
+            results = results[1:]
+        scales = [ds['scale'] for ds in self.data]
+        J = num.zeros((len(r0),n))
+        for j in range(n):
+            J[:,j] = (self._residual(results[j]) - r0)/steps[j]
+        # restore the model and FY scales of the base values
+        for (ds,s) in zip(self.data,scales): ds['scale'] = s
+        self._apply(self._values(x))
+        return J, r0
+
+    def residual(self,x=None):
+        """ weighted residual for the free parameter values x """
+        if x is None: x = self._x0()
+        return self._residual(self._calc_many([self._values(x)])[0])
+
+    def _x0(self):
+        self._free = [j for j in range(len(self.params))
+                      if not self.params[j].fixed]
+        return num.array([self.params[j].value for j in self._free],dtype=float)
+
+    def _clip(self,x):
+        return num.array([self.params[self._free[j]].clip(x[j])
+                          for j in range(len(x))],dtype=float)
+
+    ##################################################################
+    def fit(self,maxiter=50,ftol=1.0e-6,lam=1.0e-3,verbose=True):
+        """
+        Levenberg-Marquardt fit of the free parameters.
+
+        Parameters:
+        -----------
+        * maxiter is the maximum number of iterations
+        * ftol is the relative chi2 change for convergence (the fit
+          also stops if the chi2 change is below ftol for chi2 < 1,
+          or if chi2 < ftol**2)
+        * lam is the initial damping factor
+        * verbose is a flag to print the chi2 at each iteration
+
+        On return the parameter values, errors and the results
+        (self.chi2, self.redchi2, self.covar) are set, and the model
+        holds the best fit values.
+        """
+        self.nfev = 0
+        x = self._clip(self._x0())
+        n = len(x)
+        (J,r) = self.jacobian(x)
+        chi2 = num.sum(r*r)
+        self.niter = 0
+        for it in range(maxiter):
+            self.niter = it + 1
+            A = num.dot(J.T,J)
+            g = num.dot(J.T,r)
+            D = num.diag(num.diag(A))
+            D[D == 0] = 1.
+            accept = False
+            while lam < 1.0e10:
+                try:
+                    dx = num.linalg.solve(A + lam*D,-g)
+                except num.linalg.LinAlgError:
+                    lam = lam*10.
+                    continue
+                xn = self._clip(x + dx)
+                rn = self.residual(xn)
+                chi2n = num.sum(rn*rn)
+                if chi2n < chi2:
+                    accept = True
+                    lam = max(lam/10.,1.0e-12)
+                    break
+                lam = lam*10.
+            if not accept:
+                break
+            dchi = chi2 - chi2n
+            (x,chi2) = (xn,chi2n)
+            if verbose: print "Iteration %i: chi2 = %g" % (self.niter,chi2)
+            (J,r) = self.jacobian(x,r0=rn)
+            if (chi2 < ftol**2) or (dchi <= ftol*max(chi2,1.)): break
+        self._results(x,J,r)
+        return x
+
+    def _results(self,x,J,r):
+        """ store values, chi2 and covariance """
+        m = len(r)
+        n = len(x)
+        self.chi2 = num.sum(r*r)
+        dof = max(m-n,1)
+        self.redchi2 = self.chi2/dof
+        try:
+            self.covar = num.linalg.inv(num.dot(J.T,J))*self.redchi2
+            err = num.sqrt(num.fabs(num.diag(self.covar)))
+        except num.linalg.LinAlgError:
+            print "Singular matrix, omit insignificant parameters"
+            self.covar = None
+            err = num.zeros(n)
+        for j in range(n):
+            p = self.params[self._free[j]]
+            p.value = x[j]
+            p.error = err[j]
+        # leave the model at the best fit values
+        self._apply(self._values(x))
+
+    def correlations(self):
+        """
+        Correlation matrix of the free parameters
+        """
+        if self.covar is None: return None
+        sd = num.sqrt(num.fabs(num.diag(self.covar)))
+        sd[sd == 0] = 1.
+        return self.covar/num.outer(sd,sd)
+
+    ##################################################################
+    def calc(self):
+        """
+        Compute R and FY (scaled) of all data sets for the current
+        parameter values, stored as ds['Rcalc'] and ds['FYcalc']
+        """
+        x = self._x0()
+        results = self._calc_many([self._values(x)])[0]
+        self._residual(results)
+        for (ds,(R,Y)) in zip(self.data,results):
+            ds['Rcalc']  = R
+            ds['FYcalc'] = ds['scale']*Y
+
+    def plot(self,fignum=1):
+        """
+        Plot data and calculated R and FY
+        """
+        from matplotlib import pyplot
+        self.calc()
+        pyplot.figure(fignum)
+        pyplot.clf()
+        nds = len(self.data)
+        for j in range(nds):
+            ds = self.data[j]
+            pyplot.subplot(nds,2,2*j+1)
+            pyplot.semilogy()
+            if ds['R'] is not None: pyplot.plot(ds['theta'],ds['R'],'.')
+            pyplot.plot(ds['theta'],ds['Rcalc'])
+            pyplot.ylabel('R')
+            pyplot.subplot(nds,2,2*j+2)
+            if ds['FY'] is not None: pyplot.plot(ds['theta'],ds['FY'],'.')
+            pyplot.plot(ds['theta'],ds['FYcalc'])
+            pyplot.ylabel('FY')
+        pyplot.xlabel("theta (deg)")
+
+############################################################################
+def test():
+    """
+    Fit a calculated data set starting from a perturbed model
+    """
+    from tdl.modules.xrr.interface_model import Layer, Model
+    from tdl.modules.utils import compound
+    N2     = compound.Component(formula={'N':2})
+    qtz    = compound.Component(formula={'Si':1,'O':2})
+    fe2o3  = compound.Component(formula={'Fe':2,'O':3})
+    subs   = Layer(comp=[(qtz,1.),(fe2o3,0.000001)],density=2.65,thickness=1000.,roughness=3.)
+    m1     = Layer(comp=[(qtz,1.),(fe2o3,0.001)],density=2.45,thickness=50.,roughness=3.)
+    top    = Layer(comp=[(N2,1.)],density=0.001,thickness=1000.,roughness=0.)
+    theta  = num.arange(0.01, 1.0, 0.01)
+    params = {'energy':10000.,'wconv':0.01,'slen':20.,'bvert':0.01,'aflag':1.}
+    model  = Model(substrate=subs,layers=[m1],top=top,theta=theta,params=params)
+    fit    = RefFit(model,delta=5.)
+    fit.add_param('rho1',2.45,vmin=0.,targets=[('layer',1,'density')])
+    fit.add_data(theta,params={'fyel':'Fe','fyenergy':'Fe Ka'})
+    fit.calc()
+    ds = fit.data[0]
+    fit.data = []
+    fit.add_data(theta,R=ds['Rcalc'],Rerr=0.02*ds['Rcalc'],FY=ds['FYcalc'],
+                 params={'fyel':'Fe','fyenergy':'Fe Ka'})
+    fit.params[0].value = 2.2
+    fit.fit()
+    print fit
+    return fit
+
+if __name__ == "__main__":
+    test()
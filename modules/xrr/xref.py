@@ -8,10 +8,10 @@ Authors/Modifications:
 Notes:
 ------
 For this module to work correctly you need to ensure that:
-* Ifeffit is installed on the system, and the Ifeffit/bin
-  directory is in the systems search path
-* The tdl/lib directory must also be in the systems path
+* The tdl/lib directory must be in the systems path
   so that gsl dll's can be found (on windows)
+* f' and f'' are taken from the tables of xtab.anomalous
+  (Ifeffit is only used to tabulate elements without a table)
 
 Notes on the calculation:
 -------------------------
@@ -132,9 +132,9 @@ For information about scattering factors see (e.g.)
 import numpy as num
 import exceptions
 
-from Ifeffit  import Ifeffit
 from .wrxrr import _XrayRefl
 from tdl.modules.utils import elements
+from tdl.modules.xtab import anomalous
 
 ###############################################################################
 
@@ -146,6 +146,27 @@ DEFAULT_PARAMS = {'energy':10000.,'wconv':0.01,
                   'adet':90.,'tnorm':1.0,'rflag':1.0,
                   'delz':5.0,'pdepth':3.0,'rscale':1.0}
 
+# 2*Na*r_e*hc (in cm^2*eV*mole/atom)
+FY_CON = 4.20792637233e07
+
+def calc_factors(elem_z,energy,fy_energy):
+    """
+    f', f'', amu and the atomic photo-absorption cross sections
+    mu_at at fy_energy of the elements elem_z (see
+    RefModel.init_energy and RefModel.init_fy)
+    """
+    elem_z = num.array(elem_z,dtype=num.double)
+    (fp,fpp) = anomalous.f1f2(elem_z,energy)
+    fp  = num.array(fp,dtype=num.double).reshape(len(elem_z))
+    fpp = num.array(fpp,dtype=num.double).reshape(len(elem_z))
+    amu = num.array([elements.amu(z) for z in elem_z],dtype=num.double)
+    if fy_energy == 0.0:
+        mu_at = num.zeros(len(elem_z),dtype=num.double)
+    else:
+        (fyfp,fyfpp) = anomalous.f1f2(elem_z,fy_energy)
+        mu_at = FY_CON*num.array(fyfpp,dtype=num.double)/(fy_energy*amu)
+    return (fp,fpp,amu,mu_at)
+
 ###############################################################################
 class RefModel(_XrayRefl):
     """
@@ -169,7 +190,6 @@ class RefModel(_XrayRefl):
         * theta array of theta values (degrees)
         * params is a dictionary of model parameters (see set_params)
         """
-        self.iff = Ifeffit(screen_echo = 0)
         self.nlayer    = 0
         self.nelem     = 0
         self.nthet     = 0
@@ -198,26 +218,26 @@ class RefModel(_XrayRefl):
         be assigned by reference!! See wrxrr._XrayRefl._init_model for
         array creation
         """
-        if d != None:
+        if d is not None:
             self.nlayer = len(d)
             if (d.dtype == DTYPE): self.d = d
             else: raise exceptions.ValueError
             self._init_carr = True
             self._init_ptr = True
         #
-        if rho != None:
+        if rho is not None:
             if len(rho) != self.nlayer: raise exceptions.ValueError
             if (rho.dtype == DTYPE): self.rho = rho
             else: raise exceptions.ValueError
             self._init_ptr = True
         #
-        if sigma != None:
+        if sigma is not None:
             if len(sigma) != self.nlayer-1: raise exceptions.ValueError
             if (sigma.dtype == DTYPE): self.sigma = sigma
             else: raise exceptions.ValueError
             self._init_ptr = True
         #
-        if comp != None:
+        if comp is not None:
             if (comp.dtype != DTYPE): raise exceptions.ValueError
             nel,nz = comp.shape
             if nz != self.nlayer: raise exceptions.ValueError
@@ -228,7 +248,7 @@ class RefModel(_XrayRefl):
                 self._init_fy   = True
             self._init_ptr  = True
         #
-        if elem_z != None:
+        if elem_z is not None:
             if len(elem_z) != self.nelem: raise exceptions.ValueError
             if (elem_z.dtype == DTYPE): self.elem_z = elem_z
             else: raise exceptions.ValueError
@@ -236,7 +256,7 @@ class RefModel(_XrayRefl):
             self._init_fy   = True
             self._init_ptr  = True
         #
-        if theta != None:
+        if theta is not None:
             self.nthet  = len(theta)
             if (theta.dtype == DTYPE): self.theta = theta
             else: raise exceptions.ValueError
@@ -310,7 +330,8 @@ class RefModel(_XrayRefl):
         """
         Change the incident energy of the calc
 
-        get fp,fpp from ifeffit for index of refraction calcs
+        get fp,fpp from the xtab.anomalous tables for index
+        of refraction calcs (all elements in one call)
         """
         if len(self.fp) != self.nelem:
             self.fp    = num.zeros(self.nelem, dtype=num.double)
@@ -319,16 +340,11 @@ class RefModel(_XrayRefl):
             self._init_ptr  = True
 
         energy = self.calc_params[0]
+        (fp,fpp) = anomalous.f1f2(self.elem_z,energy)
+        # fill in place, the arrays are referenced by the c pointers
+        self.fp[:]  = fp
+        self.fpp[:] = fpp
         for j in range(self.nelem):
-            en = [energy, energy + 1.]
-            self.iff.put_array('calc.en',en)
-            cmd = 'f1f2(energy=calc.en,z=%i)' % self.elem_z[j]
-            self.iff.ifeffit(cmd)
-            fp  = self.iff.get_array('calc.f1')
-            fpp = self.iff.get_array('calc.f2')
-            #
-            self.fp[j]  = fp[0]
-            self.fpp[j] = fpp[0]
             self.amu[j] = elements.amu(self.elem_z[j])
 
         self._init_en = False
@@ -336,7 +352,7 @@ class RefModel(_XrayRefl):
     ##########################################################
     def init_fy(self,):
         """
-        Get fpp from ifeffit and use this to est mu_atomic for fy.
+        Get fpp from the xtab.anomalous tables and use this to est mu_atomic for fy.
         This will be a decent estimate for high z and E
         however, these are approx since we are ignoring
         coherent and incoherent scattering cross sections
@@ -346,23 +362,12 @@ class RefModel(_XrayRefl):
             self.mu_at = num.zeros(self.nelem, dtype=num.double)
             self._init_ptr  = True
 
-        #below is 2*Na*r_e*hc (in cm^2*eV*mole/atom)
-        con = 4.20792637233e07
         fy_energy = self.calc_params[7]
         if fy_energy == 0.0:
-            self.mu_at = num.zeros(self.nelem, dtype=num.double)
+            self.mu_at[:] = 0.0
         else:
-            for j in range(self.nelem):
-                en = [fy_energy, fy_energy + 1.]
-                self.iff.put_array('calc.en',en)
-                cmd = 'f1f2(energy=calc.en,z=%i)' % self.elem_z[j]
-                self.iff.ifeffit(cmd)
-                fp  = self.iff.get_array('calc.f1')
-                fpp = self.iff.get_array('calc.f2')
-                fpp = float(fpp[0])
-                mu  = con*fpp/(fy_energy*self.amu[j])
-                #
-                self.mu_at[j] = mu
+            (fp,fpp) = anomalous.f1f2(self.elem_z,fy_energy)
+            self.mu_at[:] = FY_CON*fpp/(fy_energy*self.amu)
         self._init_fy = False
 
     ##########################################################
@@ -413,6 +418,104 @@ class RefModel(_XrayRefl):
         #
         if ret: return (self.Y.copy(), self.R.copy())
 
+    ##########################################################
+    def calc_energies(self,energies,theta=None,fy=False):
+        """
+        Calc reflectivity (and FY) for a set of energies
+
+        Parameters:
+        -----------
+        * energies is an array of incident energies (eV)
+        * theta is an optional theta grid (degrees).  Either one
+          array used for all energies, or a 2D array / list of
+          arrays with one grid per energy
+        * fy is a flag to also compute the FY (see calc_FY)
+
+        Returns:
+        --------
+        * R, or (Y,R) if fy, arrays of shape (n_energy,n_theta).
+          Grids shorter than the longest are padded with nan
+
+        Notes:
+        ------
+        f' and f'' of all elements at all energies are taken from
+        one table lookup (xtab.anomalous).  The model and c arrays
+        and pointers are set up once, only the energy, fp, fpp
+        and theta values are updated in place for each energy.
+        The energy and theta of the model are restored on return.
+        """
+        energies = num.atleast_1d(num.asarray(energies,dtype=num.double))
+        nen = len(energies)
+        if theta is None:
+            thetas = [self.theta]*nen
+        elif num.ndim(theta[0]) == 0:
+            thetas = [theta]*nen
+        else:
+            thetas = list(theta)
+            if len(thetas) != nen:
+                raise exceptions.ValueError, "Need one theta grid per energy"
+        nmax = max([len(t) for t in thetas])
+
+        # checks
+        fyidx0 = self.calc_params[6]
+        if fy:
+            if (fyidx0 < 0.) or (fyidx0 > self.nelem-1):
+                print "Error, fy_idx out of range"
+                return
+            if self.calc_params[11] < 1. :
+                print "Error, zint too small, min = 1 ang."
+                return
+        else:
+            self.calc_params[6] = -1.0
+
+        # set up fp, fpp, amu and mu_at arrays
+        en0 = self.calc_params[0]
+        if self._init_en or len(self.fp) != self.nelem: self.init_energy()
+        if self._init_fy: self.init_fy()
+        (fp,fpp) = anomalous.f1f2(self.elem_z,energies)
+        fp  = num.reshape(fp,(self.nelem,nen))
+        fpp = num.reshape(fpp,(self.nelem,nen))
+
+        # own theta buffer (dont overwrite the callers array)
+        theta0 = self.theta
+        self.theta = num.array(thetas[0],dtype=num.double)
+        if len(self.theta) != self.nthet: self._init_carr = True
+        self.nthet = len(self.theta)
+        self._init_ptr = True
+
+        R = num.zeros((nen,nmax)) + num.nan
+        Y = num.zeros((nen,nmax)) + num.nan
+        for j in range(nen):
+            th = thetas[j]
+            if len(th) != self.nthet:
+                self.theta = num.array(th,dtype=num.double)
+                self.nthet = len(th)
+                self._init_carr = True
+                self._init_ptr  = True
+            else:
+                self.theta[:] = th
+            self.calc_params[0] = energies[j]
+            self.fp[:]  = fp[:,j]
+            self.fpp[:] = fpp[:,j]
+            #
+            self._calc(init_ptrs=self._init_ptr,init_arrs=self._init_carr)
+            self._init_ptr  = False
+            self._init_carr = False
+            #
+            R[j,:self.nthet] = self.R
+            if fy: Y[j,:self.nthet] = self.Y
+
+        # restore
+        self.calc_params[0] = en0
+        self.calc_params[6] = fyidx0
+        self.theta = theta0
+        self.nthet = len(theta0)
+        self._init_en   = True
+        self._init_carr = True
+        self._init_ptr  = True
+        if fy: return (Y,R)
+        return R
+
     ##########################################################
     def make_mole_fractions(self):
         """
@@ -0,0 +1,329 @@
+"""
+Tabulated anomalous scattering factors f' and f''
+
+Notes:
+------
+f' and f'' are interpolated from per element tables, so values for
+arrays of energies and elements are computed in-process without an
+ifeffit round trip per element and energy.  The tables are looked up
+in the directories of TABLE_PATH (the 'f1f2' directory of this
+package, and the directories listed in the TDL_F1F2_PATH environment
+variable).  The package ships the Henke tables (Z = 1-92,
+E = 10-30000 eV, see f1f2/read.me) as a fallback.  Two file formats
+are read:
+
+* <sym>.f1f2:  columns energy (eV), f', f''
+               (e.g. Cromer-Liberman tables as written by Hephaestus
+               or save_table)
+* <sym>.nff:   Henke tables, columns energy (eV), f1, f2 where
+               f1 = Z + f' (f1 = -9999 rows are skipped)
+
+By default (prefer='cl') Cromer-Liberman values are used: a <sym>.f1f2
+table if there is one, else (if ifeffit is available) f' and f'' are
+computed once with ifeffit's f1f2 on the grid EMIN..EMAX (step ESTEP)
+and kept for the session (use save_table to write it to a table
+directory).  Only if neither exists the Henke (.nff) table is used.
+Note the Henke grid is sparse near the edges (e.g. Fe 7079 -> 7112 eV),
+so use CL values for resonant calcs.  With prefer='henke' the .nff
+tables are used first.  F1F2Table.source gives the source of the
+table of each element ('CL' or 'Henke').
+
+Energies outside the range of a table give nan, unless clip=True is
+passed, in which case the table end values are used.
+
+Tables, broadened tables (width > 0, Lorentzian of fwhm width) and
+interpolated values are memoized.
+
+Example:
+--------
+>>(fp,fpp) = f1f2(['Fe','O'],[7100.,7112.,7120.])   # shape (2,3)
+>>(fp,fpp) = f1f2(26,7112.)                         # scalars
+"""
+##########################################################################
+
+import os, types
+import numpy as num
+
+from tdl.modules.xtab import atomic
+
+##########################################################################
+
+TABLE_PATH = [os.path.join(os.path.dirname(os.path.abspath(__file__)),'f1f2')]
+if os.environ.has_key('TDL_F1F2_PATH'):
+    TABLE_PATH = os.environ['TDL_F1F2_PATH'].split(os.pathsep) + TABLE_PATH
+
+# grid for tables computed with ifeffit
+EMIN  = 1000.
+EMAX  = 50000.
+ESTEP = 1.0
+
+# max number of memoized interpolations
+MAX_CACHE = 512
+
+# default table preference, 'cl' or 'henke'
+PREFER = 'cl'
+
+##########################################################################
+def _z(el):
+    """ atomic number from symbol or number """
+    if type(el) == types.StringType:
+        return atomic.z(el.strip())
+    return int(round(el))
+
+def read_table(fname,z=None):
+    """
+    Read a table file, returns arrays (energy,f',f'') sorted
+    by energy.  Henke (.nff) f1 values are converted to f'
+    using the atomic number z
+    """
+    rows = []
+    f = open(fname,'r')
+    for line in f.readlines():
+        tmp = line.split()
+        if len(tmp) < 3: continue
+        try:
+            rows.append([float(tmp[0]),float(tmp[1]),float(tmp[2])])
+        except ValueError:
+            continue
+        # Henke tables have no f1 below 29 eV
+        if rows[-1][1] <= -9999.: rows.pop()
+    f.close()
+    data = num.array(rows,dtype=float)
+    if len(data) == 0:
+        raise ValueError, "No data in table %s" % fname
+    data = data[num.argsort(data[:,0],kind='mergesort')]
+    (en,fp,fpp) = (data[:,0],data[:,1],data[:,2])
+    if fname.lower().endswith('.nff'):
+        if z == None: z = _z(os.path.basename(fname).split('.')[0])
+        fp = fp - z
+    return (en,fp,fpp)
+
+##########################################################################
+class F1F2Table:
+    """
+    Anomalous scattering factor tables of the elements
+    """
+    def __init__(self,path=None,use_ifeffit=True,prefer=PREFER):
+        """
+        Parameters:
+        -----------
+        * path is a list of table directories (default TABLE_PATH)
+        * use_ifeffit is a flag to compute missing tables with ifeffit
+        * prefer is 'cl' (Cromer-Liberman .f1f2 tables or ifeffit,
+          then Henke .nff tables) or 'henke' (.nff tables first)
+        """
+        if path == None: path = TABLE_PATH
+        if prefer not in ('cl','henke'):
+            raise ValueError, "prefer must be 'cl' or 'henke'"
+        self.path        = list(path)
+        self.use_ifeffit = use_ifeffit
+        self.prefer      = prefer
+        self.tables      = {}
+        self.source      = {}
+        self._broad      = {}
+        self._cache      = {}
+        self._iff        = None
+
+    def __repr__(self):
+        lout = "F1F2Table: %i elements loaded\n" % len(self.tables)
+        for p in self.path:
+            lout = "%s  %s\n" % (lout,p)
+        return lout
+
+    ######################################################################
+    def table(self,el):
+        """
+        (energy,f',f'') arrays of an element
+        """
+        z = _z(el)
+        if self.tables.has_key(z):
+            return self.tables[z]
+        sym = atomic.symbol(z).strip()
+        if self.prefer == 'henke':
+            order = ('.nff','.f1f2','ifeffit')
+        else:
+            order = ('.f1f2','ifeffit','.nff')
+        tab = None
+        for ext in order:
+            if ext == 'ifeffit':
+                if self.use_ifeffit: tab = self._ifeffit_table(z)
+            else:
+                fname = self._find_file(sym,ext)
+                if fname != None: tab = read_table(fname,z=z)
+            if tab != None: break
+        if tab == None:
+            raise ValueError, "No f1f2 table for %s" % sym
+        if ext == '.nff': self.source[z] = 'Henke'
+        else:             self.source[z] = 'CL'
+        self.tables[z] = tab
+        return tab
+
+    def _find_file(self,sym,ext):
+        """ first table file <sym><ext> in self.path (or None) """
+        for d in self.path:
+            for name in (sym,sym.lower()):
+                fname = os.path.join(d,name+ext)
+                if os.path.isfile(fname): return fname
+        return None
+
+    def _ifeffit_table(self,z):
+        """ tabulate f', f'' with ifeffit (Cromer-Liberman) """
+        try:
+            if self._iff == None:
+                from Ifeffit import Ifeffit
+                self._iff = Ifeffit(screen_echo = 0)
+        except ImportError:
+            return None
+        en = num.arange(EMIN,EMAX+ESTEP,ESTEP)
+        self._iff.put_array('calc.en',en)
+        self._iff.ifeffit('f1f2(energy=calc.en,z=%i)' % z)
+        fp  = num.array(self._iff.get_array('calc.f1'),dtype=float)
+        fpp = num.array(self._iff.get_array('calc.f2'),dtype=float)
+        return (en,fp,fpp)
+
+    def save_table(self,el,path=None):
+        """
+        Write the table of an element to path (default is the
+        first directory in self.path) as <sym>.f1f2
+        """
+        z = _z(el)
+        (en,fp,fpp) = self.table(z)
+        if path == None: path = self.path[0]
+        if not os.path.isdir(path): os.makedirs(path)
+        fname = os.path.join(path,"%s.f1f2" % atomic.symbol(z).strip())
+        f = open(fname,'w')
+        f.write("# energy(eV)   f'   f''\n")
+        for j in range(len(en)):
+            f.write("%12.4f %14.6f %14.6f\n" % (en[j],fp[j],fpp[j]))
+        f.close()
+        return fname
+
+    ######################################################################
+    def _broadened(self,z,width):
+        """
+        Table convolved with a Lorentzian of fwhm width (eV),
+        computed on a uniform energy grid
+        """
+        key = (z,float(width))
+        if self._broad.has_key(key):
+            return self._broad[key]
+        (en,fp,fpp) = self.table(z)
+        step = min(num.median(num.diff(en)),width/5.)
+        grid = num.arange(en[0],en[-1]+step,step)
+        fp   = num.interp(grid,en,fp)
+        fpp  = num.interp(grid,en,fpp)
+        hw   = width/2.
+        x    = num.arange(-int(20.*width/step),int(20.*width/step)+1)*step
+        kern = hw/(x*x + hw*hw)
+        kern = kern/num.sum(kern)
+        # pad with the end values to avoid edge effects
+        npad = len(x)//2
+        fp   = num.convolve(num.concatenate((num.repeat(fp[0],npad),fp,
+                                             num.repeat(fp[-1],npad))),kern,'valid')
+        fpp  = num.convolve(num.concatenate((num.repeat(fpp[0],npad),fpp,
+                                             num.repeat(fpp[-1],npad))),kern,'valid')
+        self._broad[key] = (grid,fp,fpp)
+        return self._broad[key]
+
+    def f1f2(self,el,energy,width=0.0,clip=False):
+        """
+        f' and f'' for elements el at energies energy (eV)
+
+        Parameters:
+        -----------
+        * el is an atomic symbol or number, or a list/array of them
+        * energy is a scalar or array of energies (eV)
+        * width is an optional Lorentzian broadening (fwhm, eV)
+        * clip is a flag to use the table end values for energies
+          outside the table range (default is nan)
+
+        Returns:
+        --------
+        * (fp,fpp) arrays of shape el.shape + energy.shape
+          (scalars if both are scalars).  Energies outside the
+          table range give nan unless clip is True
+        """
+        if type(el) in (types.ListType,types.TupleType) or \
+           isinstance(el,num.ndarray):
+            zz = num.array([_z(e) for e in num.ravel(num.array(el,dtype=object))])
+            zshape = num.shape(el)
+        else:
+            zz = num.array([_z(el)])
+            zshape = ()
+        energy = num.asarray(energy,dtype=float)
+        en = num.ravel(energy)
+        fp  = num.zeros((len(zz),len(en)))
+        fpp = num.zeros((len(zz),len(en)))
+        ekey = en.tostring()
+        for z in num.unique(zz):
+            key = (z,float(width),bool(clip),ekey)
+            res = self._cache.get(key)
+            if res == None:
+                if width > 0: (te,tfp,tfpp) = self._broadened(z,width)
+                else:         (te,tfp,tfpp) = self.table(z)
+                if clip:
+                    res = (num.interp(en,te,tfp),num.interp(en,te,tfpp))
+                else:
+                    res = (num.interp(en,te,tfp,left=num.nan,right=num.nan),
+                           num.interp(en,te,tfpp,left=num.nan,right=num.nan))
+                if len(self._cache) >= MAX_CACHE: self._cache.clear()
+                self._cache[key] = res
+            fp[zz == z]  = res[0]
+            fpp[zz == z] = res[1]
+        shape = zshape + energy.shape
+        fp  = fp.reshape(shape)
+        fpp = fpp.reshape(shape)
+        if shape == ():
+            return (float(fp),float(fpp))
+        return (fp,fpp)
+
+##########################################################################
+_TABLE = None
+
+def get_table():
+    """ the shared F1F2Table instance """
+    global _TABLE
+    if _TABLE == None: _TABLE = F1F2Table()
+    return _TABLE
+
+def f1f2(el,energy,width=0.0,clip=False):
+    """
+    f' and f'' from the shared table (see F1F2Table.f1f2)
+    """
+    return get_table().f1f2(el,energy,width=width,clip=clip)
+
+def fp(el,energy,width=0.0,clip=False):
+    """ f' from the shared table """
+    return f1f2(el,energy,width=width,clip=clip)[0]
+
+def fpp(el,energy,width=0.0,clip=False):
+    """ f'' from the shared table """
+    return f1f2(el,energy,width=width,clip=clip)[1]
+
+def table_source(el):
+    """ source of the shared table of an element, 'CL' or 'Henke' """
+    tab = get_table()
+    tab.table(el)
+    return tab.source[_z(el)]
+
+##########################################################################
+def test():
+    import tempfile
+    path = tempfile.mkdtemp()
+    en = num.arange(7000.,7200.,1.)
+    f = open(os.path.join(path,'Fe.f1f2'),'w')
+    for e in en:
+        f.write("%g %g %g\n" % (e,-5.*num.exp(-((e-7112.)/5.)**2),
+                                0.5+3.*(e>7112.)))
+    f.close()
+    tab = F1F2Table(path=[path],use_ifeffit=False)
+    print tab.f1f2('Fe',7112.)
+    print tab.f1f2(['Fe',26],[7100.,7112.5,7300.])
+    print tab.f1f2('Fe',[7105.,7112.,7120.],width=2.)
+    # shipped tables
+    tab = F1F2Table(use_ifeffit=False)
+    print tab.f1f2(['Fe','O','Sr'],[7100.,7112.,8000.]), tab.source
+    print tab.f1f2('Fe',40000.), tab.f1f2('Fe',40000.,clip=True)
+
+if __name__ == "__main__":
+    test()
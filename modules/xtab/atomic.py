@@ -26,6 +26,8 @@
     l1width(z)     L1 edge width (eV)
     l2width(z)     L2 edge width (eV)
     l3width(z)     L3 edge width (eV)
+    f0_cromer(elem,q)   Cromer-Mann f0 of an element
+    f0_table(elems,q)   f0 of several elements, array [n_elem, n_q]
     fluor_line(z,line)  emission line for char*8 line: 
         'kalpha'(='kalpha1'), 'kalpha2', 'kalpha3',
         'kbeta' (='kbeta1'),  'kbeta2', 'kbeta3', 'kbeta4', 'kbeta5',
@@ -748,6 +750,62 @@ def f0_cromer(elem, q):
 
     if  (len(q) == 1):  f0 = f0[0]
     return f0
+
+# max number of memoized f0 tables
+F0_MAX_CACHE = 256
+_f0_cache = {}
+
+def f0_coefs(elems, database=None):
+    """
+    Cromer-Mann coefficients (a1,b1,a2,b2,a3,b3,a4,b4,c) of a list
+    of element/valence symbols as an array [n_elem, 9]
+
+    Parameters:
+    -----------
+    * elems is a list of symbols (or a single symbol)
+    * database is an optional dict of coefficients (default f0data)
+    """
+    if database == None: database = f0data
+    if type(elems) in types.StringTypes: elems = [elems]
+    coefs = []
+    for elem in elems:
+        el = elem.lower()
+        if not database.has_key(el):
+            raise ValueError, "element %s not found in tables" % elem
+        coefs.append(database[el][0:9])
+    return num.array(coefs,dtype=float).reshape(len(coefs),9)
+
+def f0_table(elems, q, database=None):
+    """
+    f0 of several elements on a grid of q values in one evaluation
+    (see f0_cromer)
+
+    Parameters:
+    -----------
+    * elems is a list of symbols for element and valence
+    * q is sin(theta)/lambda, a single value or array of values
+    * database is an optional dict of coefficients (default f0data)
+
+    Returns:
+    --------
+    * f0 array of shape [n_elem, n_q].  Tables are memoized by the
+      element coefficients and the q grid, so identical grids (e.g.
+      the same rod in every fit iteration) are computed once.  The
+      returned array is shared and read-only
+    """
+    coefs = f0_coefs(elems, database=database)
+    q = num.ravel(num.asarray(q,dtype=float))
+    key = (coefs.tostring(), q.tostring())
+    f0 = _f0_cache.get(key)
+    if f0 is None:
+        q2 = -q*q
+        a = coefs[:,0:8:2,num.newaxis]
+        b = coefs[:,1:8:2,num.newaxis]
+        f0 = num.sum(a*num.exp(b*q2),axis=1) + coefs[:,8:9]
+        f0.flags.writeable = False
+        if len(_f0_cache) >= F0_MAX_CACHE: _f0_cache.clear()
+        _f0_cache[key] = f0
+    return f0
         
 ##########################################################################
 if (__name__ == '__main__'):
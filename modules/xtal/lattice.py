@@ -376,6 +376,77 @@ class Lattice:
         dvec = (dspc**2.)*dvec
         return dvec
 
+    def dot_array(self,u,v,recip=False):
+        """
+        Calculate the dot products of arrays of vectors
+
+        Parameters:
+        -----------
+        * u and v are (N x 3) arrays of vectors (or a single
+          vector, which is broadcast against the other array)
+        * If u and v are recip space vectors, use recip = True
+
+        Returns:
+        --------
+        * array of N dot products, u[i]*g*v[i]
+        """
+        if recip == True: g = self.gr
+        else: g = self.g
+        u = num.asarray(u,dtype=float)
+        v = num.asarray(v,dtype=float)
+        return num.sum(num.dot(u,g)*v,axis=-1)
+
+    def mag_array(self,v,recip=False):
+        """
+        Calculate the norms of an (N x 3) array of vectors
+        (see mag)
+        """
+        return num.sqrt(self.dot_array(v,v,recip=recip))
+
+    def angle_array(self,u,v,recip=False):
+        """
+        Calculate the angles between arrays of vectors
+        (see angle and dot_array)
+        """
+        uv = self.dot_array(u,v,recip=recip)
+        um = self.mag_array(u,recip=recip)
+        vm = self.mag_array(v,recip=recip)
+        arg = num.clip(uv/(um*vm),-1.0,1.0)
+        return arccosd(arg)
+
+    def d_array(self,hkl):
+        """
+        Calculate d spaces for an (N x 3) array of [h,k,l],
+        zero magnitude hkl give d = 0
+        """
+        h = self.mag_array(hkl,recip=True)
+        d = num.zeros(h.shape)
+        d[h > 0.] = 1./h[h > 0.]
+        return d
+
+    def tth_array(self,hkl,lam=None):
+        """
+        Calculate 2Theta for an (N x 3) array of [h,k,l]
+        (see tth)
+        """
+        if lam != None: self.lam = float(lam)
+        d = self.d_array(hkl)
+        tth = num.zeros(d.shape)
+        idx = d > 0.
+        r = num.clip(self.lam/(2.*d[idx]),-1.0,1.0)
+        tth[idx] = 2.*arcsind(r)
+        return tth
+
+    def dvec_array(self,hkl):
+        """
+        Calculate the real space vectors d (see dvec) for an
+        (N x 3) array of [h,k,l], returns an (N x 3) array
+        """
+        hkl  = num.asarray(hkl,dtype=float)
+        dvec = num.dot(hkl,self.gr)
+        dspc = self.d_array(hkl)
+        return (dspc**2.)[...,num.newaxis]*dvec
+
     def recip_to_real(self,hkl):
         """
         Given recip vector hkl = [h,k,l] calculate the
@@ -24,6 +24,9 @@ import string
 
 from tdl.modules.xtal import lattice
 
+# tolerance (fractional units) for duplicate positions
+TOL = 1.0e-5
+
 # try importing the aussie pycif module
 # if it wont load we should have our own simple backup
 # for reading/writing structures as cif files
@@ -33,6 +36,11 @@ try:
 except:
     pass  # print "    No Pycif module available"
 
+##########################################################################
+def _cif_float(val):
+    """ float from a cif value (e.g. '0.1234(5)') """
+    return float(str(val).split('(')[0])
+
 ##########################################################################
 class UnitCell:
     """
@@ -66,25 +74,26 @@ class UnitCell:
         elem_positions = {}
         
         while (counter < num_atoms): 
-            elem_positions = {'name':atoms[n], 'x':x[n], 'y':y[n], 'z':z[n]}
+            elem_positions = {'name':atoms[n], 'x':_cif_float(x[n]),
+                              'y':_cif_float(y[n]), 'z':_cif_float(z[n])}
             assym_unit.append(elem_positions)
             counter = counter + 1
             n = n + 1
 
         self.assym_unit = assym_unit
 
-        a = cb['_cell_length_a']
+        a = _cif_float(cb['_cell_length_a'])
         self.a = a
-        b = cb['_cell_length_b']
+        b = _cif_float(cb['_cell_length_b'])
         self.b = b
-        c = cb['_cell_length_c']
+        c = _cif_float(cb['_cell_length_c'])
         self.c = c
 
-        alpha = cb['_cell_angle_alpha']
+        alpha = _cif_float(cb['_cell_angle_alpha'])
         self.alpha = alpha
-        beta = cb['_cell_angle_beta']
+        beta = _cif_float(cb['_cell_angle_beta'])
         self.beta = beta
-        gamma = cb['_cell_angle_gamma']
+        gamma = _cif_float(cb['_cell_angle_gamma'])
         self.gamma = gamma
 
          # store values
@@ -99,43 +108,43 @@ class UnitCell:
         # This converts all the operations into a list of strings
         sym_values = sym_values[0] 
 
-        num_opers = len(sym_values)
-        p = PositionGenerator()
-
-        dict_length = len(assym_unit)
-        counter = 0
-        position = 0
-        atom_name = 1
-        
-        while (counter < dict_length):
-            print "Fractional coordinates for ", atom_name
-            while (position < num_opers):
-                tmp = sym_values[position]
-                xyz = tmp.split(split, ',')
-                x=xyz[0]
-                y=xyz[1]
-                z=xyz[2]
-                matrix = p._make_seitz_matrix(x,y,z)
-                p.ops.append(matrix)
-                position = position + 1
-            vecs = p.copy(0.11,0.5,0.5,reduce=True,rem_dups=True)
-            for v in vecs: print v   
-            counter = counter + 1
-            position = 0
-            atom_name = atom_name + 1
-
-       #Store positions
+        # store the sym ops
         self.symm = PositionGenerator()
-        # loop through and add sym ops to self.symm
+        for sym in sym_values:
+            self.symm.add_op(sym=sym)
+
+        # generate all positions of the unit cell
+        self.p1 = self.generate_p1()
+        print "Number of positions in the unit cell = %i" % len(self.p1)
         
     def write_cif(self):
         pass
    
     def generate_p1(self,na=1,nb=1,nc=1):
-        cell = self.lattice(a,b,c,alpha,beta,gamma) 
-        # cell is a new lattice instance
-        # Now generate positions
-        
+        """
+        Generate all positions of a block of na x nb x nc unit cells
+        from the assymetric unit and the symmetry operators
+
+        Outputs:
+        --------
+        * list of dictionaries {'name','x','y','z','parent'}, x,y,z
+          are fractional coordinates of the block (0 to 1) and parent
+          is the index of the assymetric unit atom
+        """
+        assym = self.assym_unit
+        pos = [[atom['x'],atom['y'],atom['z']] for atom in assym]
+        (vectors,parent,op) = self.symm.expand(pos)
+        # translate to each cell of the block
+        cells   = num.indices((na,nb,nc)).reshape(3,-1).T
+        vectors = (vectors[num.newaxis,:,:] + cells[:,num.newaxis,:])
+        vectors = vectors.reshape(-1,3) / num.array([na,nb,nc],dtype=float)
+        parent  = num.tile(parent,len(cells))
+        p1 = []
+        for j in range(len(vectors)):
+            p1.append({'name':assym[parent[j]]['name'],'x':vectors[j][0],
+                       'y':vectors[j][1],'z':vectors[j][2],
+                       'parent':int(parent[j])})
+        return p1
             
     def transform(self):
         """
@@ -211,7 +220,7 @@ class PositionGenerator:
         #print 'x=',x,'y=',y,'z=',z
         
         m = self._make_seitz_matrix(x,y,z)
-        if m != None:
+        if m is not None:
             self.ops.append(m)
 
     ###########################################################    
@@ -251,18 +260,79 @@ class PositionGenerator:
             return v
         #
         v1 = _vec(x)
-        if v1 == None: return None
+        if v1 is None: return None
         v2 = _vec(y)
-        if v2 == None: return None
+        if v2 is None: return None
         v3 = _vec(z)
-        if v3 == None: return None
+        if v3 is None: return None
         v4 = [0.,0.,0.,1.]
         m = num.array([v1,v2,v3,v4])
         #print m
         return m
 
     ###########################################################    
-    def copy(self,x,y,z,reduce=True,rem_dups=True):
+    def op_array(self):
+        """
+        Array (nops x 4 x 4) of the seitz matrices
+        """
+        if len(self.ops) == 0:
+            return num.zeros((0,4,4))
+        return num.array(self.ops,dtype=float)
+
+    ###########################################################    
+    def expand(self,positions,reduce=True,rem_dups=True,tol=TOL):
+        """
+        Calc all sym copies of a set of positions
+
+        Parameters:
+        -----------
+        * positions is a list/array (npos x 3) of fractional coordinates
+        * reduce is flag to indicate that all positions must be in
+          bounds 0 to 1
+        * rem_dups is a flag to indicate if duplicates (copies of the
+          same position that agree within tol) should be removed
+        * tol is the tolerance (fractional units) for duplicates
+
+        Outputs:
+        --------
+        * (vectors,parent,op) where vectors is an array (n x 3) of the
+          symmetry copy positions, parent[j] is the index of the
+          position and op[j] the index of the operator that generated
+          vectors[j].  The copies are ordered by position then operator.
+
+        Notes:
+        ------
+        All operators are applied to all positions in one array
+        product.  Duplicates are found by hashing the coordinates
+        rounded to multiples of tol (with 0 and 1 identified when
+        reduce is True), the first copy of each is kept.
+        """
+        pos = num.array(positions,dtype=float).reshape(-1,3)
+        ops = self.op_array()
+        (npos,nops) = (len(pos),len(ops))
+        # v[n,o] = R[o].pos[n] + t[o]
+        vectors = num.dot(pos,num.transpose(ops[:,:3,:3],(0,2,1))) + ops[:,:3,3]
+        vectors = vectors.reshape(npos*nops,3)
+        parent  = num.repeat(num.arange(npos),nops)
+        op      = num.tile(num.arange(nops),npos)
+        if reduce == True:
+            vectors = vectors - num.floor(vectors)
+            # rounding of small negative values gives 1.0
+            vectors[vectors >= 1.0] = 0.0
+        if rem_dups == True and len(vectors) > 0:
+            key = num.around(vectors/tol).astype(num.int64)
+            if reduce == True:
+                key = key % int(round(1./tol))
+            key = num.column_stack((parent,key))
+            keep = {}
+            for j in range(len(key)):
+                keep.setdefault(key[j].tostring(),j)
+            idx = num.sort(keep.values())
+            (vectors,parent,op) = (vectors[idx],parent[idx],op[idx])
+        return (vectors,parent,op)
+
+    ###########################################################    
+    def copy(self,x,y,z,reduce=True,rem_dups=True,tol=TOL):
         """
         Calc all sym copies of a position
 
@@ -273,57 +343,15 @@ class PositionGenerator:
           positions must be in bounds  0 to 1
         * rem_dups is a flag to indicate if duplicates
           should be removed
+        * tol is the tolerance for duplicates (see expand)
 
         Outputs:
         --------
         * list of vectors of symmetry copy positions
         """
-        v0 = num.array([float(x),float(y),float(z),1.0])
-        vectors = []
-        for m in self.ops:
-            vc = num.dot(m,v0)
-            vectors.append(vc[:3])
-        
-        # reduce values
-        def _reduce(x):
-            while 1:
-                if x >= 1.0:
-                    x = x-1.0
-                if x < 0.0:
-                    x = x + 1.0
-                if num.fabs(x) < 1.0:
-                    return x
-        #
-        if reduce == True:
-            for j in range(len(vectors)):
-                if vectors[j][0] >= 1.0 or vectors[j][0] < 0.0:
-                    vectors[j][0] = _reduce(vectors[j][0])
-                if vectors[j][1] >= 1.0 or vectors[j][1] < 0.0:
-                    vectors[j][1] = _reduce(vectors[j][1])
-                if vectors[j][2] >= 1.0 or vectors[j][2] < 0.0:
-                    vectors[j][2] = _reduce(vectors[j][2])
-
-        # remove duplicates
-        def _rem_dups(vectors):
-            unique = []
-            while len(vectors) > 0:
-                v = vectors.pop(0)
-                #print "-->new vector=", v
-                add = True
-                for u in unique:
-                    #print '    ', u
-                    tmp = num.equal(v,u)
-                    if tmp.all():
-                        add = False
-                        break
-                if add:
-                    unique.append(v)
-            return unique
-
-        if rem_dups == True:
-            vectors = _rem_dups(vectors)
-
-        return vectors
+        (vectors,parent,op) = self.expand([[x,y,z]],reduce=reduce,
+                                          rem_dups=rem_dups,tol=tol)
+        return list(vectors)
 
 ##########################################################################
 ##########################################################################
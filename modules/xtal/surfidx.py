@@ -36,7 +36,7 @@ import numpy as num
 from lattice import Lattice, LatticeTransform
 
 ##########################################################################
-def surface_vectors(hkl, lat):
+def surface_vectors(hkl, lat, nmax=4):
     """
     Calculate in-plane lattice vectors, and repeat vectors
 
@@ -44,66 +44,46 @@ def surface_vectors(hkl, lat):
     -----------
     * hkl defines the plane
     * lat defines the lattice (is a Lattice instance)
+    * nmax is the max lattice vector index searched, ie
+      all [n1,n2,n3] with -nmax <= n <= nmax
 
     Output:
     -------
-    Vr:  The first three column's of the output give coefficients of the
-    in plane vectors. The fourth is the vector length
+    Vs:  The first three column's of the output give coefficients of the
+    in plane vectors. The fourth is the vector length, Vs is sorted
+    according to the magnitudes
     
-    Vs: The first three column's of the output give coefficients of the
+    Vr: The first three column's of the output give coefficients of the
     repeat vectors. The fourth is the magnitude, fifth is the plane
     below the surface at which it terminates, and sixth is the
-    angle of the vector relative to the surface normal
-    
-    All the vectors are sorted according to their magnitudes given 
-    in column 4 of the output. 
+    angle of the vector relative to the surface normal.  Vr is sorted
+    according to the angle
     """
     # calculate vector d in bulk real space basis
     d = lat.dvec(hkl)
 
-    #calculate surface vectors for a given hkl plane through origin
-    Vs_tmp=[]
-    Vr_tmp=[]
-    vrange = range(-4,5)
-    for n1 in vrange:
-        for n2 in vrange:
-            for n3 in vrange:
-                temp = n1*hkl[0] + n2*hkl[1] + n3*hkl[2]
-                # from law of rational indicies, temp is zero 
-                # if the lattice vector is in the hkl plane
-                if temp == 0:
-                    v = [n1, n2, n3]
-                    v_mag = lat.mag(v,lat)
-                    Vs_tmp.append([n1, n2, n3, v_mag] )
-                # from law of rational indicies, temp < zero 
-                # if the lattice vector points below the hkl plane
-                # and temp is the number of planes below the surface
-                # where v terminates
-                elif temp < 0:
-                    v = [n1, n2, n3]
-                    v_mag = lat.mag(v,lat)
-                    v_ang = lat.angle(v,-1.*d,lat)
-                    Vr_tmp.append([n1, n2, n3, v_mag,temp,v_ang])
-
-    # Vs_tmp has all the surface vectors,
-    # now sort them according to magnitude
-    Vs_tmp = num.array(Vs_tmp)
-    idx = num.argsort(Vs_tmp[:,3])
-    Vs = []
-    for n in range(0,len(idx)):
-        x = Vs_tmp[idx[n],:]
-        Vs.append(x)
-    Vs = num.array(Vs)
-
-    # Vr_tmp has lot of possible slab vectors,
-    # now sort them according to angle they make with -d
-    Vr_tmp = num.array(Vr_tmp)
-    idx = num.argsort(Vr_tmp[:,5])
-    Vr = []
-    for n in range(0,len(idx)):
-        x = Vr_tmp[idx[n],:]
-        Vr.append(x)
-    Vr = num.array(Vr)
+    # all lattice vectors [n1,n2,n3] of the search range
+    vrange = num.arange(-nmax,nmax+1)
+    (n1,n2,n3) = num.meshgrid(vrange,vrange,vrange,indexing='ij')
+    v = num.transpose([n1.ravel(),n2.ravel(),n3.ravel()]).astype(float)
+
+    # from law of rational indicies, temp is zero if the lattice
+    # vector is in the hkl plane, temp < zero if the lattice vector
+    # points below the hkl plane and temp is the number of planes
+    # below the surface where v terminates
+    temp = num.dot(v,num.asarray(hkl,dtype=float))
+
+    # surface vectors, sorted according to magnitude
+    vs = v[temp == 0]
+    Vs = num.column_stack((vs,lat.mag_array(vs)))
+    Vs = Vs[num.argsort(Vs[:,3],kind='mergesort')]
+
+    # possible slab vectors, sorted according to the angle they
+    # make with -d
+    vr = v[temp < 0]
+    Vr = num.column_stack((vr,lat.mag_array(vr),temp[temp < 0],
+                           lat.angle_array(vr,-1.*d)))
+    Vr = Vr[num.argsort(Vr[:,5],kind='mergesort')]
 
     return Vs,Vr
 
@@ -124,42 +104,23 @@ def calc_surf_cell(F,bulk_name,cell):
     cell_str = lines.pop(0)
     xyz_list = []
     el_list = []
-    el = None
-    for m in range(0,len(lines)):
-        tmp = string.split(lines[m])
-        x = float(tmp[1])
-        y = float(tmp[2])
-        z = float(tmp[3])
-        el = tmp[0]
-        el_list.append(el)
-        xyz_a = [x,y,z]
-        xyz_list.append(xyz_a)
+    for line in lines:
+        tmp = line.split()
+        el_list.append(tmp[0])
+        xyz_list.append([float(tmp[1]),float(tmp[2]),float(tmp[3])])
     # use p to check if the file is read and sorted correctly
     # and use it later while writing out the file
     p = len(xyz_list)
-    xyz = xyz_list
-    el_name = el_list
-    xyz_list = num.array(xyz_list)
-    xyz_tmp = []
-    el = None
-    el_tmp=[]
-    for xt in range(0,8):
-        for yt in range(0,8):
-            for zt in range(-1,2):
-                for j in range(0,len(el_list)):
-                    xyz_tmp = [xyz_list[j,0]+ xt, xyz_list[j,1]+yt, xyz_list[j,2]+zt]
-                    xyz.append(xyz_tmp)
-                    el = el_list[j]
-                    el_tmp.append(el)
-    xyz = num.array(xyz)
-    for j in range(0,len(el_tmp)):
-        el_name.append(el_tmp[j])
-    for j in range(0,len(el_name)):
-        v_tmp = num.array([xyz[j,0],xyz[j,1],xyz[j,2]])
-        v = num.matrixmultiply(F,num.transpose(v_tmp))
-        xyz[j,0] = v[0]
-        xyz[j,1] = v[1]
-        xyz[j,2] = v[2]
+    xyz_list = num.array(xyz_list,dtype=float).reshape(p,3)
+    # the bulk atoms followed by the atoms translated by
+    # [xt,yt,zt], 0 <= xt,yt < 8 and -1 <= zt <= 1
+    (xt,yt,zt) = num.meshgrid(num.arange(0,8),num.arange(0,8),
+                              num.arange(-1,2),indexing='ij')
+    shift = num.transpose([xt.ravel(),yt.ravel(),zt.ravel()])
+    xyz = xyz_list[num.newaxis,:,:] + shift[:,num.newaxis,:]
+    xyz = num.concatenate((xyz_list,xyz.reshape(-1,3)))
+    el_name = el_list * (len(shift) + 1)
+    xyz = num.dot(xyz,num.transpose(F))
     fname_out = bulk_name + ".surf"
     file = open(fname_out,'w')
     s = '%-5i\n' % len(el_name)
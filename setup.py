@@ -62,6 +62,7 @@ packages.append('tdl.modules.xrd')
 packages.append('tdl.modules.xrf')
 packages.append('tdl.modules.xrr')
 packages.append('tdl.modules.xtab')
+package_data.update({'tdl.modules.xtab':['f1f2/*.nff','f1f2/read.me']})
 packages.append('tdl.modules.xtal')
 
 #dlls